@@ -0,0 +1,92 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the bulk load methods against plain ORM session.add() and
+commit on a sqlite file.
+
+    python benchmarks/bulk_load.py [rows]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy.orm import declarative_base
+from dodai.model.database import GetDatabase
+
+Base = declarative_base()
+
+
+class Event(Base):
+    __tablename__ = 'events'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(40))
+    value = Column(Integer)
+
+
+def rows(count):
+    for x in range(count):
+        yield (x, 'event-{0}'.format(x), x % 97)
+
+
+def main(count):
+    directory = tempfile.mkdtemp()
+    try:
+        sections = {}
+        for method in ('orm', 'executemany', 'values'):
+            sections['db.{0}'.format(method)] = {
+                'dialect': 'sqlite',
+                'filename': os.path.join(directory,
+                                         '{0}.sqlite'.format(method)),
+            }
+        get_database = GetDatabase.load(sections)
+        print("{0:<12} {1:>10} {2:>10} {3:>12}".format(
+                'method', 'rows', 'seconds', 'rows/sec'))
+        for method in ('orm', 'executemany', 'values'):
+            database = get_database('db.{0}'.format(method))
+            Base.metadata.create_all(database.engine)
+            if method == 'orm':
+                orm_count = min(count, 100000)
+                start = time.perf_counter()
+                session = database.session
+                for x, name, value in rows(orm_count):
+                    session.add(Event(id=x, name=name, value=value))
+                session.commit()
+                seconds = time.perf_counter() - start
+                print("{0:<12} {1:>10} {2:>10.3f} {3:>12.0f}".format(
+                        method, orm_count, seconds, orm_count / seconds))
+                continue
+            result = database.bulk_load(Event.__table__, rows(count),
+                                        method=method)
+            print("{0:<12} {1:>10} {2:>10.3f} {3:>12.0f}".format(
+                    method, result.rows, result.seconds,
+                    result.rows_per_second))
+            database.engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,85 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Scans a large sqlite file with ParallelScan using threads and processes
+at several worker counts and prints the throughput of each.
+
+    python benchmarks/parallel_scan.py [rows]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+
+from sqlalchemy import Column
+from sqlalchemy import Float
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from dodai.model.database import GetDatabase
+
+
+def rows(count):
+    for x in range(count):
+        yield (x, 'customer-{0}'.format(x % 5000), x % 97, x * 0.5)
+
+
+def main(count):
+    directory = tempfile.mkdtemp()
+    try:
+        get_database = GetDatabase.load({
+            'db.scan': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(directory, 'scan.sqlite'),
+            },
+        })
+        metadata = MetaData()
+        table = Table('events', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('customer', String(40)),
+                      Column('kind', Integer),
+                      Column('amount', Float))
+        database = get_database('db.scan')
+        metadata.create_all(database.engine)
+        started = time.perf_counter()
+        database.bulk_load(table, rows(count))
+        print("loaded {0} rows in {1:.1f}s".format(
+                count, time.perf_counter() - started))
+        cores = os.cpu_count() or 1
+        workers = sorted(set([1, 2, 4, cores]))
+        for mode in ('thread', 'process'):
+            for worker_count in workers:
+                scan = get_database.scan('db.scan', table, 'id',
+                                         workers=worker_count, mode=mode,
+                                         partitions=worker_count * 8,
+                                         batch_size=5000)
+                total = sum(len(batch) for batch in scan)
+                assert total == count, total
+                print(scan.report)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000000)
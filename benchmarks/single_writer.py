@@ -0,0 +1,151 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares threads writing one sqlite file through the engine, one commit
+per row, with the same writes through a SingleWriter, then measures reads
+on its reader connections while one thread keeps writing.
+
+    python benchmarks/single_writer.py [threads] [rows per thread]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from dodai.model.database import GetDatabase
+
+CREATE = "CREATE TABLE events (id INTEGER PRIMARY KEY, kind TEXT)"
+INSERT = "INSERT INTO events (id, kind) VALUES (:id, :kind)"
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(x,))
+               for x in range(count)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def engine_writes(database, threads, rows):
+    engine = database.engine
+    with engine.begin() as connection:
+        connection.execute(text(CREATE))
+    errors = []
+
+    def write(number):
+        for x in range(number * rows, (number + 1) * rows):
+            try:
+                with engine.begin() as connection:
+                    connection.execute(text(INSERT), {'id': x, 'kind': 'a'})
+            except OperationalError:
+                errors.append(x)
+
+    seconds = run_threads(threads, write)
+    return threads * rows - len(errors), len(errors), seconds
+
+
+def single_writer_writes(database, threads, rows):
+    manager = database.single_writer(readers=threads)
+    manager.write(CREATE)
+
+    def write(number):
+        for x in range(number * rows, (number + 1) * rows):
+            manager.write(INSERT, {'id': x, 'kind': 'a'})
+
+    seconds = run_threads(threads, write)
+    stats = manager.stats()
+    return stats['writes'] - 1, stats['writes_per_commit'], seconds
+
+
+def reads_during_writes(database, threads, rows, seconds=2.0):
+    manager = database.single_writer()
+    done = threading.Event()
+    writes = []
+    reads = []
+
+    def write():
+        x = threads * rows
+        while not done.is_set():
+            futures = [manager.submit(INSERT, {'id': key, 'kind': 'b'})
+                       for key in range(x, x + 100)]
+            for future in futures:
+                future.result()
+            writes.extend(futures)
+            x += len(futures)
+
+    def read(number):
+        key = number
+        while not done.is_set():
+            manager.read("SELECT kind FROM events WHERE id = :id",
+                         {'id': key % (threads * rows)})
+            reads.append(1)
+            key += 7919
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    timer = threading.Timer(seconds, done.set)
+    timer.start()
+    run_threads(threads, read)
+    writer.join()
+    manager.close()
+    return len(reads) / seconds, len(writes) / seconds
+
+
+def main(threads, rows):
+    directory = tempfile.mkdtemp()
+    try:
+        sections = {}
+        for name in ('engine', 'single'):
+            sections['db.{0}'.format(name)] = {
+                'dialect': 'sqlite',
+                'filename': os.path.join(directory, name + '.sqlite'),
+                'journal_mode': 'wal',
+                'synchronous': 'normal',
+                'busy_timeout': '100',
+            }
+        get_database = GetDatabase.load(sections)
+        written, locked, seconds = engine_writes(
+                get_database('db.engine'), threads, rows)
+        print("engine:        {0} rows, {1} 'database is locked', "
+              "{2:.0f} rows/sec".format(written, locked, written / seconds))
+        written, per_commit, seconds = single_writer_writes(
+                get_database('db.single'), threads, rows)
+        print("single writer: {0} rows, {1:.1f} rows per commit, "
+              "{2:.0f} rows/sec".format(written, per_commit,
+                                        written / seconds))
+        reads, writes = reads_during_writes(get_database('db.single'),
+                                            threads, rows)
+        print("readers:       {0} threads, {1:.0f} reads/sec alongside "
+              "{2:.0f} writes/sec".format(threads, reads, writes))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
@@ -0,0 +1,143 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures sqlite write and read throughput under several pragma profiles
+set in the config sections.  Writes are one transaction per row and one
+batched transaction, reads are primary key lookups and a grouped scan.
+
+    python benchmarks/sqlite_profiles.py [rows]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import func
+from sqlalchemy import select
+from dodai.model.database import GetDatabase
+
+PROFILES = (
+    ('default', {}),
+    ('wal', {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+    }),
+    ('wal-memory', {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': '-65536',
+        'mmap_size': '268435456',
+        'temp_store': 'memory',
+        'busy_timeout': '5000',
+    }),
+    # Not crash safe, for comparison only
+    ('unsafe', {
+        'journal_mode': 'memory',
+        'synchronous': 'off',
+    }),
+)
+
+
+def rows(start, count):
+    for x in range(start, start + count):
+        yield {'id': x, 'name': 'event-{0}'.format(x), 'kind': x % 97}
+
+
+def timed(function):
+    started = time.perf_counter()
+    count = function()
+    return count / (time.perf_counter() - started)
+
+
+def run(database, table, count):
+    engine = database.engine
+    table.metadata.create_all(engine)
+    commits = max(count // 100, 100)
+
+    def single_commits():
+        for row in rows(0, commits):
+            with engine.begin() as connection:
+                connection.execute(table.insert(), row)
+        return commits
+
+    def batch():
+        database.bulk_load(table, rows(commits, count))
+        return count
+
+    keys = [random.randrange(commits + count) for x in range(count // 10)]
+
+    def lookups():
+        statement = select(table.c.name).where(table.c.id == 0)
+        compiled = str(statement.compile(engine))
+        with engine.connect() as connection:
+            cursor = connection.connection.cursor()
+            for key in keys:
+                cursor.execute(compiled, (key,))
+                cursor.fetchall()
+        return len(keys)
+
+    def scan():
+        statement = select(table.c.kind, func.count(), func.max(table.c.name))\
+                .group_by(table.c.kind).order_by(func.max(table.c.name))
+        with engine.connect() as connection:
+            for x in range(3):
+                connection.execute(statement).fetchall()
+        return (commits + count) * 3
+
+    return [timed(x) for x in (single_commits, batch, lookups, scan)]
+
+
+def main(count):
+    directory = tempfile.mkdtemp()
+    try:
+        sections = {}
+        for name, pragmas in PROFILES:
+            section = dict(pragmas)
+            section['dialect'] = 'sqlite'
+            section['filename'] = os.path.join(directory,
+                                               '{0}.sqlite'.format(name))
+            sections['db.{0}'.format(name)] = section
+        get_database = GetDatabase.load(sections)
+        print("{0:<12} {1:>14} {2:>14} {3:>14} {4:>14}".format(
+                'profile', 'commits/sec', 'batch rows/s', 'lookups/sec',
+                'scan rows/s'))
+        for name, pragmas in PROFILES:
+            table = Table('events', MetaData(),
+                          Column('id', Integer, primary_key=True),
+                          Column('name', String(40)),
+                          Column('kind', Integer))
+            database = get_database('db.{0}'.format(name))
+            print("{0:<12} {1:>14.0f} {2:>14.0f} {3:>14.0f} {4:>14.0f}".format(
+                    name, *run(database, table, count)))
+            database.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
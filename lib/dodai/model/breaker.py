@@ -0,0 +1,229 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from sqlalchemy import event
+from dodai.model import fork
+from dodai.model.metrics import MetricFamily
+
+
+class CircuitOpen(Exception):
+    """Raised instead of connecting while a section's circuit breaker is
+    open
+    """
+
+
+_breakers = weakref.WeakSet()
+
+
+class CircuitBreaker(object):
+    """Stops a section from waiting on a database that is down.
+
+    The breaker starts closed.  After 'failures' failed attempts in a row
+    it opens, and every attempt fails at once with CircuitOpen, without
+    touching the network, for 'reset' seconds.  It is then half open: one
+    attempt is let through as a trial while the others keep failing fast.
+    The trial succeeding closes the breaker and it failing opens it again.
+
+    install() guards the new DBAPI connections of an engine, so the pool
+    fails fast when it needs a connection, and counts disconnect errors of
+    statements as failures.  guard() and call() guard anything else.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    STATES = (CLOSED, OPEN, HALF_OPEN)
+
+    FAILURES = 5
+    RESET = 30.0
+
+    def __init__(self, name, failures=None, reset=None, clock=None):
+        """
+        :param name: The section name the metrics are labelled with
+        :param failures: Failures in a row that open the breaker
+        :param reset: Seconds the breaker stays open before a trial
+        :param clock: A callable that returns the time in seconds, by
+            default time.monotonic
+        """
+        self.name = name
+        self.failures = failures or self.FAILURES
+        self.reset = reset or self.RESET
+        self._clock = clock or time.monotonic
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trial = False
+        self.consecutive_failures = 0
+        self.failures_total = 0
+        self.rejected = 0
+        self.opened = 0
+        self.last_error = None
+        _breakers.add(self)
+        fork.register(self)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current()
+
+    def _current(self):
+        if self._state == self.OPEN and \
+                self._clock() - self._opened_at >= self.reset:
+            self._state = self.HALF_OPEN
+            self._trial = False
+        return self._state
+
+    def allow(self):
+        """Raises CircuitOpen unless an attempt may go ahead now.  Every
+        allowed attempt must be followed by success() or failure().
+        """
+        with self._lock:
+            state = self._current()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            self.rejected += 1
+        raise CircuitOpen("The circuit breaker of '{0}' is {1}".format(
+                self.name, state))
+
+    def success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._trial = False
+            self._state = self.CLOSED
+
+    def failure(self, error=None):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.failures_total += 1
+            self.last_error = error
+            state = self._current()
+            if state == self.HALF_OPEN or (
+                    state == self.CLOSED and
+                    self.consecutive_failures >= self.failures):
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                self.opened += 1
+            self._trial = False
+
+    @contextmanager
+    def guard(self):
+        """Runs the body of the with statement as one attempt
+        """
+        self.allow()
+        try:
+            yield
+        except Exception as e:
+            self.failure(e)
+            raise
+        except BaseException:
+            # Interrupted, so neither a success nor a failure
+            with self._lock:
+                self._trial = False
+            raise
+        self.success()
+
+    def call(self, function, *args, **kwargs):
+        with self.guard():
+            return function(*args, **kwargs)
+
+    def install(self, engine):
+        """Guards the new DBAPI connections of the engine.  This should be
+        the last do_connect listener of the engine, because it makes the
+        connection itself.
+        """
+        event.listen(engine, 'do_connect', self._do_connect)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def _do_connect(self, dialect, connection_record, cargs, cparams):
+        with self.guard():
+            return dialect.connect(*cargs, **cparams)
+
+    def _handle_error(self, context):
+        # Failed connects were already counted by _do_connect
+        if context.is_disconnect and context.connection is not None:
+            self.failure(context.original_exception)
+
+    def stats(self):
+        """Returns the state and counters as a dictionary
+        """
+        with self._lock:
+            return {
+                'name': self.name,
+                'state': self._current(),
+                'consecutive_failures': self.consecutive_failures,
+                'failures': self.failures_total,
+                'rejected': self.rejected,
+                'opened': self.opened,
+                'last_error': self.last_error,
+            }
+
+    def collect(self):
+        """Returns the breaker's state and counters as a list of
+        MetricFamily for dodai.model.metrics.render_prometheus()
+        """
+        return BreakerMetrics([self]).collect()
+
+    def after_fork(self):
+        """Makes a new lock in the child process and forgets a trial that
+        was in flight in the parent.  Called automatically after os.fork().
+        """
+        self._lock = threading.Lock()
+        self._trial = False
+
+
+class BreakerMetrics(object):
+    """Collector of the circuit breakers of many sections for
+    dodai.model.metrics.render_prometheus().  Without a list of breakers
+    every breaker that is still in use is collected.
+
+    To use this class::
+
+        render_prometheus(PoolMetrics(), BreakerMetrics())
+    """
+
+    COUNTERS = (
+        ('failures', "Failed attempts counted by the circuit breaker"),
+        ('rejected', "Attempts failed fast by an open circuit breaker"),
+        ('opened', "Times the circuit breaker opened"),
+    )
+
+    def __init__(self, breakers=None):
+        self._breakers = breakers
+
+    def collect(self):
+        breakers = self._breakers if self._breakers is not None else \
+                   sorted(list(_breakers), key=lambda x: x.name)
+        state = MetricFamily('dodai_circuit_breaker_state', 'gauge',
+                             "1 for the state the circuit breaker is in")
+        counters = [MetricFamily('dodai_circuit_breaker_{0}_total'.format(
+                key), 'counter', help_) for key, help_ in self.COUNTERS]
+        for breaker in breakers:
+            stats = breaker.stats()
+            labels = {'section': breaker.name}
+            for name in CircuitBreaker.STATES:
+                state.add(dict(labels, state=name),
+                          int(stats['state'] == name))
+            for family, (key, help_) in zip(counters, self.COUNTERS):
+                family.add(labels, stats[key])
+        return [state] + counters
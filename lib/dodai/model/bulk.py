@@ -0,0 +1,270 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from itertools import chain
+from itertools import islice
+from operator import itemgetter
+from sqlalchemy import Table
+
+
+class BulkLoadResult(object):
+    """The progress of a bulk load
+    """
+
+    def __init__(self, table, method):
+        self.table = table
+        self.method = method
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return None
+        return self.rows / self.seconds
+
+    def __repr__(self):
+        return "<BulkLoadResult table={0!r} method={1!r} rows={2} "\
+               "seconds={3:.3f}>".format(self.table, self.method, self.rows,
+                                         self.seconds)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea in the hex format, with its backslash escaped for COPY
+        return '\\\\x' + bytes(value).hex()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t')\
+                     .replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _CopyBuffer(object):
+    """A file-like object that feeds a batch of rows to COPY in the text
+    format one line at a time
+    """
+
+    def __init__(self, rows):
+        self._lines = ('\t'.join(_copy_value(x) for x in row) + '\n'
+                       for row in rows)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            size = len(self._buffer)
+        out, self._buffer = self._buffer[:size], self._buffer[size:]
+        return out
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class BulkLoad(object):
+    """Callable object that streams rows into a table inside of a single
+    transaction.
+
+    Rows are tuples in the order of the columns, or dictionaries keyed by
+    column name.  They are read from the iterable one batch at a time, so
+    only one batch is ever held in memory.  Each batch goes to the database
+    with one of these methods:
+
+        * **executemany**: one INSERT run with the DBAPI executemany
+        * **values**: multi-row INSERT ... VALUES (...), (...) statements of
+          up to VALUES_ROWS rows, kept under sqlite's bound parameter limit.
+          The default for sqlite.
+        * **copy**: postgresql COPY ... FROM STDIN through psycopg2.  The
+          default for postgresql when psycopg2 is the driver.
+
+    To use this class::
+
+        database = get_database('db.blue')
+        result = database.bulk_load('events', rows,
+                                    columns=('id', 'name', 'created'))
+        print(result.rows_per_second)
+    """
+
+    # Number of values (rows times columns) sent in a batch
+    BATCH_VALUES = 20000
+    # Rows in one multi-row VALUES statement.  Longer statements cost more
+    # to parse than they save in round trips.
+    VALUES_ROWS = 100
+    # sqlite's default limit on bound parameters before 3.32
+    SQLITE_MAX_VARIABLES = 999
+    SQLITE_MAX_VARIABLES_NEW = 32766
+    METHODS = ('auto', 'executemany', 'values', 'copy')
+    NO_COLUMNS = "The columns of the bulk load into '{table}' are not "\
+                 "known.  Pass columns or a sqlalchemy Table."
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def __call__(self, table, rows, columns=None, batch_size=None,
+                 method='auto', progress=None):
+        """
+        :param table: A sqlalchemy Table or a table name
+        :param rows: An iterable of tuples or dictionaries
+        :param columns: The column names.  Taken from the Table, or the keys
+            of the first row when the rows are dictionaries, when not given.
+        :param batch_size: The number of rows in a batch.  Worked out from
+            the number of columns when not given.
+        :param method: One of 'auto', 'executemany', 'values' or 'copy'
+        :param progress: A callable that is called with the BulkLoadResult
+            after every batch
+        :returns: A BulkLoadResult
+        """
+        if method not in self.METHODS:
+            raise ValueError("The bulk load method '{0}' is not one of "
+                             "{1!r}".format(method, self.METHODS))
+        if method == 'auto':
+            method = self._default_method()
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            # Nothing to load, so the columns need not be known
+            return BulkLoadResult(
+                    table.name if isinstance(table, Table) else table, method)
+        table_name, schema, columns = self._columns(table, columns, first)
+        batch_size = batch_size or max(self.BATCH_VALUES // len(columns), 1)
+        result = BulkLoadResult(table_name, method)
+        to_row = self._row_converter(first, columns, method)
+        load = getattr(self, '_{0}'.format(method))
+        target = self._target(table_name, schema, columns)
+        self._statements = {}
+        start = time.perf_counter()
+        rows = chain([first], rows)
+        with self._engine.begin() as connection:
+            while True:
+                batch = [to_row(row) for row in islice(rows, batch_size)]
+                if not batch:
+                    break
+                load(connection, target, columns, batch)
+                result.rows += len(batch)
+                result.batches += 1
+                result.seconds = time.perf_counter() - start
+                if progress:
+                    progress(result)
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def _columns(self, table, columns, first):
+        schema = None
+        if isinstance(table, Table):
+            schema = table.schema
+            columns = columns or [x.name for x in table.columns]
+            table = table.name
+        elif not columns and isinstance(first, dict):
+            columns = list(first.keys())
+        if not columns:
+            raise ValueError(self.NO_COLUMNS.format(table=table))
+        return table, schema, list(columns)
+
+    def _default_method(self):
+        dialect = self._engine.dialect
+        if dialect.name == 'sqlite':
+            return 'values'
+        if dialect.name == 'postgresql' and dialect.driver == 'psycopg2':
+            return 'copy'
+        return 'executemany'
+
+    def _max_variables(self):
+        dbapi = self._engine.dialect.loaded_dbapi
+        version = getattr(dbapi, 'sqlite_version_info', (0,))
+        if version >= (3, 32):
+            return self.SQLITE_MAX_VARIABLES_NEW
+        return self.SQLITE_MAX_VARIABLES
+
+    def _named(self):
+        return self._engine.dialect.paramstyle in ('named', 'pyformat')
+
+    def _row_converter(self, first, columns, method):
+        if isinstance(first, dict):
+            if method != 'copy' and self._named():
+                return dict
+            getter = itemgetter(*columns)
+            if len(columns) == 1:
+                return lambda row: (getter(row),)
+            return getter
+        if method != 'copy' and self._named():
+            return lambda row: dict(zip(columns, row))
+        return tuple
+
+    def _target(self, table_name, schema, columns):
+        preparer = self._engine.dialect.identifier_preparer
+        target = preparer.quote(table_name)
+        if schema:
+            target = "{0}.{1}".format(preparer.quote_schema(schema), target)
+        names = ', '.join(preparer.quote(x) for x in columns)
+        return "{0} ({1})".format(target, names)
+
+    def _placeholders(self, columns, offset=0):
+        paramstyle = self._engine.dialect.paramstyle
+        if paramstyle == 'qmark':
+            out = ['?'] * len(columns)
+        elif paramstyle == 'numeric':
+            out = [':{0}'.format(offset + x + 1) for x in range(len(columns))]
+        elif paramstyle == 'named':
+            out = [':{0}'.format(x) for x in columns]
+        elif paramstyle == 'pyformat':
+            out = ['%({0})s'.format(x) for x in columns]
+        else:
+            out = ['%s'] * len(columns)
+        return '({0})'.format(', '.join(out))
+
+    def _executemany(self, connection, target, columns, batch):
+        statement = "INSERT INTO {0} VALUES {1}".format(
+                target, self._placeholders(columns))
+        connection.exec_driver_sql(statement, batch)
+
+    def _values(self, connection, target, columns, batch):
+        if self._named():
+            return self._executemany(connection, target, columns, batch)
+        size = min(self.VALUES_ROWS,
+                   max(self._max_variables() // len(columns), 1))
+        for start in range(0, len(batch), size):
+            rows = batch[start:start + size]
+            parameters = tuple(value for row in rows for value in row)
+            connection.exec_driver_sql(
+                    self._values_statement(target, columns, len(rows)),
+                    parameters)
+
+    def _values_statement(self, target, columns, count):
+        """Returns the multi-row INSERT for count rows.  The statements are
+        kept so the driver's statement cache can reuse them.
+        """
+        if count not in self._statements:
+            values = ', '.join(self._placeholders(columns, x * len(columns))
+                               for x in range(count))
+            self._statements[count] = "INSERT INTO {0} VALUES {1}".format(
+                    target, values)
+        return self._statements[count]
+
+    def _copy(self, connection, target, columns, batch):
+        cursor = connection.connection.dbapi_connection.cursor()
+        try:
+            cursor.copy_expert("COPY {0} FROM STDIN".format(target),
+                               _CopyBuffer(batch))
+        finally:
+            cursor.close()
@@ -0,0 +1,153 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+class _Node(object):
+    """A node of the prefix trie.  'names' holds every name in the node's
+    subtree in the order the names were added.
+    """
+
+    __slots__ = ('children', 'names')
+
+    def __init__(self):
+        self.children = {}
+        self.names = []
+
+
+class PrefixTrie(object):
+    """A trie of names that returns every name starting with a prefix, in
+    the order the names were added, in time proportional to the length of
+    the prefix plus the number of names returned
+    """
+
+    def __init__(self, names=()):
+        self._root = _Node()
+        self._seen = set()
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if name in self._seen:
+            return
+        self._seen.add(name)
+        node = self._root
+        node.names.append(name)
+        for character in name:
+            child = node.children.get(character)
+            if child is None:
+                child = node.children[character] = _Node()
+            child.names.append(name)
+            node = child
+
+    def __contains__(self, name):
+        return name in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __call__(self, prefix=''):
+        node = self._root
+        for character in prefix:
+            node = node.children.get(character)
+            if node is None:
+                return ()
+        return tuple(node.names)
+
+
+class SectionCatalog(object):
+    """An index of the sections of one config snapshot.
+
+    Every section name goes into a PrefixTrie and every database section
+    into group, environment and role maps, so that the questions below are
+    answered without looking at unrelated sections.  Each answer, empty
+    ones included, is cached as a tuple, so asking again is one dictionary
+    lookup.  A catalog is not updated when the config changes; a new one is
+    built for the new config.
+
+    To use this class::
+
+        catalog = get_all_database_sections()['catalog']
+        catalog.databases()
+        catalog.group('customers', 'prod', role='replica')
+        catalog.prefix('db.reports')
+    """
+
+    def __init__(self, names=()):
+        """
+        :param names: Every section name of the config, in config order
+        """
+        self._trie = PrefixTrie(names)
+        self._databases = []
+        self._groups = {}
+        self._environments = {}
+        self._results = {}
+
+    def add_database(self, name, group=None, environment=None, role=None):
+        """Adds a valid database section to the index
+        """
+        self._trie.add(name)
+        self._databases.append(name)
+        if group:
+            keys = set([(group, None, None), (group, environment, None),
+                        (group, None, role), (group, environment, role)])
+            for key in keys:
+                # A dictionary keeps the order and finds a name in O(1)
+                self._groups.setdefault(key, {})[name] = None
+        if environment:
+            self._environments.setdefault(environment, []).append(name)
+        self._results.clear()
+
+    def _cached(self, key, find):
+        try:
+            return self._results[key]
+        except KeyError:
+            out = self._results[key] = tuple(find())
+            return out
+
+    def databases(self):
+        """Returns the names of the valid database sections
+        """
+        return self._cached(('databases',), lambda: self._databases)
+
+    def group(self, group, environment=None, role=None):
+        """Returns the names of the database sections of a group, optionally
+        only those of an environment and a role
+        """
+        return self._cached(
+                ('group', group, environment, role),
+                lambda: self._groups.get((group, environment, role), ()))
+
+    def groups(self):
+        """Returns the group names
+        """
+        return self._cached(('groups',), lambda: sorted(set(
+                key[0] for key in self._groups)))
+
+    def environment(self, environment):
+        """Returns the names of the database sections of an environment
+        """
+        return self._cached(('environment', environment),
+                            lambda: self._environments.get(environment, ()))
+
+    def prefix(self, prefix):
+        """Returns the names of every section, database or not, that starts
+        with the prefix
+        """
+        return self._cached(('prefix', prefix), lambda: self._trie(prefix))
+
+    def __contains__(self, name):
+        return name in self._trie
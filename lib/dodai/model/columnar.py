@@ -0,0 +1,232 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ColumnBuffer(object):
+    """The values of one column.
+
+    Integers, floats and booleans are kept in an array.array, anything else
+    in a list.  NULLs are stored as 0 in arrays and None in lists, and are
+    marked in 'mask', a bytearray with a 1 for every NULL, which is None
+    while the column has no NULLs.  An integer column that receives a float
+    becomes a float column, and an array column that receives anything
+    else becomes a list.
+    """
+
+    TYPECODES = ((bool, 'b'), (int, 'q'), (float, 'd'))
+
+    def __init__(self, name, typecode=None):
+        self.name = name
+        self.typecode = typecode
+        self.values = array(typecode) if typecode else []
+        self.mask = None
+        self._decided = bool(typecode)
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, values):
+        """Adds a chunk of values to the end of the column
+        """
+        length = len(self.values)
+        if not self._decided:
+            self._decide(values, length)
+        nulls = None
+        if None in values:
+            nulls = bytearray(x is None for x in values)
+            if self.typecode:
+                values = [0 if x is None else x for x in values]
+        if nulls or self.mask is not None:
+            if self.mask is None:
+                self.mask = bytearray(length)
+            self.mask.extend(nulls or bytes(len(values)))
+        self._append(values, length)
+
+    def _decide(self, values, length):
+        """Picks the type of the column from the first value that is not
+        NULL.  Until there is one the column stays a list of None.
+        """
+        for value in values:
+            if value is None:
+                continue
+            self._decided = True
+            for type_, typecode in self.TYPECODES:
+                if type(value) is type_:
+                    self.typecode = typecode
+                    self.values = array(typecode, bytes(
+                            length * array(typecode).itemsize))
+            return
+
+    def _append(self, values, length):
+        if not self.typecode:
+            self.values.extend(values)
+            return
+        try:
+            self.values.extend(values)
+            return
+        except (TypeError, OverflowError):
+            # array.extend() adds values one at a time, so drop the ones
+            # that made it in before the one that failed
+            del self.values[length:]
+        if self.typecode in ('b', 'q'):
+            try:
+                values_ = array('d', self.values)
+                values_.extend(values)
+                self.values = values_
+                self.typecode = 'd'
+                return
+            except (TypeError, OverflowError):
+                pass
+        self.values = self.tolist()
+        self.values.extend(values)
+        self.typecode = None
+
+    def is_null(self, index):
+        return self.mask is not None and bool(self.mask[index])
+
+    def tolist(self):
+        """Returns the values as a list with None for NULLs
+        """
+        out = list(self.values)
+        if self.mask is not None and self.typecode:
+            for index, null in enumerate(self.mask):
+                if null:
+                    out[index] = None
+        return out
+
+    def numpy(self):
+        """Returns the values as a numpy array sharing memory with the
+        buffer, or a masked array when the column has NULLs
+        """
+        if numpy is None:
+            raise ImportError("numpy is needed for ColumnBuffer.numpy()")
+        if self.typecode:
+            out = numpy.frombuffer(self.values, dtype=self.typecode)
+            if self.typecode == 'b':
+                out = out.astype(numpy.bool_)
+        else:
+            out = numpy.array(self.values, dtype=object)
+        if self.mask is not None:
+            mask = numpy.frombuffer(self.mask, dtype=numpy.uint8)
+            return numpy.ma.masked_array(out, mask=mask.astype(bool))
+        return out
+
+
+class ColumnarResult(object):
+    """The result of a query held column by column in ColumnBuffer objects
+    """
+
+    def __init__(self, names, columns):
+        self.names = list(names)
+        self._columns = dict(zip(self.names, columns))
+
+    def __len__(self):
+        if not self.names:
+            return 0
+        return len(self._columns[self.names[0]])
+
+    def __getitem__(self, name):
+        """Returns the array.array (or list) of values of a column
+        """
+        return self._columns[name].values
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def column(self, name):
+        """Returns the ColumnBuffer of a column
+        """
+        return self._columns[name]
+
+    def mask(self, name):
+        """Returns the NULL mask of a column, a bytearray with a 1 for every
+        NULL, or None when the column has no NULLs
+        """
+        return self._columns[name].mask
+
+    def to_dict(self):
+        """Returns a dictionary of column name to a list of values with None
+        for NULLs
+        """
+        return dict((name, self._columns[name].tolist())
+                    for name in self.names)
+
+    def numpy(self):
+        """Returns a dictionary of column name to numpy array.  Columns with
+        NULLs are masked arrays.
+        """
+        return dict((name, self._columns[name].numpy())
+                    for name in self.names)
+
+
+class FetchColumns(object):
+    """Callable object that runs a query and reads its result straight into
+    per-column buffers, 'chunk_size' rows at a time.
+
+    Rows are read from the DBAPI cursor, so no sqlalchemy Row objects are
+    made and the values are what the driver returns, without sqlalchemy's
+    type conversion.  Only one chunk of row tuples exists at a time.
+
+    To use this class::
+
+        database = get_database('db.blue')
+        result = database.fetch_columns(select(prices.c.day, prices.c.close))
+        closes = result['close']          # array('d', [...])
+        closes = result.numpy()['close']  # with numpy installed
+    """
+
+    CHUNK_SIZE = 10000
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def __call__(self, statement, params=None, chunk_size=None,
+                 typecodes=None):
+        """
+        :param statement: A sqlalchemy select or text statement
+        :param params: The parameters of the statement
+        :param chunk_size: The number of rows fetched at a time
+        :param typecodes: A dictionary of column name to array.array type
+            code, for columns that should not have their type guessed from
+            the first values
+        :returns: A ColumnarResult
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        typecodes = typecodes or {}
+        with self._engine.connect() as connection:
+            result = connection.execute(statement, params)
+            try:
+                names = list(result.keys())
+                columns = [ColumnBuffer(name, typecodes.get(name))
+                           for name in names]
+                cursor = result.cursor
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for column, values in zip(columns, zip(*rows)):
+                        column.extend(values)
+            finally:
+                result.close()
+        return ColumnarResult(names, columns)
@@ -0,0 +1,234 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import Counter
+from collections import deque
+from sqlalchemy import event
+from sqlalchemy.engine.interfaces import CacheStats
+from dodai.model import fork
+
+
+def lru_hit_counts(trace, sizes):
+    """Returns a dictionary of cache size to the number of hits an LRU cache
+    of that size would have had on the given sequence of cache keys.
+
+    Every size is worked out in one pass over the trace by finding each
+    access' LRU stack distance (the number of distinct keys used since the
+    last use of the same key) with a Fenwick tree.
+    """
+    count = len(trace)
+    tree = [0] * (count + 1)
+
+    def add(index, value):
+        index += 1
+        while index <= count:
+            tree[index] += value
+            index += index & -index
+
+    def prefix(index):
+        out = 0
+        while index > 0:
+            out += tree[index]
+            index -= index & -index
+        return out
+
+    last = {}
+    distances = Counter()
+    for position, key in enumerate(trace):
+        if key in last:
+            previous = last[key]
+            distances[prefix(position) - prefix(previous + 1) + 1] += 1
+            add(previous, -1)
+        add(position, 1)
+        last[key] = position
+    out = {}
+    for size in sizes:
+        out[size] = sum(hits for distance, hits in distances.items()
+                        if distance <= size)
+    return out
+
+
+class SectionCacheStats(object):
+    """The compiled statement cache counters of one database section
+    """
+
+    def __init__(self, name, record):
+        self.name = name
+        self.caches = []
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self.evictions = 0
+        self.trace = deque(maxlen=record or 0)
+        self.keys = {}
+
+    def as_dict(self):
+        """Returns a snapshot of the counters as a dictionary
+        """
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'uncached': self.uncached,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'size': sum(len(cache) for cache in self.caches),
+            'capacity': sum(cache.capacity for cache in self.caches),
+            'recorded': len(self.trace),
+        }
+
+
+class CompiledCacheStats(object):
+    """Engine listener that counts compiled statement cache hits, misses and
+    evictions for each database section.
+
+    Hits and misses come from the cache_hit sqlalchemy sets on each
+    execution context.  Evictions are counted when the engine's compiled
+    cache prunes itself, which it does once it grows half again past its
+    size, back down to its size.  The cache size of a section is set with
+    its 'query_cache_size' key.
+
+    When 'record' is given, the last 'record' executions of each section
+    are kept so that report() can work out how well other cache sizes
+    would have done on that workload.
+    """
+
+    TARGET = 0.99
+
+    def __init__(self, record=None):
+        """
+        :param record: The number of executions per section kept for
+            report().  Nothing is recorded by default.
+        """
+        self._record = record
+        self._lock = threading.Lock()
+        self._sections = {}
+        fork.register(self)
+
+    def __call__(self, name, engine):
+        section = self._section(name)
+        cache = getattr(engine, '_compiled_cache', None)
+        if cache is not None:
+            with self._lock:
+                section.caches.append(cache)
+            self._count_evictions(name, cache)
+        event.listen(engine, 'after_cursor_execute', self._after(name))
+
+    def _section(self, name):
+        if name not in self._sections:
+            with self._lock:
+                if name not in self._sections:
+                    self._sections[name] = SectionCacheStats(name,
+                                                             self._record)
+        return self._sections[name]
+
+    def _count_evictions(self, name, cache):
+        size_alert = cache.size_alert
+
+        def count_evictions(cache):
+            section = self._section(name)
+            with self._lock:
+                section.evictions += max(len(cache) - cache.capacity, 0)
+            if size_alert:
+                size_alert(cache)
+        cache.size_alert = count_evictions
+
+    def _after(self, name):
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            cache_hit = getattr(context, 'cache_hit', None)
+            section = self._section(name)
+            with self._lock:
+                if cache_hit == CacheStats.CACHE_HIT:
+                    section.hits += 1
+                elif cache_hit == CacheStats.CACHE_MISS:
+                    section.misses += 1
+                else:
+                    section.uncached += 1
+                    return
+                if section.trace.maxlen:
+                    compiled = getattr(context, 'compiled', None)
+                    key = compiled.string if compiled is not None \
+                          else statement
+                    section.trace.append(
+                            section.keys.setdefault(key, len(section.keys)))
+        return after_cursor_execute
+
+    def sections(self):
+        """Returns the names of the sections that have counters
+        """
+        return list(self._sections)
+
+    def stats(self, name=None):
+        """Returns a snapshot dictionary of the counters of the given section
+        or, without a name, a dictionary of every section's snapshot
+        """
+        with self._lock:
+            if name is not None:
+                if name not in self._sections:
+                    raise KeyError("No cache stats for '{0}'".format(name))
+                return self._sections[name].as_dict()
+            return dict((key, section.as_dict())
+                        for key, section in self._sections.items())
+
+    def report(self, name, sizes=None, target=None):
+        """Works out the hit ratio of the recorded workload of a section for
+        a number of cache sizes and recommends the smallest size that gets
+        'target' (99% by default) of the hits an unbounded cache would get.
+
+        The cache is treated as a plain LRU cache, which is close to, but not
+        exactly, what sqlalchemy does.  Returns a dictionary with the
+        number of executions and distinct statements, the hit ratio of each
+        size and the recommended size.
+        """
+        target = target or self.TARGET
+        with self._lock:
+            section = self._sections[name]
+            trace = list(section.trace)
+            capacity = sum(cache.capacity for cache in section.caches)
+        distinct = len(set(trace))
+        if sizes is None:
+            sizes = set([capacity]) if capacity else set()
+            size = 16
+            while size < distinct:
+                sizes.add(size)
+                size *= 2
+        sizes = sorted(set(sizes) | set([max(distinct, 1)]))
+        hits = lru_hit_counts(trace, sizes)
+        best = len(trace) - distinct
+        recommended = None
+        for size in sizes:
+            if hits[size] >= best * target:
+                recommended = size
+                break
+        return {
+            'name': name,
+            'executions': len(trace),
+            'distinct': distinct,
+            'capacity': capacity,
+            'hit_ratios': dict((size, hits[size] / len(trace) if trace
+                                else None) for size in sizes),
+            'recommended': recommended,
+        }
+
+    def after_fork(self):
+        """Makes a new lock in the child process.  Called automatically after
+        os.fork().
+        """
+        self._lock = threading.Lock()
@@ -15,43 +15,117 @@
 # You should have received a copy of the GNU General Public License
 # along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import hmac
+import os
+from collections import namedtuple
 from dodai.validate.base import SectionExists
+from dodai.validate.dialect import IsValidDialect
+from dodai.validate.role import IsValidRole
 
 
+from dodai.model import fork
+from dodai.model import handle
+from dodai.model.catalog import SectionCatalog
 from dodai.model.parse import ValidateFieldExistsAndIsPopulated
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from dodai.model.parse import parse_pool_classes
+from dodai.model.routing import RoutingConnection
+from dodai.model.failover import FailoverConnection
+from dodai.model.shard import ShardRouter
+
+
+# sqlalchemy, and the dodai.model modules that use it, are imported the
+# first time an engine or session is made or a helper is used, so that tools
+# that only read and validate the config do not pay for importing it.
+
+def create_engine(url, **kwargs):
+    from sqlalchemy import create_engine
+    return create_engine(url, **kwargs)
+
+
+def sessionmaker(**kwargs):
+    from sqlalchemy.orm import sessionmaker
+    return sessionmaker(**kwargs)
+
 
 class DodaiSqlalchemyConnection(object):
     """A dodai connection object that should be used in applications for
     interacting with a database with sqlalchemy
+
+    The 'listeners' keyword argument is a list of callables that are called
+    with the name and the engine each time an engine is made.  These are used
+    to hook instrumentation like dodai.model.timing.QueryTimings into the
+    engine.  The 'connect_timeout' and 'statement_timeout' keyword arguments,
+    in seconds, are applied to the engine's connections by
+    dodai.model.timeouts, the 'pragmas' of a sqlite section by
+    dodai.model.pragmas.SqliteProfile, and a
+    dodai.model.breaker.CircuitBreaker given as 'breaker' guards its
+    connects.  Any other keyword arguments are passed
+    to create_engine.
     """
 
     DEFAULT_KEY = "__default__"
 
     def __init__(self, name, url, **kwargs):
         self.name = name
-        schema = kwargs.get('schema')
+        schema = kwargs.pop('schema', None)
         if schema:
             self.schema = schema
         self.__url = url
-        self.__create_engine = kwargs.get('create_engine') or create_engine
-        self.__sessionmaker = kwargs.get('sessionmaker') or sessionmaker
+        self.__create_engine = kwargs.pop('create_engine', None) or \
+                               create_engine
+        self.__sessionmaker = kwargs.pop('sessionmaker', None) or sessionmaker
+        self.__listeners = kwargs.pop('listeners', None) or ()
+        pool_classes = kwargs.pop('pool_classes', None) or ()
+        self.__connect_timeout = kwargs.pop('connect_timeout', None)
+        self.__statement_timeout = kwargs.pop('statement_timeout', None)
+        self.__breaker = kwargs.pop('breaker', None)
+        self.__pragmas = kwargs.pop('pragmas', None) or ()
         self.__kwargs = kwargs
+        self.__gate = None
+        if pool_classes:
+            # Made here rather than on first use so that two threads can not
+            # each make a gate and hand out twice the slots
+            from dodai.model.priority import PriorityGate
+            self.__gate = PriorityGate(name, pool_classes,
+                                       kwargs.get('pool_size'))
         self.__engine = None
         self.__connection_cache = {}
         self.__active_connection_key = None
         self.__session_cache = {}
         self.__active_session_key = None
+        self.__result_cache = None
+        self.__single_writer = None
+        fork.register(self)
 
     @property
     def engine(self):
         """The sqlalchemy engine made from sqlalchemy.create_engine
         """
         if not self.__engine:
-            self.__engine = self.__create_engine(url, **self.__kwargs)
+            self.__engine = self.__create_engine(self.__url, **self.__kwargs)
+            if self.__connect_timeout or self.__statement_timeout:
+                from dodai.model.timeouts import install_timeouts
+                install_timeouts(self.__engine, self.__connect_timeout,
+                                 self.__statement_timeout)
+            if self.__pragmas:
+                from dodai.model.pragmas import SqliteProfile
+                SqliteProfile(self.__pragmas).install(self.__engine)
+            for listener in self.__listeners:
+                listener(self.name, self.__engine)
+            if self.__breaker is not None:
+                self.__breaker.install(self.__engine)
+            if self.__gate is not None:
+                self.__gate.install(self.__engine)
         return self.__engine
 
+    @property
+    def breaker(self):
+        """The dodai.model.breaker.CircuitBreaker of this section, or None
+        when the section has none
+        """
+        return self.__breaker
+
     @property
     def connection_cache(self):
         """Dictionary of names with engine.connect()
@@ -86,9 +160,9 @@ class DodaiSqlalchemyConnection(object):
         if name:
             if name not in self.connection_cache:
                 self.connection_cache[name] = self.engine.connect()
-            self.active_connection_key = name
+            self.__active_connection_key = name
         else:
-            self.active_connection_key = self.DEFAULT_KEY
+            self.__active_connection_key = self.DEFAULT_KEY
 
     @property
     def session_cache(self):
@@ -126,9 +200,144 @@ class DodaiSqlalchemyConnection(object):
             if name not in self.session_cache:
                 session = self.__sessionmaker(bind=self.engine)
                 self.session_cache[name] = session()
-            self.active_session_key = name
+            self.__active_session_key = name
         else:
-            self.active_session_key = self.DEFAULT_KEY
+            self.__active_session_key = self.DEFAULT_KEY
+
+    def bulk_load(self, table, rows, **kwargs):
+        """Streams rows into a table in a single transaction on a new
+        connection from the engine.  See dodai.model.bulk.BulkLoad for the
+        arguments.  Returns a BulkLoadResult with the rows per second.
+        """
+        from dodai.model.bulk import BulkLoad
+        return BulkLoad(self.engine)(table, rows, **kwargs)
+
+    def stream(self, statement, params=None, **kwargs):
+        """Yields the rows of a query, or batches of them, without holding
+        more than a fetch size of rows in memory.  Runs on a new connection
+        from the engine.  See dodai.model.stream.StreamQuery for the
+        arguments.
+        """
+        from dodai.model.stream import StreamQuery
+        return StreamQuery(self.engine)(statement, params, **kwargs)
+
+    def fetch_columns(self, statement, params=None, **kwargs):
+        """Runs a query and returns its result column by column in typed
+        buffers.  Runs on a new connection from the engine.  See
+        dodai.model.columnar.FetchColumns for the arguments.
+        """
+        from dodai.model.columnar import FetchColumns
+        return FetchColumns(self.engine)(statement, params, **kwargs)
+
+    @property
+    def pool_classes(self):
+        """The dodai.model.priority.PriorityGate that shares this section's
+        connections between its pool classes, or None when the section has
+        no 'pool_classes'
+        """
+        return self.__gate
+
+    def pool_class(self, name):
+        """Returns the dodai.model.priority.PoolClass of the given name,
+        whose connections wait by priority for one of the slots of its
+        class
+        """
+        from dodai.model.priority import PoolClass
+        if self.pool_classes is None:
+            raise KeyError("The section '{0}' has no pool classes".format(
+                    self.name))
+        if name not in self.pool_classes.classes:
+            raise KeyError("The section '{0}' has no pool class '{1}'".format(
+                    self.name, name))
+        return PoolClass(name, self.pool_classes, self.engine,
+                         self.__sessionmaker)
+
+    def dispose(self):
+        """Closes the pooled connections of the engine, if one was made.
+        Connections that are checked out are closed when they are returned.
+        """
+        if self.__engine:
+            self.__engine.dispose()
+
+    def write_behind(self, table, **kwargs):
+        """Returns a WriteBehindBuffer that inserts rows into the table in
+        batches from a background thread.  See
+        dodai.model.writebehind.WriteBehindBuffer for the arguments.
+        """
+        from dodai.model.writebehind import WriteBehindBuffer
+        return WriteBehindBuffer(self.engine, table, **kwargs)
+
+    def result_cache(self, **kwargs):
+        """Returns the ResultCache of this connection, making it with the
+        given arguments on the first call.  Writes through this connection's
+        engine invalidate it.  See dodai.model.resultcache.ResultCache for
+        the arguments.
+        """
+        if self.__result_cache is None:
+            from dodai.model.resultcache import ResultCache
+            self.__result_cache = ResultCache(self.engine, self.name,
+                                              **kwargs)
+        return self.__result_cache
+
+    def single_writer(self, **kwargs):
+        """Returns the SingleWriter of this sqlite section, making it with
+        the given arguments on the first call.  It reads on a pool of
+        read-only connections and sends every write through one writer
+        connection that commits them in groups.  See
+        dodai.model.singlewriter.SingleWriter for the arguments.
+        """
+        if self.__single_writer is None:
+            from dodai.model.singlewriter import SingleWriter
+            self.__single_writer = SingleWriter(
+                    self.engine, pragmas=self.__pragmas, **kwargs)
+        return self.__single_writer
+
+    def reflect(self, schema=None, only=None, metadata=None, directory=None):
+        """Returns a MetaData of the reflected tables, loaded from a file
+        when the schema has not changed since the last reflection.  The
+        schema defaults to this section's schema.  See
+        dodai.model.reflection.ReflectionCache for the arguments.
+        """
+        from dodai.model.reflection import ReflectionCache
+        schema = schema or getattr(self, 'schema', None)
+        return ReflectionCache(self.engine, directory)(schema, only,
+                                                       metadata)
+
+    def after_fork(self):
+        """Drops the pool, connections and sessions inherited from the
+        parent process without closing them, since they still belong to the
+        parent.  The engine is kept with a new empty pool and new connections
+        and sessions are made the next time they are used.  The active
+        connection and session keys go back to the default.  This is called
+        in the child process automatically after os.fork().
+        """
+        if self.__engine:
+            fork.inherit(self.__engine.pool)
+            self.__engine.dispose(close=False)
+        fork.inherit(self.__connection_cache, self.__session_cache)
+        self.__connection_cache = {}
+        self.__active_connection_key = None
+        self.__session_cache = {}
+        self.__active_session_key = None
+
+
+class FindDatabaseSectionTrigger(object):
+    """Callable object that returns the name of the key within a config
+    section that holds the database dialect.  Returns None when the section
+    does not have one.
+    """
+
+    TRIGGERS = ('dialect', 'db_dialect', 'protocol', 'db_protocol')
+
+    def __init__(self, sections):
+        self._sections = sections
+
+    def __call__(self, section_name):
+        if section_name in self._sections:
+            for key in self.TRIGGERS:
+                if key in self._sections[section_name]:
+                    return key
+        return None
 
 
 class IsDatabaseSection(object):
@@ -199,32 +408,33 @@ class IsDatabaseSection(object):
         :param raise_errors: If set to True then all errors will be raised
         """
         self._sections = sections
-        self._section_exist = section_exist
+        self._section_exist = section_exists
         self._is_valid_dialect = is_valid_dialect
         self._prefix = prefix or self.PREFIX
-
+        self._log = log
 
     @classmethod
     def load(cls, sections, prefix=None, log=None, raise_errors=True):
         section_exists = SectionExists(sections, log=log,
                                        raise_errors=raise_errors)
-        is_valid_dialect = IsValidDialect(sections, log=log,
-                                          raise_errors=raise_errors)
+        is_valid_dialect = IsValidDialect.load(sections, log=log,
+                                               raise_errors=raise_errors)
         return cls(sections, section_exists, is_valid_dialect, prefix,
                    log, raise_errors)
 
-    def __call__(self, section_name):
+    def __call__(self, section_name, dialect_key=None):
+        dialect_key = dialect_key or self.DIALECT_KEY
         if self._section_exist(section_name):
             if section_name.startswith(self._prefix):
-                if self._should_ignore(section_name):
-                    if self._is_valid_dialect(section_name, self.DIALECT_KEY):
+                if not self._should_ignore(section_name):
+                    if self._is_valid_dialect(section_name, dialect_key):
                         return True
         return False
 
     def _should_ignore(self, section_name):
         if self.IGNORE_KEY in self._sections[section_name]:
             data = self._sections[section_name].get(self.IGNORE_KEY)
-            if not data or data not in self.IGNORE_NEGATIVE_VALUES:
+            if not data or data.lower() not in self.IGNORE_NEGATIVE_VALUES:
                 if self._log:
                     msg = self.IGNORE_MESSAGE.format(
                             section_name = section_name
@@ -272,7 +482,7 @@ class _BaseDatabaseConnectionValidator(object):
     @classmethod
     def load(cls, sections):
         find_database_section_trigger = FindDatabaseSectionTrigger(sections)
-        is_database_section = IsDatabaseSection(sections)
+        is_database_section = IsDatabaseSection.load(sections)
         validate_field_exists = ValidateFieldExistsAndIsPopulated(sections)
         return cls(sections, find_database_section_trigger,
                 is_database_section, validate_field_exists)
@@ -400,7 +610,7 @@ class DatabaseSectionConnectionValidator(object):
     def load(cls, sections, find_section_database_trigger=None):
         find_section_database_trigger = find_section_database_trigger or \
                                         FindDatabaseSectionTrigger(sections)
-        is_database_section = IsDatabaseSection(sections)
+        is_database_section = IsDatabaseSection.load(sections)
         validators = (
             FileDatabaseValidator.load(sections),
             NetworkDatabaseValidator.load(sections),
@@ -411,7 +621,7 @@ class DatabaseSectionConnectionValidator(object):
 
     def __call__(self, section_name, raise_errors=True):
         trigger_name = self._find_section_database_trigger(section_name)
-        if self._is_database_section(section_name, trigger_name, raise_errors):
+        if self._is_database_section(section_name, trigger_name):
             for obj in self._validators:
                 if obj(section_name, raise_errors):
                     return True
@@ -420,17 +630,38 @@ class DatabaseSectionConnectionValidator(object):
 class GetAllDatabaseSections(object):
     """Callable object that returns a dictionary of valid database section
     data.
+
+    The returned dictionary has four keys:
+
+        * **names**: section name to section data
+        * **groups**: group name to environment to the section that should
+          be used for that group.  A section with the role of 'primary' will
+          always take this spot over a 'replica'
+        * **roles**: group name to environment to role to a list of section
+          names in the order they were found
+        * **catalog**: a dodai.model.catalog.SectionCatalog of the sections
+
+    The dictionary is built once.  Only the sections whose name starts with
+    the database prefix are validated.
     """
 
     GROUP_NAME = "group"
     ENVIRONMENT_NAME = "environment"
+    ROLE_NAME = "role"
+    ROLE_DEFAULT = "primary"
 
-    def __init__(self, sections, validate):
+    def __init__(self, sections, validate, is_valid_role, prefix=None):
         self._sections = sections
         self._validate = validate
+        self._is_valid_role = is_valid_role
+        self._prefix = prefix or IsDatabaseSection.PREFIX
+        self._built = False
+        self._role_names = set()
         self._cache = {
             'groups': {},
-            'names': {}
+            'names': {},
+            'roles': {},
+            'catalog': SectionCatalog()
         }
 
     @classmethod
@@ -439,19 +670,28 @@ class GetAllDatabaseSections(object):
                                         FindDatabaseSectionTrigger(sections)
         validate = DatabaseSectionConnectionValidator.load(sections,
                                         find_section_database_trigger)
-        return cls(sections, validate)
+        is_valid_role = IsValidRole.load(sections)
+        return cls(sections, validate, is_valid_role)
 
     def __call__(self, raise_errors=True):
-        if not self._cache['names']:
+        if not self._built:
             self._build_cache(raise_errors)
+            self._built = True
         return self._cache
 
     def _build_cache(self, raise_errors):
-        """Loops through the section data and populates the cache
+        """Indexes the section names and populates the cache with the
+        sections that have the database prefix and are valid
         """
-        for section_name in self._sections.keys():
+        catalog = SectionCatalog(self._sections.keys())
+        for section_name in catalog.prefix(self._prefix):
             if self._validate(section_name, raise_errors):
                 self._set_cache(section_name)
+                catalog.add_database(
+                        section_name, self._get_group_name(section_name),
+                        self._get_environment_name(section_name),
+                        self._get_role(section_name))
+        self._cache['catalog'] = catalog
 
     def _set_cache(self, section_name):
         """Takes the given section_name and builds figures out where in
@@ -461,15 +701,40 @@ class GetAllDatabaseSections(object):
         if group_name:
             environment_name = self._get_environment_name(section_name)
             if environment_name:
-                if group_name not in self._cache['groups']:
-                    self._cache['groups'][group_name] = {}
-                if environment_name not in self._cache['groups'][group_name]:
-                    self._cache['groups'][group_name][environment_name] = \
-                                                                section_name
+                role = self._get_role(section_name)
+                self._set_group_cache(group_name, environment_name,
+                                      section_name, role)
+                self._set_role_cache(group_name, environment_name,
+                                     section_name, role)
 
         if section_name not in self._cache['names']:
             self._cache['names'][section_name] = self._sections[section_name]
 
+    def _set_group_cache(self, group_name, environment_name, section_name,
+                         role):
+        groups = self._cache['groups'].setdefault(group_name, {})
+        if environment_name not in groups:
+            groups[environment_name] = section_name
+        elif role == self.ROLE_DEFAULT:
+            current = groups[environment_name]
+            if self._get_role(current) != self.ROLE_DEFAULT:
+                groups[environment_name] = section_name
+
+    def _set_role_cache(self, group_name, environment_name, section_name,
+                        role):
+        environments = self._cache['roles'].setdefault(group_name, {})
+        roles = environments.setdefault(environment_name, {})
+        key = (group_name, environment_name, role, section_name)
+        if key not in self._role_names:
+            self._role_names.add(key)
+            roles.setdefault(role, []).append(section_name)
+
+    def _get_role(self, section_name):
+        if self._sections[section_name].get(self.ROLE_NAME):
+            if self._is_valid_role(section_name, self.ROLE_NAME):
+                return self._sections[section_name][self.ROLE_NAME].lower()
+        return self.ROLE_DEFAULT
+
     def _get_group_name(self, section_name):
         if self.GROUP_NAME in self._sections[section_name]:
             if self._sections[section_name][self.GROUP_NAME]:
@@ -485,86 +750,102 @@ class GetAllDatabaseSections(object):
 
 
 class SqlalchemyUrlBuilder(object):
+    """Callable object that returns the sqlalchemy.engine.URL of a database
+    section.  Values are escaped by sqlalchemy when the URL is rendered, so
+    passwords and filenames may hold any character.
+    """
+
+    BAD_PORT = "In the config section '{section_name}' the port of "\
+               "'{val}' is not a number"
 
     def __init__(self, sections, find_section_database_trigger):
         self._find_section_database_trigger = find_section_database_trigger
         self._sections = sections
 
     def __call__(self, section_name):
-        out = []
-        self._dialect(section_name, out)
-        self._driver(section_name, out)
-        self._filename(section_name, out)
-        self._username(section_name, out)
-        self._password(section_name, out)
-        self._hostname(section_name, out)
-        self._database(section_name, out)
-
-        out = ''.join(out)
-        return out
+        from sqlalchemy.engine import URL
+        return URL.create(*self.parts(section_name))
 
-    def _dialect(self, section_name, out):
-        dialect = self._find_section_database_trigger(section_name)
-        out.append(dialect)
-
-    def _driver(self, section_name, out):
+    def parts(self, section_name):
+        """Returns the drivername, username, password, host, port and
+        database of the section's URL as a tuple, which is checked the same
+        way but does not need sqlalchemy
+        """
+        section = self._sections[section_name]
+        return (self._drivername(section_name),
+                section.get('username') or None,
+                section.get('password') or None,
+                section.get('hostname') or None,
+                self._port(section_name),
+                section.get('filename') or section.get('database') or None)
+
+    def _drivername(self, section_name):
+        trigger = self._find_section_database_trigger(section_name)
+        out = self._sections[section_name].get(trigger)
         driver = self._sections[section_name].get('driver')
         if driver:
-            out.append('+')
-            out.append(driver)
-
-        out.append('://')
-
-    def _filename(self, section_name, out):
-        filename = self._sections[section_name].get('filename')
-        if filename:
-            out.append('/')
-            out.append(filename)
-
-    def _username(self, section_name, out):
-        username = self._sections[section_name].get('username')
-        if username:
-            out.append(username)
-
-    def _password(self, section_name, out):
-        password = self._sections[section_name].get('password')
-        if password:
-            out.append(':')
-            out.append(password)
-
-    def _hostname(self, section_name, out):
-        hostname = self._sections[section_name].get('hostname')
-        if hostname:
-            out.append('@')
-            out.append(hostname)
-
-    def _port(self, section_name, out):
+            out = '{0}+{1}'.format(out, driver)
+        return out
+
+    def _port(self, section_name):
         port = self._sections[section_name].get('port')
-        if port:
-            out.append(':')
-            out.append(port)
+        if port is None or not str(port).strip():
+            return None
+        try:
+            return int(port)
+        except ValueError:
+            raise ValueError(self.BAD_PORT.format(section_name=section_name,
+                                                  val=port))
+
+
+class ConnectionSpec(namedtuple('ConnectionSpec', (
+        'name', 'url_parts', 'engine_options', 'schema', 'group',
+        'environment', 'role', 'pool_classes', 'connect_timeout',
+        'statement_timeout', 'breaker', 'pragmas', 'fingerprint'))):
+    """Everything needed to connect to one database section, worked out
+    once when the config is loaded.  url_parts are the arguments of
+    sqlalchemy.engine.URL.create(), which the url property makes only when
+    it is asked for so that loading a config does not import sqlalchemy,
+    engine_options a sorted tuple of create_engine (key, value) pairs,
+    pool_classes a tuple of (name, size) pairs, the timeouts are in seconds
+    or None, breaker is None or the (failures, reset) of the section's
+    circuit breaker, either of which may be None for the default, pragmas
+    the (name, value) pairs of a sqlite section's SqliteProfile and
+    fingerprint a hash of the section's config, without its secrets like
+    the password, that changes whenever the rest of the section does.  The
+    fingerprint travels in ConnectionHandles, so it must not let anyone
+    test guesses of a password.
+    """
 
-    def _database(self, section_name, out):
-        database = self._sections[section_name].get('database')
-        if database:
-            out.append('/')
-            out.append(database)
+    __slots__ = ()
+
+    @property
+    def url(self):
+        """The sqlalchemy.engine.URL of the section
+        """
+        from sqlalchemy.engine import URL
+        return URL.create(*self.url_parts)
+
+    def engine_kwargs(self):
+        return dict(self.engine_options)
 
 
 class DodaiDatabaseObject(object):
 
     def __init__(self, url, **kwargs):
         self.__url = url
+        self.__listeners = kwargs.pop('listeners', None) or ()
         self.__ignore__ = None
         self.__engine = None
         self.__session_cache = {}
         self._active_session_ = None
         self.__setup_kwargs(kwargs)
+        fork.register(self)
 
     @property
     def __ignore(self):
         if not self.__ignore__:
-            out = self(self.__dict__.keys())
+            out = list(self.__dict__.keys())
             out = out + ['username', 'user', 'password']
             self.__ignore__ = tuple(out)
         return self.__ignore__
@@ -578,8 +859,24 @@ class DodaiDatabaseObject(object):
     def engine(self):
         if not self.__engine:
             self.__engine = create_engine(self.__url)
+            name = getattr(self, 'name', None) or \
+                   self.__engine.url.render_as_string(hide_password=True)
+            for listener in self.__listeners:
+                listener(name, self.__engine)
         return self.__engine
 
+    def after_fork(self):
+        """Drops the pool and sessions inherited from the parent process
+        without closing them.  This is called in the child process
+        automatically after os.fork().
+        """
+        if self.__engine:
+            fork.inherit(self.__engine.pool)
+            self.__engine.dispose(close=False)
+        fork.inherit(self.__session_cache)
+        self.__session_cache = {}
+        self._active_session_ = None
+
     def make_session(self):
         """Makes a new session with this object's engine
         """
@@ -615,31 +912,147 @@ class DodaiDatabaseObject(object):
 
 
 class GetDatabase(object):
+    """Callable object that returns a DodaiSqlalchemyConnection for either
+    a database section name or a group name.  When a group name is given
+    the section for the current environment is used.
+
+    A ConnectionSpec is made for every valid database section when the
+    object is made, so finding a connection is a couple of dictionary
+    lookups.  reload() only makes new specs, and new engines, for the
+    sections whose config changed.
+    """
 
     ENVIRONMENT_SEARCH_SECTIONS = ('server', 'basic', 'default', 'system',
                                    'main')
     ENVIRONMENT_FIELD_NAMES = ('environment', 'env',)
     ENVIRONMENT_DEFAULT = 'dev'
+    NOT_FOUND = "Unable to find a database section or group named "\
+                "'{name}' for the environment '{environment}'"
+    NO_PRIMARY = "The database group '{name}' does not have a primary "\
+                 "section for the environment '{environment}'"
+    BAD_OPTION = "In the config section '{section_name}' the '{key}' of "\
+                 "'{val}' is not valid"
+
+    SHARD_WEIGHT = 'shard_weight'
+    POOL_CLASSES = 'pool_classes'
+    CONNECT_TIMEOUT = 'connect_timeout'
+    STATEMENT_TIMEOUT = 'statement_timeout'
+    BREAKER_FAILURES = 'breaker_failures'
+    BREAKER_RESET = 'breaker_reset'
+    # Keys holding any of these are left out of the fingerprint
+    SECRET_KEYS = ('password', 'passwd', 'secret', 'token')
+    # Changes to the secrets are found with an HMAC under a key that never
+    # leaves the process
+    _SECRETS_KEY = os.urandom(32)
+
+    # Section keys that are passed to create_engine, and their types
+    ENGINE_OPTIONS = (
+        ('query_cache_size', int),
+        ('pool_size', int),
+        ('max_overflow', int),
+        ('pool_timeout', float),
+        ('pool_recycle', int),
+    )
 
     def __init__(self, sections, validate, database_sections,
-                 as_sqlalchemy_url):
+                 as_sqlalchemy_url, listeners=None):
         self._sections = sections
         self._validate = validate
         self._database_sections = database_sections
         self._as_sqlalchemy_url = as_sqlalchemy_url
+        self._listeners = listeners or ()
         self._environment_ = None
-        self._url_cache = {}
+        self._spec_cache = {}
+        self._spec_errors = {}
+        self._fingerprints = {}
+        self._group_cache = {}
+        self._connection_cache = {}
+        self._build_specs()
 
     @classmethod
-    def load(cls, sections):
+    def load(cls, sections, listeners=None):
+        """
+        :param sections: A dictionary that contains config data usually the
+            result of parsing config files
+        :param listeners: A list of callables that are called with the
+            section name and the engine each time an engine is made for one
+            of the sections.  See DodaiSqlalchemyConnection.
+        """
+        return cls(sections, *cls._load_parts(sections), listeners=listeners)
+
+    @staticmethod
+    def _load_parts(sections):
         find_section_database_trigger = FindDatabaseSectionTrigger(sections)
         validate = DatabaseSectionConnectionValidator.load(
-                                find_section_database_trigger, sections)
-        get_all_database_sections = GetAllDatabaseSections(sections, validate)
+                                sections, find_section_database_trigger)
+        get_all_database_sections = GetAllDatabaseSections.load(
+                                sections, find_section_database_trigger)
         database_sections = get_all_database_sections()
         as_sqlalchemy_url = SqlalchemyUrlBuilder(sections,
                                                  find_section_database_trigger)
-        return cls(sections, validate, database_sections)
+        return validate, database_sections, as_sqlalchemy_url
+
+    def reload(self, sections):
+        """Switches to new config data.  Sections whose config is unchanged
+        keep their spec and connection.  The engines of sections that
+        changed or are gone are disposed and new ones are made on their
+        next use.  Returns the sorted names of the sections that changed,
+        were added or were removed.
+        """
+        self._sections = sections
+        (self._validate, self._database_sections,
+         self._as_sqlalchemy_url) = self._load_parts(sections)
+        self._environment_ = None
+        changed = self._build_specs()
+        for section_name in changed:
+            self._discard(section_name)
+        return changed
+
+    def handle(self, name, environment=None):
+        """Returns a picklable dodai.model.handle.ConnectionHandle of a
+        section or group name, for passing the connection to other
+        processes
+        """
+        spec = self.spec(name, environment)
+        handle.register(self)
+        return handle.ConnectionHandle(spec.name, spec.fingerprint)
+
+    def scan(self, name, statement, key, environment=None, **kwargs):
+        """Returns a dodai.model.scan.ParallelScan that reads a table or
+        select of a section or group split into ranges of the key.  See
+        ParallelScan for the arguments.
+        """
+        from dodai.model.scan import ParallelScan
+        return ParallelScan(self.handle(name, environment), statement, key,
+                            **kwargs)
+
+    def discard(self, name, environment=None, connection=None):
+        """Forgets the connection of a section or group name and disposes
+        its engine, so the next call makes a new one.  When a connection is
+        given it is only forgotten if it is still the current one.  Returns
+        False when nothing was forgotten.
+        """
+        section_name = self._find_name(name, environment)
+        return bool(section_name) and self._discard(section_name, connection)
+
+    def _discard(self, section_name, connection=None):
+        current = self._connection_cache.get(section_name)
+        if current is None or connection not in (None, current):
+            return False
+        del self._connection_cache[section_name]
+        current.dispose()
+        return True
+
+    def spec(self, name, environment=None):
+        """Returns the ConnectionSpec of a section or group name
+        """
+        section_name = self._find_name(name, environment)
+        if not section_name:
+            raise KeyError(self.NOT_FOUND.format(
+                    name=name, environment=environment or self.environment))
+        if section_name in self._spec_errors:
+            raise self._spec_errors[section_name]
+        return self._spec_cache[section_name]
 
     @property
     def environment(self):
@@ -659,15 +1072,295 @@ class GetDatabase(object):
         return self._environment_
 
     def __call__(self, name, environment=None):
-        name = self._find_name(name, environment)
+        section_name = self._find_name(name, environment)
+        if not section_name:
+            raise KeyError(self.NOT_FOUND.format(
+                    name=name, environment=environment or self.environment))
+        return self._connection(section_name)
+
+    def routing(self, name, environment=None, picker=None):
+        """Returns a RoutingConnection for the given group name that sends
+        writes to the group's primary section and reads to the group's
+        replica sections.  If name is a section name instead of a group the
+        section is used for both reads and writes.  The picker is a class
+        from dodai.model.routing that decides which replica serves a read.
+        """
+        environment = environment or self.environment
+        roles = self._find_roles(name, environment)
+        if roles is None:
+            return RoutingConnection(self(name, environment), [], picker)
+        if not roles.get('primary'):
+            raise ValueError(self.NO_PRIMARY.format(name=name,
+                                                    environment=environment))
+        primary = self._connection(roles['primary'][0])
+        replicas = [self._connection(section_name)
+                    for section_name in roles.get('replica', [])]
+        return RoutingConnection(primary, replicas, picker)
+
+    def failover(self, name, environment=None, start=True, **kwargs):
+        """Returns a FailoverConnection over an ordered list of candidate
+        sections.  The name can be a list of section names or a group name,
+        in which case the primary sections of the group for the environment
+        are the candidates in the order they appear in the config.  Extra
+        keyword arguments are passed to FailoverConnection.  When start is
+        True the background health probes are started.
+        """
+        environment = environment or self.environment
+        if isinstance(name, str):
+            roles = self._find_roles(name, environment)
+            if roles and roles.get('primary'):
+                names = roles['primary']
+            else:
+                names = [name]
+        else:
+            names = name
+        candidates = [self(section_name, environment)
+                      for section_name in names]
+        out = FailoverConnection(candidates, **kwargs)
+        if start:
+            out.start()
+        return out
 
-    def _find_name(self, name, environment):
+    def fan_out(self, name, environment=None, sections=None, role=None,
+                workers=None):
+        """Returns a FanOutQuery that runs statements on every section of
+        the given group at once.  The name can also be a list of section
+        names.  The sections of a group are those with the given role,
+        'primary' by default, for the environment in the order they appear
+        in the config, optionally narrowed down to the given section names.
+        """
+        environment = environment or self.environment
+        if isinstance(name, str):
+            names = self.group_sections(name, environment, role)
+            if sections is not None:
+                names = [x for x in names if x in sections]
+        else:
+            names = name
+        connections = dict((section_name, self(section_name, environment))
+                           for section_name in names)
+        from dodai.model.fanout import FanOutQuery
+        return FanOutQuery(connections, workers)
+
+    def shard_router(self, name, environment=None, role=None, vnodes=None,
+                     router=None):
+        """Returns a ShardRouter over the sections of the given group, with
+        the same choice of sections as group_sections().  Each section's
+        weight is its 'shard_weight' key.  When an existing router is given
+        it is updated with the sections and weights of this config instead
+        of making a new one.
+        """
+        environment = environment or self.environment
+        names = self.group_sections(name, environment, role)
+        connections = {}
+        weights = {}
+        for section_name in names:
+            connections[section_name] = self(section_name, environment)
+            weights[section_name] = self._shard_weight(section_name)
+        if router is None:
+            return ShardRouter(connections, weights, vnodes)
+        router.update(connections, weights)
+        return router
+
+    def group_sections(self, name, environment=None, role=None):
+        """Returns the names of the sections of a group with the given role,
+        'primary' by default, for the environment in the order they appear
+        in the config
+        """
         environment = environment or self.environment
+        if not self.catalog.group(name, environment):
+            raise KeyError(self.NOT_FOUND.format(name=name,
+                                                 environment=environment))
+        role = role or GetAllDatabaseSections.ROLE_DEFAULT
+        return list(self.catalog.group(name, environment, role))
+
+    @property
+    def catalog(self):
+        """The dodai.model.catalog.SectionCatalog of the loaded config
+        """
+        return self._database_sections['catalog']
+
+    def _shard_weight(self, section_name):
+        val = self._sections[section_name].get(self.SHARD_WEIGHT, 1)
+        try:
+            weight = float(val)
+        except (TypeError, ValueError):
+            weight = -1
+        if weight < 0:
+            raise ValueError(self.BAD_OPTION.format(
+                    section_name=section_name, key=self.SHARD_WEIGHT, val=val))
+        return weight
+
+    def _connection(self, section_name):
+        if section_name not in self._connection_cache:
+            if section_name in self._spec_errors:
+                raise self._spec_errors[section_name]
+            spec = self._spec_cache[section_name]
+            kwargs = spec.engine_kwargs()
+            kwargs['listeners'] = self._listeners
+            if spec.schema:
+                kwargs['schema'] = spec.schema
+            if spec.pool_classes:
+                kwargs['pool_classes'] = spec.pool_classes
+            kwargs['connect_timeout'] = spec.connect_timeout
+            kwargs['statement_timeout'] = spec.statement_timeout
+            if spec.pragmas:
+                kwargs['pragmas'] = spec.pragmas
+            if spec.breaker:
+                from dodai.model.breaker import CircuitBreaker
+                kwargs['breaker'] = CircuitBreaker(section_name, *spec.breaker)
+            self._connection_cache[section_name] = DodaiSqlalchemyConnection(
+                    section_name, spec.url, **kwargs)
+        return self._connection_cache[section_name]
+
+    def _build_specs(self):
+        """Makes the ConnectionSpec of every valid database section, reusing
+        the current spec of sections whose fingerprint did not change.  A
+        section with a bad value gets its error saved instead, which is
+        raised when the section is asked for, and is kept the same way
+        while it does not change.  Returns the sorted names of the sections
+        that changed.
+        """
+        specs = {}
+        errors = {}
+        fingerprints = {}
+        for section_name in self._database_sections['names']:
+            fingerprints[section_name] = self._fingerprint(section_name)
+            if self._fingerprints.get(section_name) == \
+                    fingerprints[section_name]:
+                if section_name in self._spec_cache:
+                    specs[section_name] = self._spec_cache[section_name]
+                    continue
+                if section_name in self._spec_errors:
+                    errors[section_name] = self._spec_errors[section_name]
+                    continue
+            try:
+                specs[section_name] = self._spec(
+                        section_name, fingerprints[section_name][0])
+            except ValueError as e:
+                errors[section_name] = e
+        changed = set(x for x in set(fingerprints) | set(self._fingerprints)
+                      if fingerprints.get(x) != self._fingerprints.get(x))
+        self._spec_cache = specs
+        self._spec_errors = errors
+        self._fingerprints = fingerprints
+        self._group_cache = dict(
+                ((group_name, environment), section_name)
+                for group_name, environments in
+                self._database_sections['groups'].items()
+                for environment, section_name in environments.items()
+                if section_name)
+        return sorted(changed)
+
+    def _spec(self, section_name, fingerprint):
+        section = self._sections[section_name]
+        role = section.get(GetAllDatabaseSections.ROLE_NAME) or \
+               GetAllDatabaseSections.ROLE_DEFAULT
+        options = self._engine_options(section_name)
+        pool_classes = self._pool_classes(section_name)
+        url_parts = self._as_sqlalchemy_url.parts(section_name)
+        breaker = (self._positive(section_name, self.BREAKER_FAILURES, int),
+                   self._positive(section_name, self.BREAKER_RESET, float))
+        if pool_classes and 'pool_size' not in options:
+            options['pool_size'] = sum(size for x, size in pool_classes)
+        return ConnectionSpec(
+                name=section_name,
+                url_parts=url_parts,
+                engine_options=tuple(sorted(options.items())),
+                schema=section.get('schema') or None,
+                group=section.get(GetAllDatabaseSections.GROUP_NAME) or None,
+                environment=section.get(
+                        GetAllDatabaseSections.ENVIRONMENT_NAME) or None,
+                role=role.lower(),
+                pool_classes=pool_classes,
+                connect_timeout=self._positive(section_name,
+                                               self.CONNECT_TIMEOUT, float),
+                statement_timeout=self._positive(
+                        section_name, self.STATEMENT_TIMEOUT, float),
+                breaker=breaker if breaker != (None, None) else None,
+                pragmas=self._pragmas(section_name, url_parts[0]),
+                fingerprint=fingerprint)
+
+    def _pool_classes(self, section_name):
+        val = self._sections[section_name].get(self.POOL_CLASSES)
+        if val is None or not str(val).strip():
+            return ()
+        try:
+            return parse_pool_classes(val)
+        except ValueError:
+            raise ValueError(self.BAD_OPTION.format(
+                    section_name=section_name, key=self.POOL_CLASSES, val=val))
 
-        if name in self._database_sections['groups']:
-            if environment in self._database_sections['groups'][name]:
-                if len(self._database_sections['groups'][name][environment]):
-                    name = self._database_sections['groups'][name][environment]
+    def _pragmas(self, section_name, drivername):
+        """Returns the pragmas of a sqlite section.  The pragma keys of
+        other dialects' sections are ignored.
+        """
+        if drivername.split('+')[0] != 'sqlite':
+            return ()
+        from dodai.model.pragmas import SqliteProfile
+        try:
+            return SqliteProfile.load(self._sections[section_name]).pragmas
+        except ValueError as e:
+            key = e.args[0]
+            raise ValueError(self.BAD_OPTION.format(
+                    section_name=section_name, key=key,
+                    val=self._sections[section_name][key]))
+
+    def _positive(self, section_name, key, type_):
+        """Returns the number of the given type in the section's key, or
+        None when it is not set
+        """
+        val = self._sections[section_name].get(key)
+        if val is None or not str(val).strip():
+            return None
+        try:
+            out = type_(val)
+        except ValueError:
+            out = 0
+        if out <= 0:
+            raise ValueError(self.BAD_OPTION.format(
+                    section_name=section_name, key=key, val=val))
+        return out
 
-        if name in self._database_sections['names']:
+    def _fingerprint(self, section_name):
+        """Returns the fingerprint of a section, a plain hash of everything
+        but its secrets, and an HMAC of its secrets
+        """
+        data = []
+        secrets = []
+        for key, val in sorted((str(key), str(val)) for key, val in
+                               self._sections[section_name].items()):
+            if any(x in key.lower() for x in self.SECRET_KEYS):
+                secrets.append((key, val))
+            else:
+                data.append((key, val))
+        return (hashlib.sha1(repr(data).encode('utf-8')).hexdigest(),
+                hmac.new(self._SECRETS_KEY, repr(secrets).encode('utf-8'),
+                         hashlib.sha256).hexdigest())
+
+    def _engine_options(self, section_name):
+        """Returns the create_engine keyword arguments that are set in the
+        section
+        """
+        out = {}
+        for key, type_ in self.ENGINE_OPTIONS:
+            val = self._sections[section_name].get(key)
+            if val is None or not str(val).strip():
+                continue
+            try:
+                out[key] = type_(val)
+            except ValueError:
+                raise ValueError(self.BAD_OPTION.format(
+                        section_name=section_name, key=key, val=val))
+        return out
+
+    def _find_roles(self, name, environment):
+        if name in self._database_sections['roles']:
+            if environment in self._database_sections['roles'][name]:
+                return self._database_sections['roles'][name][environment]
+        return None
+
+    def _find_name(self, name, environment):
+        environment = environment or self.environment
+        name = self._group_cache.get((name, environment), name)
+        if name in self._spec_cache or name in self._spec_errors:
             return name
@@ -0,0 +1,250 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from dodai.model import fork
+from dodai.model.timing import normalize_sql
+
+
+class ExplainCapture(object):
+    """Engine listener that captures the query plan of statements that run
+    longer than a section's threshold.
+
+    The plan comes from 'EXPLAIN QUERY PLAN' on sqlite and 'EXPLAIN' on
+    postgresql and mysql.  Other dialects are not captured.  The slow
+    statement and its parameters are only recorded when it runs, since the
+    caller's connection may still be reading its result.  The EXPLAIN runs
+    later, when explain(), plans() or plan() is called, on a new pooled
+    connection of the section's engine.  A statement that needs the
+    caller's uncommitted state, like a temporary table, fails to explain
+    and is counted in 'failed'.  Plans are kept once per section and
+    normalized statement (see dodai.model.timing.normalize_sql) in a
+    bounded buffer that drops the oldest plan first.  A statement whose
+    plan is already kept only has its count and duration updated, so it
+    is never explained twice.
+    At most 'limit' plans are captured every 'period' seconds and only a
+    'sample_rate' fraction of the slow statements are considered, so the
+    capture itself cannot turn into load on the database.
+
+    A section's threshold in seconds comes from its 'explain_threshold'
+    key, then its 'slow_query_threshold' key, then the threshold given
+    here.  Sections without one are not captured.
+    """
+
+    THRESHOLD_KEYS = ('explain_threshold', 'slow_query_threshold')
+    PREFIXES = {
+        'sqlite': 'EXPLAIN QUERY PLAN ',
+        'postgresql': 'EXPLAIN ',
+        'mysql': 'EXPLAIN ',
+        'mariadb': 'EXPLAIN ',
+    }
+    STATEMENTS = ('select', 'with', 'insert', 'update', 'delete', 'replace')
+    SIZE = 500
+    LIMIT = 10
+    PERIOD = 60.0
+    INFO_KEY = 'dodai_explain_start'
+
+    def __init__(self, thresholds=None, threshold=None, size=None,
+                 limit=None, period=None, sample_rate=1.0):
+        """
+        :param thresholds: A dictionary of section name to threshold in
+            seconds
+        :param threshold: The threshold for sections not in thresholds.
+            None turns capturing off for them.
+        :param size: The number of plans that are kept
+        :param limit: The number of plans captured at most every period
+        :param period: The length of the rate limit period in seconds
+        :param sample_rate: The fraction of slow statements considered for
+            capture, between 0 and 1
+        """
+        self._thresholds = thresholds or {}
+        self._threshold = threshold
+        self._size = size or self.SIZE
+        self._limit = limit or self.LIMIT
+        self._period = period or self.PERIOD
+        self._sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()
+        self._pending = OrderedDict()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self.skipped = 0
+        self.failed = 0
+        fork.register(self)
+
+    @classmethod
+    def load(cls, sections, threshold=None, size=None, limit=None,
+             period=None, sample_rate=1.0):
+        """Builds the thresholds from the 'explain_threshold' or
+        'slow_query_threshold' keys of the given config sections
+        """
+        thresholds = {}
+        for section_name in sections:
+            for key in cls.THRESHOLD_KEYS:
+                value = sections[section_name].get(key)
+                if value:
+                    thresholds[section_name] = float(value)
+                    break
+        return cls(thresholds, threshold, size, limit, period, sample_rate)
+
+    def __call__(self, name, engine):
+        threshold = self._thresholds.get(name, self._threshold)
+        prefix = self.PREFIXES.get(engine.dialect.name)
+        if threshold is None or prefix is None:
+            return
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute',
+                     self._after(name, threshold, prefix))
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault(self.INFO_KEY, []).append(time.perf_counter())
+
+    def _after(self, name, threshold, prefix):
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            duration = time.perf_counter() - conn.info[self.INFO_KEY].pop()
+            if duration < threshold or executemany:
+                return
+            if not self._explainable(statement):
+                return
+            key = (name, normalize_sql(statement))
+            if self._seen(key, duration):
+                return
+            if not self._allowed():
+                return
+            self._keep(key, {
+                'name': name,
+                'statement': key[1],
+                'sql': statement,
+                'dialect': conn.dialect.name,
+                'plan': None,
+                'text': None,
+                'duration': duration,
+                'max_duration': duration,
+                'count': 1,
+                'timestamp': time.time(),
+            }, (conn.engine, prefix, statement, parameters))
+        return after_cursor_execute
+
+    def _explainable(self, statement):
+        words = statement.lstrip(' \t\r\n(').split(None, 1)
+        return bool(words) and words[0].lower() in self.STATEMENTS
+
+    def _seen(self, key, duration):
+        with self._lock:
+            if key not in self._plans:
+                return False
+            entry = self._plans[key]
+            entry['count'] += 1
+            entry['duration'] = duration
+            entry['max_duration'] = max(entry['max_duration'], duration)
+            self._plans.move_to_end(key)
+            return True
+
+    def _allowed(self):
+        if self._sample_rate < 1 and random.random() >= self._sample_rate:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= self._period:
+                self._window_start = now
+                self._window_count = 0
+            if self._window_count >= self._limit:
+                self.skipped += 1
+                return False
+            self._window_count += 1
+            return True
+
+    def explain(self):
+        """Runs the EXPLAIN of every statement captured since the last call,
+        each on a new pooled connection of its engine.  A statement that
+        can not be explained is dropped and may be captured again.
+        """
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+        for key, (engine, prefix, statement, parameters) in pending:
+            plan = self._explain(engine, prefix, statement, parameters)
+            with self._lock:
+                if key not in self._plans:
+                    continue
+                if plan is None:
+                    self.failed += 1
+                    del self._plans[key]
+                    continue
+                self._plans[key]['plan'] = plan
+                self._plans[key]['text'] = '\n'.join(
+                        ' | '.join(str(x) for x in row) for row in plan)
+
+    @staticmethod
+    def _explain(engine, prefix, statement, parameters):
+        try:
+            with engine.connect() as connection:
+                result = connection.exec_driver_sql(prefix + statement,
+                                                    parameters or ())
+                return [tuple(row) for row in result]
+        except Exception:
+            return None
+
+    def _keep(self, key, entry, pending):
+        with self._lock:
+            self._plans[key] = entry
+            self._pending[key] = pending
+            while len(self._plans) > self._size:
+                old, _ = self._plans.popitem(last=False)
+                self._pending.pop(old, None)
+
+    def plans(self, name=None):
+        """Returns the captured plans, least recently seen first, optionally
+        only those of the given section
+        """
+        self.explain()
+        with self._lock:
+            out = [dict(x) for x in self._plans.values()]
+        if name is not None:
+            out = [x for x in out if x['name'] == name]
+        return out
+
+    def plan(self, name, statement):
+        """Returns the captured plan of a statement on the given section or
+        None.  The statement is normalized before looking it up.
+        """
+        self.explain()
+        with self._lock:
+            entry = self._plans.get((name, normalize_sql(statement)))
+            return dict(entry) if entry else None
+
+    def clear(self):
+        """Forgets every captured plan
+        """
+        with self._lock:
+            self._plans.clear()
+            self._pending.clear()
+            self._window_count = 0
+            self.skipped = 0
+            self.failed = 0
+
+    def after_fork(self):
+        """Makes a new lock in the child process.  Called automatically after
+        os.fork().
+        """
+        self._lock = threading.Lock()
@@ -0,0 +1,247 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from urllib.parse import quote
+from dodai.model import fork
+
+
+class HealthProbe(object):
+    """Callable object that checks if the database behind a
+    DodaiSqlalchemyConnection can be reached.
+
+    A new DBAPI connection is opened for every probe rather than one from the
+    engine's pool, so connections that were opened before the database went
+    down do not hide the outage.  With a timeout, in seconds, the connect
+    gives up after it in the way the driver supports (see
+    dodai.model.timeouts.ConnectTimeout), so a host that does not answer
+    does not hold the probe forever.  A sqlite file is opened read-only,
+    so probing a file that is missing does not make an empty one.
+    """
+
+    QUERY = "SELECT 1"
+    QUERIES = {
+        'sqlite': "PRAGMA schema_version",
+        'oracle': "SELECT 1 FROM DUAL",
+        'firebird': "SELECT 1 FROM RDB$DATABASE",
+    }
+
+    def __init__(self, query=None, timeout=None):
+        self._query = query
+        self.timeout = timeout
+
+    def __call__(self, connection):
+        engine = connection.engine
+        dialect = engine.dialect
+        query = self._query or self.QUERIES.get(dialect.name, self.QUERY)
+        try:
+            cargs, cparams = dialect.create_connect_args(
+                    self._url(engine.url))
+            if self.timeout:
+                from dodai.model.timeouts import ConnectTimeout
+                ConnectTimeout(self.timeout)(dialect, None, cargs, cparams)
+            dbapi_connection = dialect.connect(*cargs, **cparams)
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute(query)
+                cursor.fetchall()
+                cursor.close()
+            finally:
+                dbapi_connection.close()
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def _url(url):
+        database = url.database
+        if url.get_backend_name() != 'sqlite' or not database or \
+                database == ':memory:' or url.query.get('uri'):
+            return url
+        query = dict(url.query, mode='ro', uri='true')
+        return url.set(database='file:' + quote(os.path.abspath(database)),
+                       query=query)
+
+
+class FailoverConnection(object):
+    """A connection object that uses the first healthy candidate out of an
+    ordered list of DodaiSqlalchemyConnection objects.
+
+    The engine, connection and session attributes are the active
+    candidate's.  Every candidate is probed each 'interval' seconds by a
+    background thread (see start()), and a probe that takes longer than
+    'timeout' seconds counts as a failure, so an outage of the active
+    candidate is noticed within interval + timeout seconds.  When the active
+    candidate fails, the next healthy candidate in the list takes over.  With
+    'failback' set, a candidate earlier in the list takes over again as soon
+    as it is healthy.  A candidate whose probe is still running from an
+    earlier check is not probed again and keeps its last result, so a probe
+    that hangs never holds up the probes of the other candidates.
+    """
+
+    INTERVAL = 5.0
+    TIMEOUT = 2.0
+    HISTORY = 100
+
+    def __init__(self, candidates, probe=None, interval=None, timeout=None,
+                 failback=False):
+        self.candidates = list(candidates)
+        if not self.candidates:
+            raise ValueError("At least one candidate is needed for failover")
+        self.interval = interval or self.INTERVAL
+        self.timeout = timeout or self.TIMEOUT
+        self._probe = probe or HealthProbe(timeout=self.timeout)
+        self.failback = failback
+        self.healthy = [True] * len(self.candidates)
+        self.switches = 0
+        self.last_switch = None
+        self.history = deque(maxlen=self.HISTORY)
+        self._active = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._pending = {}
+        fork.register(self)
+
+    @property
+    def active(self):
+        """The DodaiSqlalchemyConnection that is currently in use
+        """
+        return self.candidates[self._active]
+
+    @property
+    def name(self):
+        return self.active.name
+
+    @property
+    def engine(self):
+        return self.active.engine
+
+    @property
+    def connection(self):
+        return self.active.connection
+
+    @property
+    def session(self):
+        return self.active.session
+
+    def check(self):
+        """Probes every candidate once and switches the active candidate if
+        needed.  Returns the list of health results.
+        """
+        futures = []
+        with self._lock:
+            if not self._executor:
+                self._executor = ThreadPoolExecutor(
+                        max_workers=len(self.candidates))
+            for index, candidate in enumerate(self.candidates):
+                future = self._pending.get(index)
+                if future is not None and not future.done():
+                    futures.append(None)
+                    continue
+                future = self._executor.submit(self._probe, candidate)
+                self._pending[index] = future
+                futures.append(future)
+        deadline = time.monotonic() + self.timeout
+        healthy = []
+        for index, future in enumerate(futures):
+            if future is None:
+                healthy.append(self.healthy[index])
+                continue
+            try:
+                remaining = max(deadline - time.monotonic(), 0)
+                healthy.append(bool(future.result(timeout=remaining)))
+            except TimeoutError:
+                healthy.append(False)
+        self.healthy = healthy
+        self._switch()
+        return healthy
+
+    def _switch(self):
+        with self._lock:
+            index = self._pick()
+            if index is None or index == self._active:
+                return
+            previous = self.candidates[self._active]
+            self._active = index
+            self.switches += 1
+            self.last_switch = time.time()
+            self.history.append((self.last_switch, previous.name,
+                                 self.candidates[index].name))
+        previous.engine.dispose()
+
+    def _pick(self):
+        if self.failback:
+            order = range(len(self.candidates))
+        elif self.healthy[self._active]:
+            return self._active
+        else:
+            count = len(self.candidates)
+            order = [(self._active + x) % count for x in range(1, count)]
+        for index in order:
+            if self.healthy[index]:
+                return index
+        return None
+
+    def start(self):
+        """Starts the background thread that probes the candidates
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                name="dodai-failover-{0}".format(self.candidates[0].name))
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and waits for it to finish
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self._pending = {}
+
+    def after_fork(self):
+        """Makes new locks in the child process and starts the background
+        health probes again if they were running in the parent, since
+        threads do not survive a fork.  Called automatically after
+        os.fork().
+        """
+        running = self._thread is not None and not self._stop.is_set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._pending = {}
+        if running:
+            self.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
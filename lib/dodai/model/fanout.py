@@ -0,0 +1,213 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from sqlalchemy import text
+
+
+class FanOutTimeout(Exception):
+    """The error of a shard that did not finish before the fan out timeout
+    """
+
+
+class ShardResult(object):
+    """The outcome of a statement on one section: the column names and rows,
+    or the error it raised, and the seconds it took
+    """
+
+    def __init__(self, name, keys=None, rows=None, error=None, elapsed=None):
+        self.name = name
+        self.keys = keys
+        self.rows = rows
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "<ShardResult {0} rows={1} elapsed={2:.3f}>".format(
+                    self.name, len(self.rows), self.elapsed)
+        return "<ShardResult {0} error={1!r}>".format(self.name, self.error)
+
+
+class FanOutResult(object):
+    """The ShardResult of every section, in the order the sections were
+    given
+    """
+
+    def __init__(self, shards, elapsed):
+        self.shards = shards
+        self.elapsed = elapsed
+
+    def __getitem__(self, name):
+        return self.shards[name]
+
+    @property
+    def errors(self):
+        """Section name to the error of the sections that failed
+        """
+        return dict((name, shard.error) for name, shard in self.shards.items()
+                    if not shard.ok)
+
+    @property
+    def timings(self):
+        """Section name to the seconds each section took
+        """
+        return dict((name, shard.elapsed)
+                    for name, shard in self.shards.items())
+
+    def rows(self, key=None):
+        """Returns the rows of every section that succeeded.  Without a key
+        the rows are joined in section order.  With a key function each
+        section's rows are taken to be sorted by it and are merged into
+        one sorted list.
+        """
+        parts = [shard.rows for shard in self.shards.values() if shard.ok]
+        if key is None:
+            return [row for part in parts for row in part]
+        return list(heapq.merge(*parts, key=key))
+
+
+class FanOutQuery(object):
+    """Runs the same statement on several database sections at once with
+    at most 'workers' running together.
+
+    Every section's rows, error and time are kept apart in a ShardResult, so
+    one failing shard does not hide the others.  When the whole fan out
+    takes longer than 'timeout' seconds the sections still running are
+    given a FanOutTimeout error and their queries are cancelled through the
+    DBAPI connection when the driver can (psycopg2's cancel(), sqlite's
+    interrupt()).  Other drivers finish the query in the background and the
+    result is dropped.
+
+    To use this class::
+
+        fan_out = get_database.fan_out('customers')
+        result = fan_out(select(orders).order_by(orders.c.created),
+                         timeout=30)
+        rows = result.rows(key=lambda row: row.created)
+        for name, error in result.errors.items():
+            log.warning("shard %s failed: %s", name, error)
+
+        for shard in fan_out.stream("SELECT COUNT(*) FROM orders"):
+            print(shard.name, shard.rows)
+    """
+
+    WORKERS = 8
+    CANCEL_METHODS = ('cancel', 'interrupt')
+
+    def __init__(self, connections, workers=None):
+        """
+        :param connections: A dictionary of section name to
+            DodaiSqlalchemyConnection, in the order results are reported
+        :param workers: The most sections queried at once
+        """
+        self._connections = connections
+        self.workers = workers or min(self.WORKERS, len(connections)) or 1
+
+    @property
+    def names(self):
+        return list(self._connections)
+
+    def __call__(self, statement, params=None, timeout=None):
+        """Runs the statement on every section and returns a FanOutResult
+        once they all finished or the timeout ran out
+        """
+        started = time.perf_counter()
+        shards = dict((name, None) for name in self._connections)
+        for shard in self.stream(statement, params, timeout):
+            shards[shard.name] = shard
+        return FanOutResult(shards, time.perf_counter() - started)
+
+    def stream(self, statement, params=None, timeout=None):
+        """Runs the statement on every section and yields each ShardResult
+        as soon as its section finishes.  Once the timeout runs out a
+        ShardResult with a FanOutTimeout error is yielded for every section
+        that has not finished, in section order.
+        """
+        if isinstance(statement, str):
+            statement = text(statement)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        running = {}
+        lock = threading.Lock()
+        executor = ThreadPoolExecutor(max_workers=self.workers,
+                                      thread_name_prefix='dodai-fan-out')
+        futures = dict(
+                (executor.submit(self._run, name, connection, statement,
+                                 params, running, lock), name)
+                for name, connection in self._connections.items())
+        try:
+            pending = set(futures)
+            while pending:
+                remaining = None if deadline is None else \
+                            deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                done, pending = wait(pending, remaining,
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            for future in pending:
+                future.cancel()
+            with lock:
+                for future in pending:
+                    self._cancel(running.get(futures[future]))
+            for future in [x for x in futures if x in pending]:
+                yield ShardResult(futures[future], error=FanOutTimeout(
+                        "The section '{0}' did not finish within {1} "
+                        "seconds".format(futures[future], timeout)),
+                        elapsed=timeout)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, name, connection, statement, params, running, lock):
+        started = time.perf_counter()
+        try:
+            with connection.engine.connect() as db:
+                with lock:
+                    running[name] = db.connection.dbapi_connection
+                try:
+                    result = db.execute(statement, params or {})
+                    keys = list(result.keys())
+                    rows = result.all()
+                finally:
+                    with lock:
+                        running.pop(name, None)
+        except Exception as e:
+            return ShardResult(name, error=e,
+                               elapsed=time.perf_counter() - started)
+        return ShardResult(name, keys, rows,
+                           elapsed=time.perf_counter() - started)
+
+    def _cancel(self, dbapi_connection):
+        if dbapi_connection is None:
+            return
+        for method in self.CANCEL_METHODS:
+            if hasattr(dbapi_connection, method):
+                try:
+                    getattr(dbapi_connection, method)()
+                except Exception:
+                    pass
+                return
@@ -0,0 +1,77 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import weakref
+
+_registry = weakref.WeakSet()
+# The pid of the process that owns them to the objects inherited from it
+_inherited = {}
+
+
+def register(obj):
+    """Registers an object with an after_fork() method to be called in the
+    child process right after os.fork().  Only a weak reference is kept.
+    """
+    _registry.add(obj)
+
+
+def inherit(*objs):
+    """Keeps objects the child process inherited from the parent alive and
+    untouched.  Engines, pools, connections and sessions made before a fork
+    share sockets with the parent, and closing them or letting them be
+    garbage collected in the child would close or reset the parent's
+    connections.  They are kept until the parent is gone, checked after
+    every fork.
+    """
+    _inherited.setdefault(os.getppid(), []).extend(objs)
+
+
+def registered():
+    """Returns a list of the objects that are registered
+    """
+    return list(_registry)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Another user's process
+        pass
+    return True
+
+
+def _forget_dead():
+    """Lets go of the objects of processes that have exited, whose
+    connections no one else uses anymore
+    """
+    for pid in list(_inherited):
+        if not _alive(pid):
+            del _inherited[pid]
+
+
+def _after_in_child():
+    for obj in list(_registry):
+        obj.after_fork()
+    _forget_dead()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_in_child)
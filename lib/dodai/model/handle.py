@@ -0,0 +1,129 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import weakref
+
+
+_configs = weakref.WeakSet()
+_found = weakref.WeakValueDictionary()
+# Configs loaded by install() have no other owner
+_installed = []
+
+
+NOT_FOUND = "No loaded config has the database section '{name}' with the "\
+            "fingerprint '{fingerprint}'.  In a spawned process call "\
+            "dodai.model.handle.install() with the config first."
+
+
+def register(get_database):
+    """Makes the database sections of a GetDatabase available to the
+    ConnectionHandles used in this process.  GetDatabase.handle() does this
+    itself; forked workers inherit it.
+    """
+    _configs.add(get_database)
+
+
+def install(sections, listeners=None):
+    """Loads a config and registers it.  Meant as the initializer of process
+    pools whose workers are spawned rather than forked::
+
+        ProcessPoolExecutor(initializer=dodai.model.handle.install,
+                            initargs=(sections,))
+    """
+    from dodai.model.database import GetDatabase
+    get_database = GetDatabase.load(sections, listeners=listeners)
+    _installed.append(get_database)
+    register(get_database)
+    return get_database
+
+
+class ConnectionHandle(object):
+    """A picklable stand-in for a DodaiSqlalchemyConnection that can be sent
+    to other processes, like ProcessPoolExecutor tasks.
+
+    Only the section name and the fingerprint of its config are pickled.
+    The first use in a process finds a registered config whose section has
+    the same fingerprint and remembers it, and the connection comes from
+    that config's GetDatabase, so each process makes its own engine once.
+    A KeyError is raised when no registered config matches, which also
+    catches workers that run with a different config than the parent.
+
+    To use this class::
+
+        handle = get_database.handle('db.warehouse')
+        with ProcessPoolExecutor() as pool:
+            totals = pool.map(summarize, [handle] * 8, range(8))
+
+        def summarize(handle, part):
+            with handle.engine.connect() as connection:
+                ...
+    """
+
+    __slots__ = ('name', 'fingerprint')
+
+    def __init__(self, name, fingerprint):
+        self.name = name
+        self.fingerprint = fingerprint
+
+    def __getstate__(self):
+        return (self.name, self.fingerprint)
+
+    def __setstate__(self, state):
+        self.name, self.fingerprint = state
+
+    def __eq__(self, other):
+        return isinstance(other, ConnectionHandle) and \
+               self.__getstate__() == other.__getstate__()
+
+    def __hash__(self):
+        return hash(self.__getstate__())
+
+    def __repr__(self):
+        return "<ConnectionHandle {0} {1}>".format(self.name,
+                                                   self.fingerprint[:12])
+
+    @property
+    def connection(self):
+        """The DodaiSqlalchemyConnection of this process
+        """
+        key = self.__getstate__()
+        get_database = _found.get(key)
+        if get_database is None or not self._matches(get_database):
+            get_database = _found[key] = self._find()
+        return get_database(self.name)
+
+    @property
+    def engine(self):
+        return self.connection.engine
+
+    @property
+    def session(self):
+        return self.connection.session
+
+    def _matches(self, get_database):
+        try:
+            spec = get_database.spec(self.name)
+        except (KeyError, ValueError):
+            return False
+        return spec.fingerprint == self.fingerprint
+
+    def _find(self):
+        for get_database in list(_configs):
+            if self._matches(get_database):
+                return get_database
+        raise KeyError(NOT_FOUND.format(name=self.name,
+                                        fingerprint=self.fingerprint))
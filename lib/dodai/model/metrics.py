@@ -0,0 +1,358 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from sqlalchemy import event
+from dodai.model import fork
+
+
+class MetricFamily(object):
+    """One metric with its type, help text and a list of (labels, value)
+    samples.  Collectors return lists of these from collect().
+    """
+
+    def __init__(self, name, type_, help_, samples=None):
+        self.name = name
+        self.type = type_
+        self.help = help_
+        self.samples = samples or []
+
+    def add(self, labels, value, suffix=''):
+        self.samples.append((suffix, labels, value))
+        return self
+
+
+class SectionPoolMetrics(object):
+    """The pool counters of one database section
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.engines = weakref.WeakSet()
+        self.engines_created = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.invalidations = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self):
+        """Returns a snapshot of the metrics as a dictionary
+        """
+        out = {
+            'name': self.name,
+            'engines': len(self.engines),
+            'engines_created': self.engines_created,
+            'connects': self.connects,
+            'disconnects': self.disconnects,
+            'invalidations': self.invalidations,
+            'checkouts': self.checkouts,
+            'checked_out': 0,
+            'overflow': 0,
+            'pool_size': 0,
+            'wait_count': self.wait_count,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+        }
+        counted = False
+        for engine in list(self.engines):
+            pool = engine.pool
+            if hasattr(pool, 'checkedout'):
+                out['checked_out'] += pool.checkedout()
+                counted = True
+            if hasattr(pool, 'overflow'):
+                out['overflow'] += max(pool.overflow(), 0)
+            if hasattr(pool, 'size'):
+                out['pool_size'] += pool.size()
+        if not counted:
+            out['checked_out'] = self.checked_out
+        return out
+
+
+class PoolMetrics(object):
+    """Engine listener that keeps pool and engine metrics for each database
+    section, fed by the sqlalchemy pool events.
+
+    Pass an instance in the listeners of GetDatabase.load,
+    DodaiSqlalchemyConnection or DodaiDatabaseObject, then use stats() or
+    render_prometheus() to read them.  Pool wait time is the time
+    engine.connect() spends getting a connection from the pool, including
+    making a new one when the pool has to.
+
+    To use this class::
+
+        from dodai.model.database import GetDatabase
+        from dodai.model.metrics import PoolMetrics
+        from dodai.model.metrics import serve
+
+        metrics = PoolMetrics()
+        get_database = GetDatabase.load(sections, listeners=[metrics])
+
+        # Serve http://localhost:9100/metrics from a daemon thread
+        serve(9100, metrics)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sections = {}
+        fork.register(self)
+
+    def __call__(self, name, engine):
+        section = self._section(name)
+        with self._lock:
+            section.engines.add(engine)
+            section.engines_created += 1
+        event.listen(engine, 'connect', self._count(name, 'connects'))
+        event.listen(engine, 'close', self._count(name, 'disconnects'))
+        event.listen(engine, 'close_detached',
+                     self._count(name, 'disconnects'))
+        event.listen(engine, 'invalidate',
+                     self._count(name, 'invalidations'))
+        event.listen(engine, 'soft_invalidate',
+                     self._count(name, 'invalidations'))
+        event.listen(engine, 'checkout', self._checkout(name))
+        event.listen(engine, 'checkin', self._checkin(name))
+        event.listen(engine, 'engine_disposed', self._disposed(name))
+        self._time_pool(name, engine.pool)
+
+    def _section(self, name):
+        if name not in self._sections:
+            with self._lock:
+                if name not in self._sections:
+                    self._sections[name] = SectionPoolMetrics(name)
+        return self._sections[name]
+
+    def _count(self, name, attribute):
+        def count(*args):
+            section = self._section(name)
+            with self._lock:
+                setattr(section, attribute, getattr(section, attribute) + 1)
+        return count
+
+    def _checkout(self, name):
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            section = self._section(name)
+            with self._lock:
+                section.checkouts += 1
+                section.checked_out += 1
+        return checkout
+
+    def _checkin(self, name):
+        def checkin(dbapi_connection, connection_record):
+            section = self._section(name)
+            with self._lock:
+                if section.checked_out > 0:
+                    section.checked_out -= 1
+        return checkin
+
+    def _disposed(self, name):
+        def engine_disposed(engine):
+            self._time_pool(name, engine.pool)
+        return engine_disposed
+
+    def _time_pool(self, name, pool):
+        """Wraps the pool's connect() to time how long getting a connection
+        takes.  The pool events only fire once a connection is in hand.
+        """
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                self._wait(name, time.perf_counter() - start)
+        pool.connect = timed_connect
+
+    def _wait(self, name, duration):
+        section = self._section(name)
+        with self._lock:
+            section.wait_count += 1
+            section.wait_total += duration
+            if duration > section.wait_max:
+                section.wait_max = duration
+
+    def sections(self):
+        """Returns the names of the sections that have metrics
+        """
+        return list(self._sections)
+
+    def stats(self, name=None):
+        """Returns a snapshot dictionary of the metrics of the given section
+        or, without a name, a dictionary of every section's snapshot
+        """
+        with self._lock:
+            if name is not None:
+                if name not in self._sections:
+                    raise KeyError("No pool metrics for '{0}'".format(name))
+                return self._sections[name].as_dict()
+            return dict((key, section.as_dict())
+                        for key, section in self._sections.items())
+
+    def collect(self):
+        """Returns the metrics as a list of MetricFamily
+        """
+        families = (
+            ('engines', 'gauge', "Live engines for the section"),
+            ('engines_created', 'counter',
+             "Engines made for the section"),
+            ('checked_out', 'gauge', "Connections checked out of the pool"),
+            ('overflow', 'gauge', "Connections opened past the pool size"),
+            ('pool_size', 'gauge', "Configured size of the pool"),
+            ('connects', 'counter', "New DBAPI connections made"),
+            ('disconnects', 'counter', "DBAPI connections closed"),
+            ('invalidations', 'counter', "Pool connections invalidated"),
+            ('checkouts', 'counter', "Connections checked out of the pool"),
+            ('wait_max', 'gauge',
+             "Longest wait for a pool connection in seconds"),
+        )
+        names = {
+            'engines_created': 'dodai_engines_created_total',
+            'engines': 'dodai_engines',
+            'connects': 'dodai_pool_connects_total',
+            'disconnects': 'dodai_pool_disconnects_total',
+            'invalidations': 'dodai_pool_invalidations_total',
+            'checkouts': 'dodai_pool_checkouts_total',
+            'wait_max': 'dodai_pool_wait_seconds_max',
+        }
+        stats = self.stats()
+        out = []
+        for key, type_, help_ in families:
+            name = names.get(key, 'dodai_pool_{0}'.format(key))
+            family = MetricFamily(name, type_, help_)
+            for section_name in sorted(stats):
+                family.add({'section': section_name},
+                           stats[section_name][key])
+            out.append(family)
+        wait = MetricFamily('dodai_pool_wait_seconds', 'summary',
+                            "Time spent getting a connection from the pool")
+        for section_name in sorted(stats):
+            labels = {'section': section_name}
+            wait.add(labels, stats[section_name]['wait_total'], '_sum')
+            wait.add(labels, stats[section_name]['wait_count'], '_count')
+        out.append(wait)
+        return out
+
+    def reset(self):
+        """Starts the counters over.  Live engines are kept.
+        """
+        with self._lock:
+            for name, section in self._sections.items():
+                new = SectionPoolMetrics(name)
+                for engine in list(section.engines):
+                    new.engines.add(engine)
+                self._sections[name] = new
+
+    def after_fork(self):
+        """Makes a new lock and starts the counters over in the child process
+        since the pools are new there.  Called automatically after os.fork().
+        """
+        self._lock = threading.Lock()
+        self.reset()
+
+
+def _escape(value, quotes=True):
+    out = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    if quotes:
+        out = out.replace('"', '\\"')
+    return out
+
+
+def quantile(percent):
+    """Returns the quantile label of a percentile, '0.999' for 99.9
+    """
+    return '{0:g}'.format(percent / 100.0)
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render_prometheus(*collectors):
+    """Returns the metrics of the given collectors (objects with a collect()
+    method like PoolMetrics) in the Prometheus text exposition format
+    """
+    out = []
+    for collector in collectors:
+        for family in collector.collect():
+            out.append("# HELP {0} {1}".format(family.name,
+                                               _escape(family.help, False)))
+            out.append("# TYPE {0} {1}".format(family.name, family.type))
+            for suffix, labels, value in family.samples:
+                if labels:
+                    labels = ','.join(
+                        '{0}="{1}"'.format(key, _escape(labels[key]))
+                        for key in sorted(labels))
+                    labels = '{' + labels + '}'
+                else:
+                    labels = ''
+                out.append("{0}{1}{2} {3}".format(family.name, suffix,
+                                                  labels,
+                                                  _format_value(value)))
+    return '\n'.join(out) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """A tiny http handler that serves the collectors set on the class in
+    the Prometheus text format.  Use make_handler() to get one.
+    """
+
+    collectors = ()
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_prometheus(*self.collectors).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', self.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_handler(*collectors):
+    """Returns a MetricsHandler class that serves the given collectors
+    """
+    return type('MetricsHandler', (MetricsHandler,),
+                {'collectors': collectors})
+
+
+def serve(port, *collectors, host=''):
+    """Serves the given collectors over http from a daemon thread and
+    returns the server.  Call shutdown() on it to stop.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(*collectors))
+    thread = threading.Thread(target=server.serve_forever, daemon=True,
+                              name="dodai-metrics")
+    thread.start()
+    return server
@@ -85,3 +85,23 @@ class ValidateFieldExistsAndIsPopulated(object):
                     required_field=field_name
             )
             raise ValueError(message)
+
+
+def parse_pool_classes(value):
+    """Parses the 'pool_classes' value of a section, like
+    'interactive:8, batch:2', into a tuple of (name, size) pairs in
+    priority order.  Raises ValueError when it can not be parsed.
+    """
+    out = []
+    for part in str(value).split(','):
+        if not part.strip():
+            continue
+        name, _, size = part.partition(':')
+        name = name.strip()
+        size = int(size)
+        if not name or size < 1 or name in dict(out):
+            raise ValueError(value)
+        out.append((name, size))
+    if not out:
+        raise ValueError(value)
+    return tuple(out)
@@ -0,0 +1,114 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+def _choice(*names, numbered=True):
+    """Returns a parser of a pragma value that is one of the names or, when
+    numbered, the position of the name
+    """
+    def parse(val):
+        val = str(val).strip().lower()
+        if numbered and val.isdigit() and int(val) < len(names):
+            return names[int(val)]
+        if val not in names:
+            raise ValueError(val)
+        return val
+    return parse
+
+
+def _integer(minimum=None):
+    def parse(val):
+        out = int(str(val).strip())
+        if minimum is not None and out < minimum:
+            raise ValueError(val)
+        return out
+    return parse
+
+
+class SqliteProfile(object):
+    """The pragmas of a sqlite section, run on every new DBAPI connection
+    of the engine through its connect event.
+
+    The section keys are named after the pragmas and take their values:
+    journal_mode (delete, truncate, persist, memory, wal or off),
+    synchronous (off, normal, full or extra), cache_size (pages, or KiB
+    when negative), mmap_size (bytes), temp_store (default, file or
+    memory) and busy_timeout (milliseconds).  Keys that are not set keep
+    sqlite's default.
+
+    To use this class::
+
+        profile = SqliteProfile.load({'journal_mode': 'wal',
+                                      'synchronous': 'normal'})
+        profile.install(engine)
+    """
+
+    # In the order they are run.  busy_timeout comes first so that the
+    # others wait for a lock instead of failing.
+    PRAGMAS = (
+        ('busy_timeout', _integer(0)),
+        ('journal_mode', _choice('delete', 'truncate', 'persist', 'memory',
+                                 'wal', 'off', numbered=False)),
+        ('synchronous', _choice('off', 'normal', 'full', 'extra')),
+        ('cache_size', _integer()),
+        ('mmap_size', _integer(0)),
+        ('temp_store', _choice('default', 'file', 'memory')),
+    )
+
+    def __init__(self, pragmas):
+        """
+        :param pragmas: A list of (pragma name, value) pairs with parsed
+            values, in the order they are run
+        """
+        self.pragmas = tuple(pragmas)
+
+    @classmethod
+    def load(cls, section):
+        """Makes the profile from the pragma keys of a config section.
+        Raises a ValueError of the key's name when a value is not valid.
+        """
+        out = []
+        for key, parse in cls.PRAGMAS:
+            val = section.get(key)
+            if val is None or not str(val).strip():
+                continue
+            try:
+                out.append((key, parse(val)))
+            except ValueError:
+                raise ValueError(key)
+        return cls(out)
+
+    def statements(self):
+        return ["PRAGMA {0} = {1}".format(key, val)
+                for key, val in self.pragmas]
+
+    def __call__(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in self.statements():
+                cursor.execute(statement)
+                # journal_mode answers with the mode it switched to
+                cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def install(self, engine):
+        # Imported here, since loading a config makes a profile for every
+        # sqlite section and has to stay free of sqlalchemy
+        from sqlalchemy import event
+        event.listen(engine, 'connect', self)
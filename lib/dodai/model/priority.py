@@ -0,0 +1,331 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+from dodai.model import fork
+from dodai.model.metrics import MetricFamily
+from dodai.model.metrics import quantile
+from dodai.model.parse import parse_pool_classes
+from dodai.model.timing import LatencyHistogram
+
+
+class PoolClassTimeout(Exception):
+    """Raised when a pool class slot was not free within the timeout
+    """
+
+
+class _PoolClassStats(object):
+
+    def __init__(self, name, priority, size):
+        self.name = name
+        self.priority = priority
+        self.size = size
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.queue_time = LatencyHistogram()
+
+
+class PriorityGate(object):
+    """Shares 'total' connection slots of one section between named pool
+    classes, each allowed at most its own size of them at a time.
+
+    When no slot is free callers wait, and a freed slot goes to the waiter
+    of the highest priority class that is still under its size, first come
+    first served within a class.  Classes are listed highest priority
+    first.  The time spent waiting is recorded per class.
+
+    Once install()ed on an engine, every connection checked out of its
+    pool holds a slot until it is checked back in.  Connections of a
+    PoolClass take a slot of their class.  Any other checkout, through
+    the engine, connection or session of the section, takes a slot of the
+    lowest priority class, so work that does not name a class can not
+    starve the others.
+    """
+
+    PERCENTILES = (50, 90, 99)
+    INFO_KEY = 'dodai_pool_class'
+
+    def __init__(self, name, classes, total=None):
+        """
+        :param name: The section name the metrics are labelled with
+        :param classes: A list of (class name, size) pairs, highest
+            priority first
+        :param total: The slots shared by all classes, by default the sum
+            of the sizes
+        """
+        self.name = name
+        self.total = total or sum(size for x, size in classes)
+        self._classes = dict(
+                (class_name, _PoolClassStats(class_name, priority, size))
+                for priority, (class_name, size) in enumerate(classes))
+        self._order = [class_name for class_name, size in classes]
+        self._in_use = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._default_timeout = None
+        fork.register(self)
+
+    @property
+    def classes(self):
+        return list(self._order)
+
+    @property
+    def default(self):
+        """The class of checkouts that do not name one, the lowest priority
+        class
+        """
+        return self._order[-1]
+
+    def install(self, engine):
+        """Makes every checkout of the engine's pool take a slot.  Those
+        that do not name a class wait up to the pool's timeout.
+        """
+        timeout = getattr(engine.pool, 'timeout', None)
+        self._default_timeout = timeout() if timeout else None
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'checkin', self._checkin)
+        event.listen(engine, 'detach', self._checkin)
+
+    @contextmanager
+    def using(self, class_name, timeout=None):
+        """Makes the checkouts of this thread inside of the with block take
+        slots of the class
+        """
+        self._stats(class_name)
+        previous = getattr(self._local, 'using', None)
+        self._local.using = (class_name, timeout)
+        try:
+            yield
+        finally:
+            self._local.using = previous
+
+    def _checkout(self, dbapi_connection, connection_record,
+                  connection_proxy):
+        if self.INFO_KEY in connection_record.info:
+            # Checked out again after a disconnect, the slot is still held
+            return
+        class_name, timeout = getattr(self._local, 'using', None) or \
+                              (self.default, self._default_timeout)
+        self.acquire(class_name, timeout)
+        connection_record.info[self.INFO_KEY] = class_name
+
+    def _checkin(self, dbapi_connection, connection_record):
+        class_name = connection_record.info.pop(self.INFO_KEY, None)
+        if class_name is not None:
+            self.release(class_name)
+
+    def _stats(self, class_name):
+        try:
+            return self._classes[class_name]
+        except KeyError:
+            raise KeyError("The section '{0}' has no pool class '{1}'".format(
+                    self.name, class_name))
+
+    def _free(self, stats):
+        return self._in_use < self.total and stats.in_use < stats.size
+
+    def _next(self):
+        """The first waiter, by priority then arrival, that could take a
+        slot now
+        """
+        for waiter in self._waiters:
+            if self._free(self._classes[waiter[2]]):
+                return waiter
+        return None
+
+    def acquire(self, class_name, timeout=None):
+        """Takes a slot for the class, waiting up to timeout seconds
+        (forever when None) before raising PoolClassTimeout
+        """
+        stats = self._stats(class_name)
+        started = time.perf_counter()
+        with self._condition:
+            if self._free(stats) and self._next() is None:
+                self._take(stats, started)
+                return
+            waiter = (stats.priority, next(self._counter), class_name)
+            self._waiters.append(waiter)
+            self._waiters.sort()
+            stats.waiting += 1
+            try:
+                deadline = None if timeout is None else \
+                           time.monotonic() + timeout
+                while self._next() is not waiter:
+                    remaining = None if deadline is None else \
+                                deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        stats.timeouts += 1
+                        raise PoolClassTimeout(
+                                "No '{0}' connection of '{1}' was free within "
+                                "{2} seconds".format(class_name, self.name,
+                                                     timeout))
+                    self._condition.wait(remaining)
+            finally:
+                stats.waiting -= 1
+                self._waiters.remove(waiter)
+                # Someone behind this waiter may be able to go now
+                self._condition.notify_all()
+            self._take(stats, started)
+
+    def _take(self, stats, started):
+        stats.in_use += 1
+        stats.acquired += 1
+        self._in_use += 1
+        stats.queue_time.record(time.perf_counter() - started)
+
+    def release(self, class_name):
+        stats = self._stats(class_name)
+        with self._condition:
+            stats.in_use -= 1
+            self._in_use -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, class_name, timeout=None):
+        self.acquire(class_name, timeout)
+        try:
+            yield
+        finally:
+            self.release(class_name)
+
+    def stats(self, class_name=None):
+        """Returns a dictionary of class name to its counters and queue time
+        percentiles in seconds, or the dictionary of one class
+        """
+        with self._condition:
+            out = {}
+            for name in self._order:
+                stats = self._classes[name]
+                out[name] = {
+                    'priority': stats.priority,
+                    'size': stats.size,
+                    'in_use': stats.in_use,
+                    'waiting': stats.waiting,
+                    'acquired': stats.acquired,
+                    'timeouts': stats.timeouts,
+                    'queue_time_mean': stats.queue_time.mean,
+                    'queue_time': dict(
+                            (x, stats.queue_time.percentile(x))
+                            for x in self.PERCENTILES),
+                }
+        if class_name is not None:
+            self._stats(class_name)
+            return out[class_name]
+        return out
+
+    def collect(self):
+        """Returns the pool class counters as a list of MetricFamily for
+        dodai.model.metrics.render_prometheus()
+        """
+        stats = self.stats()
+        queue_time = MetricFamily('dodai_pool_class_queue_seconds', 'summary',
+                                  "Time spent waiting for a pool class slot")
+        gauges = (
+            ('size', "Slots the pool class may use"),
+            ('in_use', "Slots the pool class is using"),
+            ('waiting', "Callers waiting for a pool class slot"),
+        )
+        counters = (
+            ('acquired', "Pool class slots handed out"),
+            ('timeouts', "Pool class waits that timed out"),
+        )
+        families = [MetricFamily('dodai_pool_class_{0}'.format(key), 'gauge',
+                                 help_) for key, help_ in gauges]
+        families += [MetricFamily('dodai_pool_class_{0}_total'.format(key),
+                                  'counter', help_)
+                     for key, help_ in counters]
+        for class_name in self._order:
+            labels = {'section': self.name, 'pool_class': class_name}
+            histogram = self._classes[class_name].queue_time
+            for percent, value in sorted(
+                    stats[class_name]['queue_time'].items()):
+                if value is not None:
+                    queue_time.add(dict(labels, quantile=quantile(percent)),
+                                   value)
+            queue_time.add(labels, histogram.total / 1000000.0, '_sum')
+            queue_time.add(labels, histogram.count, '_count')
+            for family, (key, help_) in zip(families, gauges + counters):
+                family.add(labels, stats[class_name][key])
+        return [queue_time] + families
+
+    def after_fork(self):
+        """Starts over with no slots in use in the child process.  Called
+        automatically after os.fork().
+        """
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._waiters = []
+        self._in_use = 0
+        for stats in self._classes.values():
+            stats.in_use = 0
+            stats.waiting = 0
+
+
+class PoolClass(object):
+    """The connections of one pool class of a section.  Each of the context
+    managers takes a slot of the class when it checks out its connection,
+    waiting by priority when none is free, and gives it back on exit.
+
+    To use this class::
+
+        batch = get_database('db.orders').pool_class('batch')
+        with batch.begin() as connection:
+            connection.execute(...)
+    """
+
+    def __init__(self, name, gate, engine, sessionmaker):
+        self.name = name
+        self._gate = gate
+        self._engine = engine
+        self._sessionmaker = sessionmaker
+
+    @contextmanager
+    def connect(self, timeout=None):
+        """Yields a sqlalchemy Connection
+        """
+        with self._gate.using(self.name, timeout):
+            connection = self._engine.connect()
+        with connection:
+            yield connection
+
+    @contextmanager
+    def begin(self, timeout=None):
+        """Yields a sqlalchemy Connection in a transaction that is committed
+        on exit, or rolled back on an error
+        """
+        with self.connect(timeout) as connection:
+            with connection.begin():
+                yield connection
+
+    @contextmanager
+    def session(self, timeout=None):
+        """Yields a sqlalchemy Session bound to one connection of the class
+        """
+        with self.connect(timeout) as connection:
+            session = self._sessionmaker(bind=connection)()
+            try:
+                yield session
+            finally:
+                session.close()
@@ -0,0 +1,205 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import pickle
+import tempfile
+from sqlalchemy import MetaData
+from sqlalchemy import inspect
+from sqlalchemy import text
+
+
+def _digest(rows):
+    out = hashlib.sha1()
+    for row in rows:
+        out.update(repr(tuple(row)).encode('utf-8'))
+        out.update(b'\n')
+    return out.hexdigest()
+
+
+class SchemaVersion(object):
+    """Callable object that returns a cheap value that changes whenever the
+    schema of a database changes.
+
+        * **sqlite**: a hash over the SQL of everything in sqlite_master.
+          PRAGMA schema_version is not enough, since a new file made at the
+          same path with another schema can have the same number.
+        * **postgresql** and **mysql**: a hash over the columns and
+          constraints listed in information_schema for the schema
+        * anything else: a hash over the table names, which only notices
+          tables being added or removed
+    """
+
+    CATALOG = {
+        'postgresql': (
+            "SELECT table_name, column_name, ordinal_position, data_type, "
+            "is_nullable, column_default FROM information_schema.columns "
+            "WHERE table_schema = COALESCE(:schema, current_schema()) "
+            "ORDER BY table_name, ordinal_position",
+            "SELECT table_name, constraint_name, constraint_type FROM "
+            "information_schema.table_constraints WHERE table_schema = "
+            "COALESCE(:schema, current_schema()) ORDER BY table_name, "
+            "constraint_name",
+        ),
+        'mysql': (
+            "SELECT table_name, column_name, ordinal_position, column_type, "
+            "is_nullable, column_default FROM information_schema.columns "
+            "WHERE table_schema = COALESCE(:schema, DATABASE()) "
+            "ORDER BY table_name, ordinal_position",
+            "SELECT table_name, index_name, seq_in_index, column_name FROM "
+            "information_schema.statistics WHERE table_schema = "
+            "COALESCE(:schema, DATABASE()) ORDER BY table_name, index_name, "
+            "seq_in_index",
+        ),
+    }
+    CATALOG['mariadb'] = CATALOG['mysql']
+
+    def __call__(self, connection, schema=None):
+        name = connection.dialect.name
+        if name == 'sqlite':
+            prefix = '"{0}".'.format(schema.replace('"', '""')) \
+                     if schema else ''
+            return _digest(connection.exec_driver_sql(
+                    "SELECT type, name, tbl_name, sql FROM {0}sqlite_master "
+                    "ORDER BY type, name".format(prefix)))
+        if name in self.CATALOG:
+            rows = []
+            for query in self.CATALOG[name]:
+                rows.extend(connection.execute(text(query),
+                                               {'schema': schema}))
+            return _digest(rows)
+        return _digest([(x,) for x in
+                        sorted(inspect(connection).get_table_names(schema))])
+
+
+class ReflectionCache(object):
+    """Reflects the tables of a database into a sqlalchemy MetaData and keeps
+    the result in a file, so the next start loads it instead of asking the
+    database about every table again.
+
+    The file is named after a hash of the engine URL (without the password),
+    the schema and the tables asked for.  It holds the pickled MetaData and
+    the schema version it was reflected at (see SchemaVersion).  A file
+    that is not owned by the current user, or that the group or others may
+    write, is never loaded.  Each call
+    reads the current schema version, which is one cheap query, and reflects
+    again when it is not the one in the file.
+
+    To use this class::
+
+        database = get_database('db.blue')
+        metadata = database.reflect(schema='sales')
+        orders = metadata.tables['sales.orders']
+    """
+
+    def __init__(self, engine, directory=None, version=None):
+        """
+        :param engine: The sqlalchemy engine to reflect with
+        :param directory: Where the files are kept.  Defaults to
+            dodai/reflection in XDG_CACHE_HOME, or ~/.cache.
+        :param version: A callable like SchemaVersion that returns the
+            schema version of a connection
+        """
+        self._engine = engine
+        self.directory = directory or self.default_directory()
+        self._version = version or SchemaVersion()
+        self.source = None
+
+    @staticmethod
+    def default_directory():
+        base = os.environ.get('XDG_CACHE_HOME') or \
+               os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'dodai', 'reflection')
+
+    def path(self, schema=None, only=None):
+        """Returns the file the reflection of the schema and tables is
+        kept in
+        """
+        key = repr((self._engine.url.render_as_string(hide_password=True),
+                    schema, sorted(only) if only else None))
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{0}.pickle'.format(name))
+
+    def __call__(self, schema=None, only=None, metadata=None):
+        """Returns a MetaData with the reflected tables, loaded from the file
+        when the schema has not changed since it was written.  The
+        attribute 'source' tells which: 'file' or 'database'.
+
+        :param schema: The schema to reflect
+        :param only: A list of table names to reflect instead of all
+        :param metadata: A MetaData to add the tables to instead of a new
+            one
+        """
+        path = self.path(schema, only)
+        with self._engine.connect() as connection:
+            version = self._version(connection, schema)
+            cached = self._read(path, version)
+            if cached is None:
+                cached = MetaData()
+                cached.reflect(connection, schema=schema, only=only)
+                self._write(path, version, cached)
+                self.source = 'database'
+            else:
+                self.source = 'file'
+        if metadata is None:
+            return cached
+        for table in cached.sorted_tables:
+            if table.key not in metadata.tables:
+                table.to_metadata(metadata)
+        return metadata
+
+    @staticmethod
+    def _trusted(stream):
+        """Only files of this user that no one else can write are unpickled
+        """
+        stat = os.fstat(stream.fileno())
+        if hasattr(os, 'getuid') and stat.st_uid != os.getuid():
+            return False
+        return not stat.st_mode & 0o022
+
+    def _read(self, path, version):
+        try:
+            with open(path, 'rb') as stream:
+                if not self._trusted(stream):
+                    return None
+                data = pickle.load(stream)
+        except Exception:
+            return None
+        if data.get('version') != version:
+            return None
+        return data.get('metadata')
+
+    def _write(self, path, version, metadata):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        handle, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                pickle.dump({'version': version, 'metadata': metadata},
+                            stream, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, path)
+        except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def clear(self, schema=None, only=None):
+        """Removes the file of the schema and tables
+        """
+        path = self.path(schema, only)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,471 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy import text
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.util import find_tables
+from dodai.model import fork
+from dodai.model.metrics import MetricFamily
+
+
+NAME = r'((?:[`"\[]?\w+[`"\]]?\.)?[`"\[]?\w+[`"\]]?)'
+
+WRITE_PATTERN = re.compile(
+        r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE'
+        r'(?:\s+OR\s+\w+)?|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?|'
+        r'(?:DROP|ALTER)\s+TABLE(?:\s+IF\s+EXISTS)?)\s+' + NAME,
+        re.IGNORECASE)
+
+READ_PATTERN = re.compile(r'\b(?:FROM|JOIN)\s+' + NAME, re.IGNORECASE)
+
+
+def _table_name(name):
+    """Returns the lower case name of a table without its schema or quotes
+    """
+    return re.sub(r'[`"\[\]]', '', name).split('.')[-1].lower()
+
+
+def written_table(statement):
+    """Returns the name of the table a write statement changes, or None when
+    the statement does not write
+    """
+    match = WRITE_PATTERN.match(statement)
+    if match:
+        return _table_name(match.group(1))
+
+
+def read_tables(statement):
+    """Returns the set of table names a query reads.  Tables of sqlalchemy
+    statements are found from the statement itself and those of plain sql
+    from its FROM and JOIN clauses.
+    """
+    if isinstance(statement, ClauseElement):
+        tables = find_tables(statement, include_aliases=True,
+                             include_joins=True, include_crud=True)
+        out = set(_table_name(x.name) for x in tables
+                  if getattr(x, 'name', None))
+        if out:
+            return out
+        statement = getattr(statement, 'text', '')
+    return set(_table_name(x) for x in READ_PATTERN.findall(statement))
+
+
+class CachedResult(object):
+    """The column names and rows of a cached query
+    """
+
+    def __init__(self, keys, rows):
+        self._keys = keys
+        self.rows = rows
+
+    def keys(self):
+        return list(self._keys)
+
+    def all(self):
+        return list(self.rows)
+
+    def mappings(self):
+        return [dict(zip(self._keys, x)) for x in self.rows]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class MemoryBackend(object):
+    """Keeps cached results in a dictionary in least recently used order
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._tables = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        data, tables, expires = entry
+        if expires is not None and expires <= now:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return data
+
+    def put(self, key, data, tables, expires, now):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (data, tables, expires)
+        self.size += len(data)
+        for table in tables:
+            self._tables.setdefault(table, set()).add(key)
+
+    def invalidate(self, tables):
+        keys = set()
+        for table in tables:
+            keys.update(self._tables.pop(table, ()))
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def evict(self, max_entries, max_bytes):
+        count = 0
+        while self._entries and (
+                (max_entries and len(self._entries) > max_entries) or
+                (max_bytes and self.size > max_bytes)):
+            self._remove(next(iter(self._entries)))
+            count += 1
+        return count
+
+    def clear(self):
+        self._entries.clear()
+        self._tables.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        data, tables, expires = self._entries.pop(key)
+        self.size -= len(data)
+        for table in tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+    def after_fork(self):
+        pass
+
+
+class SqliteBackend(object):
+    """Keeps cached results in a sqlite file so that they outlive the
+    process.  Expiry times are wall clock times for the same reason.
+
+    The results are pickled, and loading a pickle can run code, so the file
+    must only be writable by the user running the program.  A new file is
+    made readable and writable by its owner only.
+
+    The last use times the eviction goes by are kept in memory and written
+    once USED_BATCH keys were hit, or before an eviction, instead of on
+    every hit.
+    """
+
+    USED_BATCH = 100
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS dodai_result_cache ("
+              "key TEXT PRIMARY KEY, tables TEXT, expires REAL, "
+              "used REAL, size INTEGER, data BLOB)")
+
+    def __init__(self, path):
+        self.path = path
+        self._used = {}
+        self._connect()
+
+    def _connect(self):
+        if not os.path.exists(self.path):
+            os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+        self._db = sqlite3.connect(self.path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(self.SCHEMA)
+
+    def __len__(self):
+        return self._db.execute(
+                "SELECT COUNT(*) FROM dodai_result_cache").fetchone()[0]
+
+    @property
+    def size(self):
+        return self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM dodai_result_cache"
+                ).fetchone()[0]
+
+    def get(self, key, now):
+        row = self._db.execute(
+                "SELECT data, expires FROM dodai_result_cache WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= now:
+            self._db.execute("DELETE FROM dodai_result_cache WHERE key = ?",
+                             (key,))
+            return None
+        self._used[key] = now
+        if len(self._used) >= self.USED_BATCH:
+            self._write_used()
+        return row[0]
+
+    def _write_used(self):
+        self._db.executemany("UPDATE dodai_result_cache SET used = ? "
+                             "WHERE key = ?",
+                             [(now, key) for key, now in self._used.items()])
+        self._used.clear()
+
+    def put(self, key, data, tables, expires, now):
+        tables = ' {0} '.format(' '.join(sorted(tables)))
+        self._db.execute("INSERT OR REPLACE INTO dodai_result_cache VALUES "
+                         "(?, ?, ?, ?, ?, ?)",
+                         (key, tables, expires, now, len(data), data))
+
+    @staticmethod
+    def _like(table):
+        for char in ('\\', '%', '_'):
+            table = table.replace(char, '\\' + char)
+        return '% {0} %'.format(table)
+
+    def invalidate(self, tables):
+        count = 0
+        for table in tables:
+            count += self._db.execute(
+                    "DELETE FROM dodai_result_cache WHERE tables LIKE ? "
+                    "ESCAPE '\\'", (self._like(table),)).rowcount
+        return count
+
+    def evict(self, max_entries, max_bytes):
+        if self._used:
+            self._write_used()
+        count = 0
+        if max_entries:
+            count += self._db.execute(
+                    "DELETE FROM dodai_result_cache WHERE key IN (SELECT key "
+                    "FROM dodai_result_cache ORDER BY used DESC LIMIT -1 "
+                    "OFFSET ?)", (max_entries,)).rowcount
+        if max_bytes:
+            while self._entries_over(max_bytes):
+                count += self._db.execute(
+                        "DELETE FROM dodai_result_cache WHERE key = (SELECT "
+                        "key FROM dodai_result_cache ORDER BY used LIMIT 1)"
+                        ).rowcount
+        return count
+
+    def _entries_over(self, max_bytes):
+        return len(self) and self.size > max_bytes
+
+    def clear(self):
+        self._used.clear()
+        self._db.execute("DELETE FROM dodai_result_cache")
+
+    def after_fork(self):
+        self._used = {}
+        self._connect()
+
+
+class ResultCache(object):
+    """Caches query results of one engine, keyed by the compiled sql and its
+    parameters.
+
+    Each result is kept until its time to live runs out, it is pushed out
+    by the 'max_entries' or 'max_bytes' bounds (least recently used first)
+    or a write through the same engine changes one of the tables it was
+    read from.  Writes are seen from the INSERT, UPDATE, DELETE, REPLACE,
+    TRUNCATE, ALTER and DROP statements the engine runs, whichever way
+    they are run, and are invalidated again when their transaction commits
+    so that no reader caches the old rows in between.  Writes made by other
+    programs are not seen; the time to live bounds how stale those results
+    get.
+
+    Results are stored pickled, in memory or, when 'path' is given, in a
+    sqlite file that outlives the process.  Keys include the engine URL, so
+    caches of different databases can share a file, but the file must be
+    private to the user running the program (see SqliteBackend).
+
+    To use this class::
+
+        database = get_database('db.blue')
+        cache = database.result_cache(ttl=300, max_bytes=64 * 1024 * 1024)
+        for row in cache.execute(select(countries)):
+            ...
+    """
+
+    TTL = 60.0
+    MAX_ENTRIES = 10000
+
+    def __init__(self, engine, name=None, ttl=None, max_entries=None,
+                 max_bytes=None, path=None):
+        """
+        :param engine: The sqlalchemy engine queries are run on
+        :param name: The name the metrics are labelled with
+        :param ttl: The default seconds a result is kept, 0 for no limit
+        :param max_entries: The most results kept
+        :param max_bytes: The most pickled bytes kept
+        :param path: A sqlite file to keep the results in, writable only
+            by the user running the program
+        """
+        self._engine = engine
+        self.name = name or engine.url.render_as_string(hide_password=True)
+        self.ttl = self.TTL if ttl is None else ttl
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.max_bytes = max_bytes
+        self._backend = SqliteBackend(path) if path else MemoryBackend()
+        self._lock = threading.Lock()
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'commit', self._commit)
+        event.listen(engine, 'rollback', self._rollback)
+        fork.register(self)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._backend)
+
+    def execute(self, statement, params=None, ttl=None, tables=None):
+        """Returns the CachedResult of the statement, running it only when
+        it is not cached.
+
+        :param statement: A sqlalchemy select, text or a sql string
+        :param params: The parameters of the statement
+        :param ttl: Seconds to keep this result instead of the default
+        :param tables: The names of the tables the result depends on, for
+            statements whose tables can not be found from the statement
+        """
+        if isinstance(statement, str):
+            statement = text(statement)
+        key = self.key(statement, params)
+        tables = set(_table_name(x) for x in tables) if tables else \
+                 read_tables(statement)
+        with self._lock:
+            data = self._backend.get(key, time.time())
+            if data is not None:
+                self.hits += 1
+                return pickle.loads(data)
+            self.misses += 1
+            versions = [self._versions.get(x, 0) for x in tables]
+        with self._engine.connect() as connection:
+            result = connection.execute(statement, params or {})
+            out = CachedResult(list(result.keys()),
+                               [tuple(x) for x in result])
+        self._store(key, out, tables, versions, ttl)
+        return out
+
+    def key(self, statement, params=None):
+        """Returns the cache key of a statement: a hash of the engine URL,
+        without the password, the sql compiled for the engine's dialect and
+        its parameters
+        """
+        compiled = statement.compile(dialect=self._engine.dialect)
+        values = dict(compiled.params)
+        values.update(params or {})
+        raw = '{0}\0{1}\0{2!r}'.format(
+                self._engine.url.render_as_string(hide_password=True),
+                compiled, sorted(values.items()))
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _store(self, key, result, tables, versions, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            # A write to one of the tables while the query ran means the
+            # result may already be stale
+            if versions != [self._versions.get(x, 0) for x in tables]:
+                return
+            self._backend.put(key, data, tables, now + ttl if ttl else None,
+                              now)
+            self.evictions += self._backend.evict(self.max_entries,
+                                                  self.max_bytes)
+
+    def invalidate(self, *tables):
+        """Drops the cached results that depend on any of the given tables
+        """
+        tables = set(_table_name(x) for x in tables)
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+            self.invalidations += self._backend.invalidate(tables)
+
+    def clear(self):
+        """Drops every cached result
+        """
+        with self._lock:
+            self._backend.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hit_ratio,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._backend),
+                'bytes': self._backend.size,
+            }
+
+    def collect(self):
+        """Returns the cache counters as a list of MetricFamily for
+        dodai.model.metrics.render_prometheus()
+        """
+        stats = self.stats()
+        labels = {'section': self.name}
+        families = []
+        for key, help_ in (('hits', "Queries answered from the cache"),
+                           ('misses', "Queries that were run"),
+                           ('evictions', "Results pushed out of the cache"),
+                           ('invalidations', "Results dropped by writes")):
+            family = MetricFamily('dodai_result_cache_{0}_total'.format(key),
+                                  'counter', help_)
+            families.append(family.add(labels, stats[key]))
+        for key, help_ in (('hit_ratio', "Share of queries that were hits"),
+                           ('entries', "Results in the cache"),
+                           ('bytes', "Pickled bytes in the cache")):
+            family = MetricFamily('dodai_result_cache_{0}'.format(key),
+                                  'gauge', help_)
+            families.append(family.add(labels, stats[key]))
+        return families
+
+    def _after_execute(self, connection, cursor, statement, parameters,
+                       context, executemany):
+        table = written_table(statement)
+        if table:
+            connection.info.setdefault('dodai_written', set()).add(table)
+            self.invalidate(table)
+
+    def _commit(self, connection):
+        tables = connection.info.pop('dodai_written', None)
+        if tables:
+            self.invalidate(*tables)
+
+    def _rollback(self, connection):
+        connection.info.pop('dodai_written', None)
+
+    def after_fork(self):
+        """Makes a new lock and reopens the sqlite file in the child
+        process.  Called automatically after os.fork().
+        """
+        self._lock = threading.Lock()
+        self._backend.after_fork()
@@ -0,0 +1,241 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from contextlib import contextmanager
+from dodai.model import fork
+
+
+class _BasePicker(object):
+    """Base class for the callables that choose which replica serves a read.
+    Keeps a count of the reads that are currently outstanding on each
+    replica.
+    """
+
+    def __init__(self, count):
+        self._lock = threading.Lock()
+        self._outstanding = [0] * count
+
+    def reset(self):
+        """Forgets every outstanding read and makes a new lock.  Used in a
+        child process after os.fork() where the parent's reads do not exist.
+        """
+        self._lock = threading.Lock()
+        self._outstanding = [0] * len(self._outstanding)
+
+    @property
+    def outstanding(self):
+        """A list with the number of reads currently running on each
+        replica
+        """
+        with self._lock:
+            return list(self._outstanding)
+
+    def acquire(self):
+        """Picks a replica, marks a read as outstanding on it and returns
+        its index
+        """
+        with self._lock:
+            index = self._pick()
+            self._outstanding[index] += 1
+            return index
+
+    def hold(self, index):
+        """Marks a read as outstanding on the replica at index
+        """
+        with self._lock:
+            self._outstanding[index] += 1
+
+    def release(self, index):
+        """Marks a read on the replica at index as finished
+        """
+        with self._lock:
+            if self._outstanding[index] > 0:
+                self._outstanding[index] -= 1
+
+    def __call__(self):
+        with self._lock:
+            return self._pick()
+
+
+class RoundRobinPicker(_BasePicker):
+    """Hands out the replicas one after another
+    """
+
+    def __init__(self, count):
+        super(RoundRobinPicker, self).__init__(count)
+        self._next = 0
+
+    def _pick(self):
+        index = self._next
+        self._next = (index + 1) % len(self._outstanding)
+        return index
+
+
+class LeastOutstandingPicker(_BasePicker):
+    """Hands out the replica with the fewest outstanding reads.  Ties go to
+    the replica listed first in the config.
+    """
+
+    def _pick(self):
+        return self._outstanding.index(min(self._outstanding))
+
+
+class RoutingConnection(object):
+    """A connection object that sends writes to a primary and reads to
+    replicas.
+
+    The engine, connection and session attributes are the primary's, so this
+    can be used anywhere a DodaiSqlalchemyConnection is used.  Reads go
+    through the read_engine, read_connection and read_session attributes or
+    the reader() context manager.  When there are no replicas, or inside of
+    read_your_writes(), reads are sent to the primary.
+
+    A read is outstanding on a replica for as long as it holds one of the
+    replica's pooled connections, whichever way it got there.  A replica's
+    active connection (read_connection) holds one until it is closed.
+    """
+
+    def __init__(self, primary, replicas, picker=None):
+        """
+        :param primary: The DodaiSqlalchemyConnection used for writes
+        :param replicas: A list of DodaiSqlalchemyConnection used for reads
+        :param picker: A picker class (RoundRobinPicker by default) or an
+            instance of one
+        """
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.name = primary.name
+        picker = picker or RoundRobinPicker
+        if isinstance(picker, type):
+            picker = picker(len(self.replicas))
+        self._picker = picker
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._watched = False
+        fork.register(self)
+
+    @property
+    def engine(self):
+        return self.primary.engine
+
+    @property
+    def connection(self):
+        return self.primary.connection
+
+    @property
+    def session(self):
+        return self.primary.session
+
+    @property
+    def read_engine(self):
+        """The engine of the connection object that should serve the next
+        read
+        """
+        return self._read_target().engine
+
+    @property
+    def read_connection(self):
+        """The active connection of the connection object that should serve
+        the next read
+        """
+        return self._read_target().connection
+
+    @property
+    def read_session(self):
+        """The active session of the connection object that should serve the
+        next read
+        """
+        return self._read_target().session
+
+    @property
+    def pinned(self):
+        """True when reads in this thread are being sent to the primary
+        """
+        return getattr(self._local, 'pinned', 0) > 0
+
+    def after_fork(self):
+        """Resets the picker in the child process.  The primary and
+        replicas reset themselves.  Called automatically after os.fork().
+        """
+        self._lock = threading.Lock()
+        self._picker.reset()
+
+    @contextmanager
+    def read_your_writes(self):
+        """Sends every read made by this thread inside of the with block to
+        the primary, so that rows just written are visible
+        """
+        self._local.pinned = getattr(self._local, 'pinned', 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.pinned -= 1
+
+    @contextmanager
+    def reader(self):
+        """Yields a new connection from the chosen replica's engine that is
+        closed when the with block ends.  The read is counted as outstanding
+        until then, which is what LeastOutstandingPicker goes by.
+        """
+        if self.pinned or not self.replicas:
+            with self.primary.engine.connect() as connection:
+                yield connection
+            return
+        self._watch()
+        # Held until the pool counts the checkout, so that readers in other
+        # threads do not all pick the same replica in the meantime
+        index = self._picker.acquire()
+        try:
+            connection = self.replicas[index].engine.connect()
+        finally:
+            self._picker.release(index)
+        with connection:
+            yield connection
+
+    def _read_target(self):
+        if self.pinned or not self.replicas:
+            return self.primary
+        self._watch()
+        return self.replicas[self._picker()]
+
+    def _watch(self):
+        """Counts the connections checked out of each replica's pool as
+        outstanding reads on it
+        """
+        if self._watched:
+            return
+        # dodai.model.database imports this module and has to stay free of
+        # sqlalchemy until an engine is made
+        from sqlalchemy import event
+        with self._lock:
+            if self._watched:
+                return
+            for index, replica in enumerate(self.replicas):
+                event.listen(replica.engine, 'checkout', self._checkout(index))
+                event.listen(replica.engine, 'checkin', self._checkin(index))
+            self._watched = True
+
+    def _checkout(self, index):
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            self._picker.hold(index)
+        return checkout
+
+    def _checkin(self, index):
+        def checkin(dbapi_connection, connection_record):
+            self._picker.release(index)
+        return checkin
@@ -0,0 +1,403 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from numbers import Number
+from sqlalchemy import Table
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.sql import Select
+
+
+Partition = namedtuple('Partition', 'index low high last null')
+
+
+def split_range(low, high, count):
+    """Returns count + 1 evenly spaced cut points from low to high, fewer
+    when an integer range has fewer values than partitions
+    """
+    if isinstance(low, int) and isinstance(high, int):
+        count = max(1, min(count, high - low + 1))
+        step = (high - low + 1) / float(count)
+        out = [low + int(round(x * step)) for x in range(count)]
+        return out + [high]
+    # No float() here, so Decimal keys stay Decimals
+    step = (high - low) / count
+    return [low + x * step for x in range(count)] + [high]
+
+
+def split_sample(sample, count):
+    """Returns up to count + 1 distinct cut points at the quantiles of a
+    sample of keys
+    """
+    sample = sorted(sample)
+    if not sample:
+        return []
+    out = []
+    for x in range(count):
+        point = sample[int(x * len(sample) / count)]
+        if not out or point != out[-1]:
+            out.append(point)
+    if sample[-1] != out[-1]:
+        out.append(sample[-1])
+    return out
+
+
+def make_partitions(points):
+    """Turns cut points into Partitions, each from its low point up to but
+    not including its high point except for the last, plus one more for
+    the rows whose key is NULL
+    """
+    out = []
+    if len(points) == 1:
+        out.append(Partition(0, points[0], points[0], True, False))
+    for index in range(len(points) - 1):
+        out.append(Partition(index, points[index], points[index + 1],
+                             index == len(points) - 2, False))
+    out.append(Partition(len(out), None, None, False, True))
+    return out
+
+
+class ScanReport(object):
+    """Progress and throughput of a ParallelScan.  Updated as partitions
+    finish; str() gives a short summary.
+    """
+
+    def __init__(self, partitions, workers, mode):
+        self.partitions = partitions
+        self.workers = workers
+        self.mode = mode
+        self.done = 0
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.finished = None
+        self.partition_rows = {}
+        self.partition_seconds = {}
+        self.worker_rows = {}
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed else 0.0
+
+    @property
+    def busy_seconds(self):
+        """The time the workers spent scanning, added up
+        """
+        return sum(self.partition_seconds.values())
+
+    @property
+    def concurrency(self):
+        """How many partitions were being read at once on average, up to
+        'workers'.  Compare rows_per_second across worker counts to see
+        whether the extra workers actually ran on more cores.
+        """
+        elapsed = self.elapsed
+        return self.busy_seconds / elapsed if elapsed else 0.0
+
+    def _partition(self, partition, rows, seconds, worker):
+        self.done += 1
+        self.partition_rows[partition.index] = rows
+        self.partition_seconds[partition.index] = seconds
+        self.worker_rows[worker] = self.worker_rows.get(worker, 0) + rows
+
+    def __str__(self):
+        return "{0}/{1} partitions, {2} rows in {3:.2f}s ({4:.0f} rows/s) "\
+               "with {5} {6} workers, concurrency {7:.2f}".format(
+                       self.done, self.partitions, self.rows, self.elapsed,
+                       self.rows_per_second, self.workers, self.mode,
+                       self.concurrency)
+
+
+def _scan_process(handle, statement, batch_size):
+    """Runs one partition in a worker process and returns its rows
+    """
+    started = time.perf_counter()
+    rows = []
+    with handle.engine.connect() as connection:
+        result = connection.execution_options(
+                stream_results=True, yield_per=batch_size).execute(statement)
+        for batch in result.partitions(batch_size):
+            rows.extend(tuple(x) for x in batch)
+    return rows, time.perf_counter() - started, os.getpid()
+
+
+class ParallelScan(object):
+    """Reads a whole table or query by splitting it on a key into ranges and
+    reading the ranges at the same time, yielding batches of rows (tuples)
+    as they arrive, in no particular order.
+
+    The key's range is split one of two ways:
+
+        * **minmax**: evenly between the key's smallest and largest value.
+          Good for numeric keys that are spread evenly, like ids.
+        * **quantiles**: at the quantiles of the keys, each read at its
+          offset in key order, which an index on the key makes cheap.
+          Better for skewed keys and needed for keys that are not numbers.
+          Used by 'auto' when the key is not a number.
+
+    Rows whose key is NULL are read as one extra partition.
+
+    With mode 'thread' each worker thread reads with its own pooled
+    connection of the engine and hands over batches through a bounded
+    queue, so memory stays bounded by the queue.  With mode 'process' each
+    partition is read by a worker process from a ConnectionHandle (see
+    dodai.model.handle) and returned whole, so use more partitions to keep
+    them small.  Processes are worth it when turning rows into python
+    objects is the bottleneck, which is the case for sqlite.
+
+    'progress' is called with the ScanReport after each partition, and the
+    report is also kept in the 'report' attribute.
+
+    To use this class::
+
+        scan = get_database.scan('db.warehouse', events, 'id', workers=4,
+                                 mode='process', partitions=32)
+        for batch in scan:
+            write_out(batch)
+        print(scan.report)
+    """
+
+    WORKERS = os.cpu_count() or 1
+    BATCH_SIZE = 1000
+    SAMPLE_SIZE = 10000
+    QUEUE_BATCHES = 4
+    SPLITS = ('auto', 'minmax', 'quantiles')
+    MODES = ('thread', 'process')
+
+    def __init__(self, source, statement, key, partitions=None, workers=None,
+                 mode='thread', split='auto', batch_size=None,
+                 sample_size=None, progress=None):
+        """
+        :param source: A DodaiSqlalchemyConnection or a ConnectionHandle.
+            Process mode needs a ConnectionHandle.
+        :param statement: A sqlalchemy Table or select
+        :param key: The name of the column, or the column, to split on
+        :param partitions: The number of ranges, by default four per worker
+        :param workers: The number of threads or processes
+        :param mode: 'thread' or 'process'
+        :param split: 'auto', 'minmax' or 'quantiles'
+        :param batch_size: The rows in each yielded batch
+        :param sample_size: The most keys the quantiles split reads all
+            of.  With more it reads one key at each cut point.
+        :param progress: A callable called with the ScanReport after each
+            partition
+        """
+        if mode not in self.MODES:
+            raise ValueError("The scan mode '{0}' is not one of "
+                             "{1!r}".format(mode, self.MODES))
+        if split not in self.SPLITS:
+            raise ValueError("The scan split '{0}' is not one of "
+                             "{1!r}".format(split, self.SPLITS))
+        if mode == 'process' and not hasattr(source, 'fingerprint'):
+            raise ValueError("A process scan needs a ConnectionHandle, see "
+                             "GetDatabase.handle()")
+        if isinstance(statement, Table):
+            statement = select(statement)
+        if not isinstance(statement, Select):
+            raise ValueError("A scan needs a sqlalchemy Table or select")
+        if statement._limit_clause is not None or \
+                statement._offset_clause is not None:
+            # Every partition would apply them again
+            raise ValueError("A scan can not read a select with a limit or "
+                             "offset")
+        self._source = source
+        self._statement = statement
+        self._key = statement.selected_columns[key] \
+                    if isinstance(key, str) else key
+        self.workers = workers or self.WORKERS
+        self.partitions = partitions or self.workers * 4
+        self.mode = mode
+        self.split = split
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.sample_size = sample_size or self.SAMPLE_SIZE
+        self._progress = progress
+        self.report = None
+
+    def plan(self):
+        """Returns the Partitions the scan reads
+        """
+        statement = self._statement.order_by(None)
+        key = self._key
+        with self._source.engine.connect() as connection:
+            low, high, count = connection.execute(
+                    statement.with_only_columns(
+                            func.min(key), func.max(key), func.count(key))
+                    .limit(None)).one()
+            if low is None:
+                return make_partitions([])
+            split = self.split
+            if split == 'auto':
+                numeric = isinstance(low, Number) and \
+                          not isinstance(low, bool)
+                split = 'minmax' if numeric else 'quantiles'
+            if split == 'minmax':
+                points = split_range(low, high, self.partitions)
+            else:
+                keys = statement.with_only_columns(key).where(
+                        key.isnot(None))
+                if count <= self.sample_size:
+                    points = split_sample(
+                            connection.execute(keys).scalars().all(),
+                            self.partitions)
+                else:
+                    # One key at each evenly spaced offset, read along the
+                    # index on the key instead of sorting the whole table
+                    keys = keys.order_by(key).limit(1)
+                    sample = [connection.execute(keys.offset(
+                            count * x // self.partitions)).scalar()
+                              for x in range(self.partitions)]
+                    points = split_sample(sample + [high], len(sample) + 1)
+                if len(points) < 2:
+                    points = [low, high] if low != high else [low]
+                points[0] = low
+                points[-1] = high
+        return make_partitions(points)
+
+    def statement(self, partition):
+        """Returns the statement that reads one partition
+        """
+        key = self._key
+        if partition.null:
+            return self._statement.where(key.is_(None))
+        if partition.last:
+            return self._statement.where(key >= partition.low,
+                                         key <= partition.high)
+        return self._statement.where(key >= partition.low,
+                                     key < partition.high)
+
+    def __iter__(self):
+        partitions = self.plan()
+        self.report = ScanReport(len(partitions), self.workers, self.mode)
+        if self.mode == 'process':
+            batches = self._processes(partitions)
+        else:
+            batches = self._threads(partitions)
+        for batch in batches:
+            yield batch
+        self.report.finished = time.perf_counter()
+
+    def _finished(self, partition, rows, seconds, worker):
+        self.report._partition(partition, rows, seconds, worker)
+        if self._progress:
+            self._progress(self.report)
+
+    def _threads(self, partitions):
+        todo = queue.Queue()
+        for partition in partitions:
+            todo.put(partition)
+        out = queue.Queue(self.workers * self.QUEUE_BATCHES)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def work():
+            engine = self._source.engine
+            worker = threading.current_thread().name
+            while not stop.is_set():
+                try:
+                    partition = todo.get_nowait()
+                except queue.Empty:
+                    break
+                started = time.perf_counter()
+                count = 0
+                try:
+                    with engine.connect() as connection:
+                        result = connection.execution_options(
+                                stream_results=True,
+                                yield_per=self.batch_size).execute(
+                                        self.statement(partition))
+                        for batch in result.partitions(self.batch_size):
+                            count += len(batch)
+                            if not put(('rows', [tuple(x) for x in batch])):
+                                return
+                except Exception as e:
+                    put(('error', e))
+                    return
+                put(('done', (partition, count,
+                              time.perf_counter() - started, worker)))
+            put(('exit', None))
+
+        threads = [threading.Thread(target=work, daemon=True,
+                                    name='dodai-scan-{0}'.format(x))
+                   for x in range(min(self.workers, len(partitions)))]
+        for thread in threads:
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                kind, value = out.get()
+                if kind == 'rows':
+                    self.report.rows += len(value)
+                    yield value
+                elif kind == 'done':
+                    self._finished(*value)
+                elif kind == 'exit':
+                    running -= 1
+                else:
+                    raise value
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _processes(self, partitions):
+        pending = list(reversed(partitions))
+        running = {}
+        with ProcessPoolExecutor(self.workers) as executor:
+
+            def submit():
+                while pending and len(running) < self.workers + 1:
+                    partition = pending.pop()
+                    future = executor.submit(
+                            _scan_process, self._source,
+                            self.statement(partition), self.batch_size)
+                    running[future] = partition
+
+            submit()
+            try:
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        partition = running.pop(future)
+                        rows, seconds, pid = future.result()
+                        self.report.rows += len(rows)
+                        self._finished(partition, len(rows), seconds, pid)
+                        submit()
+                        for index in range(0, len(rows), self.batch_size):
+                            yield rows[index:index + self.batch_size]
+            finally:
+                for future in running:
+                    future.cancel()
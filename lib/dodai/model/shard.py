@@ -0,0 +1,181 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import hashlib
+import threading
+from dodai.model import fork
+
+
+def hash_key(key):
+    """Returns the position of a key on the ring: the first eight bytes of
+    its md5 as an integer, so that every process places keys the same way
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    elif not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """A consistent hash ring of names.
+
+    Each name is placed on the ring 'vnodes' times its weight, at the
+    hashes of '<name>#<number>'.  A key belongs to the first name at or
+    after its own hash.  Since the places of a name only depend on the name,
+    adding or removing a name only moves the keys between it and its
+    neighbours, about 1/n of them.
+    """
+
+    VNODES = 160
+
+    def __init__(self, weights, vnodes=None):
+        """
+        :param weights: A dictionary of name to weight.  A name with a
+            weight of 0 gets no keys.
+        :param vnodes: The places on the ring of a name with a weight of 1
+        """
+        self.vnodes = vnodes or self.VNODES
+        self._places = {}
+        self._ring = ((), ())
+        self.weights = {}
+        self.update(weights)
+
+    def update(self, weights):
+        """Rebuilds the ring for a new dictionary of name to weight.  The
+        places of names that stay are reused rather than hashed again.
+        """
+        points = []
+        for name, weight in weights.items():
+            count = int(round(self.vnodes * weight))
+            places = self._places.get(name, [])
+            if len(places) < count:
+                places = places + [hash_key('{0}#{1}'.format(name, x))
+                                   for x in range(len(places), count)]
+                self._places[name] = places
+            points.extend((point, name) for point in places[:count])
+        for name in set(self._places) - set(weights):
+            del self._places[name]
+        points.sort()
+        self.weights = dict(weights)
+        self._ring = (tuple(x[0] for x in points),
+                      tuple(x[1] for x in points))
+
+    def copy(self):
+        """Returns a ring with the same names, weights and places that can
+        be updated without changing this one
+        """
+        ring = type(self)({}, self.vnodes)
+        ring._places = dict(self._places)
+        ring.weights = dict(self.weights)
+        ring._ring = self._ring
+        return ring
+
+    def __len__(self):
+        return len(self._ring[0])
+
+    def __call__(self, key):
+        """Returns the name the key belongs to
+        """
+        points, names = self._ring
+        if not points:
+            raise KeyError("The hash ring is empty")
+        index = bisect.bisect_left(points, hash_key(key))
+        if index == len(points):
+            index = 0
+        return names[index]
+
+    def shares(self):
+        """Returns a dictionary of name to the share of the keyspace it owns
+        """
+        points, names = self._ring
+        out = dict((name, 0.0) for name in self.weights)
+        size = float(2 ** 64)
+        for index, point in enumerate(points):
+            previous = points[index - 1] if index else points[-1] - 2 ** 64
+            out[names[index]] += (point - previous) / size
+        return out
+
+
+class ShardRouter(object):
+    """Routes shard keys, like a tenant id, to the database sections of a
+    group with a consistent HashRing.
+
+    Each section's weight is read from its 'shard_weight' key (1 when not
+    set), so a section with a weight of 2 gets about twice the keys.  When
+    the config changes, update() rebuilds the ring and only the keys next
+    to sections that were added, removed or reweighted move.  The new ring
+    and connections replace the old ones together, so a key is never routed
+    to a section whose connection is not there yet.
+
+    To use this class::
+
+        router = get_database.shard_router('customers')
+        session = router.session(tenant_id)
+
+        # after the config is reloaded
+        get_database.shard_router('customers', router=router)
+    """
+
+    def __init__(self, connections, weights, vnodes=None):
+        """
+        :param connections: A dictionary of section name to
+            DodaiSqlalchemyConnection
+        :param weights: A dictionary of section name to weight
+        :param vnodes: The places on the ring of a section with a weight
+            of 1
+        """
+        self._lock = threading.Lock()
+        self._routes = (HashRing(weights, vnodes), connections)
+        fork.register(self)
+
+    def update(self, connections, weights):
+        """Swaps in new sections and weights.  The new ring is built next to
+        the old one, which keeps routing keys until both are swapped.
+        """
+        with self._lock:
+            ring = self._routes[0].copy()
+            ring.update(weights)
+            self._routes = (ring, connections)
+
+    def after_fork(self):
+        """Makes a new lock in the child process.  Called automatically
+        after os.fork().
+        """
+        self._lock = threading.Lock()
+
+    @property
+    def ring(self):
+        return self._routes[0]
+
+    def section(self, key):
+        """Returns the name of the section the key belongs to
+        """
+        return self._routes[0](key)
+
+    def connection(self, key):
+        """Returns the DodaiSqlalchemyConnection the key belongs to
+        """
+        ring, connections = self._routes
+        return connections[ring(key)]
+
+    def engine(self, key):
+        return self.connection(key).engine
+
+    def session(self, key):
+        return self.connection(key).session
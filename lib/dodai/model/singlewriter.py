@@ -0,0 +1,366 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from urllib.parse import quote
+from sqlalchemy import create_engine
+from sqlalchemy import text
+from sqlalchemy.engine import URL
+from dodai.model import fork
+from dodai.model.pragmas import SqliteProfile
+
+
+class WriterClosed(Exception):
+    """Raised when a write is sent to a SingleWriter that was closed
+    """
+
+
+_STOP = object()
+
+
+class SingleWriter(object):
+    """Reads and writes one sqlite file without 'database is locked'
+    errors: readers share a pool of read-only connections and every write
+    goes through a queue to one writer connection owned by a background
+    thread.
+
+    The file is switched to WAL mode so readers in any number of threads
+    run alongside the writer.  The writer takes whatever writes are queued,
+    up to 'batch_size' of them, and commits them in one transaction, so a
+    burst of writes from many threads costs one commit instead of one each.
+    Each write runs in its own savepoint, so a failing write is rolled back
+    and reported to its caller without failing the rest of the group.  With
+    'max_delay' the writer waits up to that many seconds for a group to
+    fill.
+
+    To use this class::
+
+        manager = get_database('db.events').single_writer(readers=8)
+        manager.write(events.insert(), {'kind': 'click'})
+        rows = manager.read(select(events))
+    """
+
+    READERS = 4
+    BATCH_SIZE = 500
+    QUEUE_SIZE = 10000
+
+    def __init__(self, engine, readers=None, batch_size=None, max_delay=0,
+                 queue_size=None, pragmas=None):
+        """
+        :param engine: A sqlalchemy engine of a sqlite file.  The writer
+            keeps one of its connections.
+        :param readers: The number of read-only connections
+        :param batch_size: The most writes committed together
+        :param max_delay: Seconds the writer waits for more writes before
+            committing a group
+        :param queue_size: Writes that may wait before submit() blocks
+        :param pragmas: (name, value) pairs of a SqliteProfile that are run
+            on the reader connections too, except journal_mode
+        """
+        if engine.dialect.name != 'sqlite' or not engine.url.database or \
+                engine.url.database == ':memory:':
+            raise ValueError("A single writer needs a sqlite file, not "
+                             "'{0}'".format(engine.url))
+        self.engine = engine
+        self.readers = readers or self.READERS
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.max_delay = max_delay
+        self.queue_size = queue_size or self.QUEUE_SIZE
+        self._pragmas = tuple((key, val) for key, val in (pragmas or ())
+                              if key != 'journal_mode')
+        self.writes = 0
+        self.failed = 0
+        self.commits = 0
+        self._reader_engine = None
+        self._lock = threading.Lock()
+        self._setup()
+        self._start()
+        atexit.register(self.close)
+        fork.register(self)
+
+    def _setup(self):
+        # Held from the closed check to the put of a write, so that no write
+        # is queued behind the stop
+        self._submit_lock = threading.Lock()
+        self._queue = queue.Queue(self.queue_size)
+        self._ready = threading.Event()
+        self._error = None
+        self._closed = False
+        self._thread = None
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="dodai-single-writer")
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            self._closed = True
+            raise self._error
+
+    @property
+    def reader_engine(self):
+        """The sqlalchemy engine of the read-only connections
+        """
+        if self._reader_engine is None:
+            with self._lock:
+                if self._reader_engine is None:
+                    self._reader_engine = self._make_reader_engine()
+        return self._reader_engine
+
+    def _make_reader_engine(self):
+        path = os.path.abspath(self.engine.url.database)
+        url = URL.create(self.engine.url.drivername,
+                         database='file:' + quote(path),
+                         query={'mode': 'ro', 'uri': 'true'})
+        engine = create_engine(url, pool_size=self.readers, max_overflow=0)
+        if self._pragmas:
+            SqliteProfile(self._pragmas).install(engine)
+        return engine
+
+    @contextmanager
+    def reader(self):
+        """Yields a sqlalchemy Connection that can only read
+        """
+        with self.reader_engine.connect() as connection:
+            yield connection
+
+    def read(self, statement, params=None):
+        """Runs a query on a reader connection and returns its rows
+        """
+        with self.reader() as connection:
+            return connection.execute(_statement(statement),
+                                      params).fetchall()
+
+    def submit(self, work, params=None, timeout=None):
+        """Queues a write and returns a concurrent.futures.Future of it.
+        The work is a statement, run with the params, whose result is the
+        number of rows it changed, or a callable that is called with the
+        writer's sqlalchemy Connection and whose result is what it returns.
+        A callable must not commit or roll back.  When the queue is full
+        this waits up to timeout seconds and raises queue.Full.
+        """
+        future = Future()
+        with self._submit_lock:
+            if self._closed:
+                raise WriterClosed("The single writer is closed")
+            self._queue.put((work, params, future), timeout=timeout)
+        return future
+
+    def write(self, work, params=None, timeout=None):
+        """Queues a write, waits for its group to be committed and returns
+        its result.  Raises the write's error if it failed.
+        """
+        return self.submit(work, params, timeout).result(timeout)
+
+    def close(self):
+        """Commits the queued writes, stops the writer and closes all
+        connections
+        """
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._thread is not None:
+                self._queue.put((_STOP, None, None))
+        atexit.unregister(self.close)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._reader_engine is not None:
+            self._reader_engine.dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def stats(self):
+        return {
+            'writes': self.writes,
+            'failed': self.failed,
+            'commits': self.commits,
+            'writes_per_commit': self.writes / self.commits
+                                 if self.commits else None,
+            'queued': self._queue.qsize(),
+        }
+
+    def _run(self):
+        try:
+            connection = self.engine.connect().execution_options(
+                    isolation_level='AUTOCOMMIT')
+            connection.exec_driver_sql("PRAGMA journal_mode = wal").fetchall()
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            with connection:
+                stop = False
+                while not stop:
+                    group, stop = self._next_group()
+                    if group:
+                        self._commit(connection, group)
+        finally:
+            self._drain()
+
+    def _drain(self):
+        """Fails the writes left in the queue once the writer stops, either
+        at close() or because an error got out of the writer thread
+        """
+        self._closed = True
+        # Draining makes room for a submit() blocked on a full queue, which
+        # then releases the lock
+        self._fail_queued()
+        with self._submit_lock:
+            self._fail_queued()
+
+    def _fail_queued(self):
+        while True:
+            try:
+                work, params, future = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if future is not None and future.set_running_or_notify_cancel():
+                self.failed += 1
+                future.set_exception(WriterClosed(
+                        "The single writer is closed"))
+
+    def _next_group(self):
+        group = []
+        item = self._queue.get()
+        deadline = time.monotonic() + self.max_delay
+        while item[0] is not _STOP:
+            group.append(item)
+            if len(group) >= self.batch_size:
+                return group, False
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                return group, False
+        return group, True
+
+    def _commit(self, connection, group):
+        """Runs a group of writes in one transaction.  The sqlite driver's
+        own transaction handling does not get along with savepoints, so the
+        writer connection is in autocommit mode and the transaction is
+        handled here.
+        """
+        results = []
+        begun = False
+        try:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            begun = True
+            for work, params, future in group:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                connection.exec_driver_sql("SAVEPOINT dodai_write")
+                try:
+                    out = self._write(connection, work, params)
+                except Exception as e:
+                    connection.exec_driver_sql(
+                            "ROLLBACK TO SAVEPOINT dodai_write")
+                    connection.exec_driver_sql(
+                            "RELEASE SAVEPOINT dodai_write")
+                    results.append((future, e, True))
+                else:
+                    connection.exec_driver_sql(
+                            "RELEASE SAVEPOINT dodai_write")
+                    results.append((future, out, False))
+            connection.exec_driver_sql("COMMIT")
+        except Exception as e:
+            if begun:
+                self._rollback(connection)
+            self._fail(group, results, e)
+            return
+        except BaseException:
+            if begun:
+                self._rollback(connection)
+            self._fail(group, results, WriterClosed(
+                    "The single writer stopped"))
+            raise
+        self.commits += 1
+        for future, out, failed in results:
+            if failed:
+                self.failed += 1
+                future.set_exception(out)
+            else:
+                self.writes += 1
+                future.set_result(out)
+
+    @staticmethod
+    def _rollback(connection):
+        try:
+            connection.exec_driver_sql("ROLLBACK")
+        except Exception:
+            # sqlite may have rolled back already
+            pass
+
+    def _fail(self, group, results, error):
+        """Fails every write of a group that was not committed, including
+        those that never ran because the transaction could not start
+        """
+        ran = set()
+        for future, out, failed in results:
+            ran.add(future)
+            self.failed += 1
+            future.set_exception(out if failed else error)
+        for work, params, future in group:
+            if future in ran or future.done():
+                continue
+            # The write that raised is still marked as running
+            if future.running() or future.set_running_or_notify_cancel():
+                self.failed += 1
+                future.set_exception(error)
+
+    @staticmethod
+    def _write(connection, work, params):
+        if callable(work):
+            return work(connection)
+        return connection.execute(_statement(work), params).rowcount
+
+    def after_fork(self):
+        """Drops the queued writes in the child process, since the parent
+        commits them, and starts a new writer.  Called automatically after
+        os.fork().
+        """
+        closed = self._closed
+        if self._reader_engine is not None:
+            fork.inherit(self._reader_engine.pool)
+            self._reader_engine.dispose(close=False)
+        self._lock = threading.Lock()
+        self._setup()
+        self._closed = closed
+        if not closed:
+            self._start()
+
+
+def _statement(statement):
+    if isinstance(statement, str):
+        return text(statement)
+    return statement
@@ -0,0 +1,168 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import tuple_
+from sqlalchemy.sql import Select
+
+
+class StreamQuery(object):
+    """Callable object that runs a query and yields its rows without ever
+    holding more than 'fetch_size' of them in memory.
+
+    The rows are read one of three ways:
+
+        * **server_side**: a server side cursor (stream_results) read
+          'fetch_size' rows at a time.  Used when the dialect supports them,
+          like postgresql and mysql.
+        * **keyset**: the query is run again for every 'fetch_size' rows,
+          ordered by 'key' and starting after the last key seen.  Used when
+          the dialect has no server side cursors and a key is given for a
+          select without a limit or offset.  The statement has to be a
+          sqlalchemy select without a limit or offset and the key unique.
+        * **cursor**: the DBAPI cursor is read with fetchmany.  Used
+          otherwise.  This only keeps memory bounded for drivers that do not
+          read the whole result up front, which sqlite's does not.
+
+    To use this class::
+
+        database = get_database('db.blue')
+        for batch in database.stream(select(events), batch_size=500,
+                                     key='id'):
+            write_out(batch)
+    """
+
+    FETCH_SIZE = 1000
+    METHODS = ('auto', 'server_side', 'keyset', 'cursor')
+    NEEDS_SELECT = "A keyset stream needs a sqlalchemy select statement"
+    NEEDS_KEY = "A keyset stream needs a key"
+    NO_LIMIT = "A keyset stream can not page a select with a limit or offset"
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def __call__(self, statement, params=None, fetch_size=None,
+                 batch_size=None, key=None, method='auto'):
+        """
+        :param statement: A sqlalchemy select or text statement
+        :param params: The parameters of the statement
+        :param fetch_size: The number of rows read from the database at a
+            time
+        :param batch_size: When given, lists of this many rows are yielded
+            instead of single rows
+        :param key: A column name, column or a tuple of them that uniquely
+            orders the rows.  Needed for the keyset method.
+        :param method: One of 'auto', 'server_side', 'keyset' or 'cursor'
+        """
+        if method not in self.METHODS:
+            raise ValueError("The stream method '{0}' is not one of "
+                             "{1!r}".format(method, self.METHODS))
+        fetch_size = fetch_size or batch_size or self.FETCH_SIZE
+        if method == 'auto':
+            method = self._default_method(statement, key)
+        if method == 'keyset':
+            if not isinstance(statement, Select):
+                raise ValueError(self.NEEDS_SELECT)
+            if key is None:
+                raise ValueError(self.NEEDS_KEY)
+            if self._limited(statement):
+                raise ValueError(self.NO_LIMIT)
+        rows = getattr(self, '_{0}'.format(method))(statement, params,
+                                                    fetch_size, key)
+        if batch_size:
+            return self._batches(rows, batch_size)
+        return self._rows(rows)
+
+    def _default_method(self, statement, key):
+        if self._engine.dialect.supports_server_side_cursors:
+            return 'server_side'
+        if key is not None and isinstance(statement, Select) and \
+                not self._limited(statement):
+            return 'keyset'
+        return 'cursor'
+
+    @staticmethod
+    def _limited(statement):
+        # The pages have their own limit and would repeat the offset
+        return statement._limit_clause is not None or \
+               statement._offset_clause is not None
+
+    def _rows(self, partitions):
+        for partition in partitions:
+            for row in partition:
+                yield row
+
+    def _batches(self, partitions, batch_size):
+        out = []
+        for partition in partitions:
+            for row in partition:
+                out.append(row)
+                if len(out) >= batch_size:
+                    yield out
+                    out = []
+        if out:
+            yield out
+
+    def _server_side(self, statement, params, fetch_size, key):
+        with self._engine.connect() as connection:
+            connection = connection.execution_options(
+                    stream_results=True, max_row_buffer=fetch_size)
+            result = connection.execute(statement, params)
+            try:
+                for partition in result.partitions(fetch_size):
+                    yield partition
+            finally:
+                result.close()
+
+    def _cursor(self, statement, params, fetch_size, key):
+        with self._engine.connect() as connection:
+            result = connection.execute(statement, params)
+            try:
+                for partition in result.partitions(fetch_size):
+                    yield partition
+            finally:
+                result.close()
+
+    def _keyset(self, statement, params, fetch_size, key):
+        keys = key if isinstance(key, (tuple, list)) else (key,)
+        columns = [self._column(statement, x) for x in keys]
+        names = [column.key for column in columns]
+        if len(columns) > 1:
+            order = tuple_(*columns)
+        else:
+            order = columns[0]
+        ordered = statement.order_by(None).order_by(*columns)\
+                           .limit(fetch_size)
+        last = None
+        with self._engine.connect() as connection:
+            while True:
+                page = ordered
+                if last is not None:
+                    page = page.where(order > (tuple_(*last) if len(last) > 1
+                                               else last[0]))
+                rows = connection.execute(page, params).all()
+                if not rows:
+                    break
+                yield rows
+                if len(rows) < fetch_size:
+                    break
+                mapping = rows[-1]._mapping
+                last = [mapping[name] for name in names]
+
+    def _column(self, statement, key):
+        if isinstance(key, str):
+            return statement.selected_columns[key]
+        return key
@@ -0,0 +1,211 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+from dodai.model import fork
+
+
+class EngineManager(object):
+    """Hands out the connections of a config with many database sections,
+    like one per tenant, while keeping at most 'max_engines' engines and
+    'max_connections' pooled DBAPI connections alive across all of them.
+
+    Engines are made the first time a section is asked for.  Every time a
+    section is asked for, or one of its pooled connections is checked out,
+    it becomes the most recently used.  When a new engine would go over
+    'max_engines', or the open connections of all engines go over
+    'max_connections', the least recently used engines are disposed and
+    forgotten by GetDatabase; the next call for such a section makes a new
+    engine.  Connections checked out of an evicted engine keep working and
+    are closed when they are returned, and its listeners are removed so it
+    no longer counts.
+
+    Set 'pool_size' and 'max_overflow' in the sections to keep each pool
+    small; the cap on open connections is checked when a section is asked
+    for and whenever a new DBAPI connection is opened.
+
+    To use this class::
+
+        tenants = EngineManager(get_database, max_engines=200,
+                                max_connections=1000)
+        with tenants('db.tenant.{0}'.format(tenant_id)).engine.begin() as c:
+            ...
+    """
+
+    MAX_ENGINES = 100
+
+    def __init__(self, get_database, max_engines=None, max_connections=None):
+        """
+        :param get_database: The dodai.model.database.GetDatabase of the
+            config
+        :param max_engines: The most engines kept alive
+        :param max_connections: The most pooled DBAPI connections kept open
+            across all engines, or None for no limit
+        """
+        self._get_database = get_database
+        self.max_engines = max_engines or self.MAX_ENGINES
+        self.max_connections = max_connections
+        self._live = OrderedDict()
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+        fork.register(self)
+
+    def __call__(self, name, environment=None):
+        """Returns the DodaiSqlalchemyConnection of a section or group name,
+        making its engine if needed
+        """
+        connection = self._get_database(name, environment)
+        with self._lock:
+            if connection.name in self._live:
+                self._live.move_to_end(connection.name)
+                victims = []
+            else:
+                self._live[connection.name] = connection
+                self._watch(connection)
+                victims = self._victims(connection.name)
+        self._evict(victims)
+        return connection
+
+    def _watch(self, connection):
+        from sqlalchemy import event
+        name = connection.name
+        engine = connection.engine
+
+        def on_checkout(*args):
+            with self._lock:
+                if self._live.get(name) is connection:
+                    self._live.move_to_end(name)
+
+        def on_connect(*args):
+            if self.max_connections is not None:
+                with self._lock:
+                    if self._live.get(name) is not connection:
+                        # An evicted engine does not count against the cap
+                        return
+                    victims = self._victims(name)
+                self._evict(victims)
+        listeners = (('checkout', on_checkout), ('connect', on_connect))
+        for identifier, listener in listeners:
+            event.listen(engine, identifier, listener)
+        self._listeners[connection] = (engine, listeners)
+
+    def _unwatch(self, connection):
+        from sqlalchemy import event
+        with self._lock:
+            engine, listeners = self._listeners.pop(connection, (None, ()))
+        for identifier, listener in listeners:
+            event.remove(engine, identifier, listener)
+
+    def _oldest(self, keep):
+        """Returns the least recently used section name other than 'keep',
+        or None
+        """
+        for name in self._live:
+            if name != keep:
+                return name
+        return None
+
+    def _victims(self, keep):
+        """Takes the least recently used sections off the live list until
+        the limits are met, never taking 'keep'.  Called with the lock.
+        """
+        out = []
+        while len(self._live) > self.max_engines:
+            name = self._oldest(keep)
+            if name is None:
+                break
+            out.append(self._live.pop(name))
+        if self.max_connections is not None:
+            total = sum(self._open(x) for x in self._live.values())
+            while total > self.max_connections:
+                name = self._oldest(keep)
+                if name is None:
+                    break
+                connection = self._live.pop(name)
+                total -= self._open(connection)
+                out.append(connection)
+        return out
+
+    def _evict(self, connections):
+        for connection in connections:
+            self._unwatch(connection)
+            if not self._get_database.discard(connection.name,
+                                              connection=connection):
+                connection.dispose()
+        if connections:
+            with self._lock:
+                self.evictions += len(connections)
+
+    @staticmethod
+    def _open(connection):
+        """Returns the number of DBAPI connections the engine's pool holds,
+        checked in or out
+        """
+        pool = connection.engine.pool
+        try:
+            return pool.checkedin() + pool.checkedout()
+        except (AttributeError, NotImplementedError):
+            return 0
+
+    def evict(self, name, environment=None):
+        """Disposes the engine of a section now.  Returns False when it was
+        not alive.
+        """
+        connection = self._get_database(name, environment)
+        with self._lock:
+            connection = self._live.pop(connection.name, None)
+        if connection is None:
+            return False
+        self._evict([connection])
+        return True
+
+    def close(self):
+        """Disposes every live engine
+        """
+        with self._lock:
+            connections = list(self._live.values())
+            self._live.clear()
+        self._evict(connections)
+
+    def live(self):
+        """Returns the names of the sections with a live engine, least
+        recently used first
+        """
+        with self._lock:
+            return list(self._live)
+
+    def open_connections(self):
+        """Returns the number of DBAPI connections open across the live
+        engines
+        """
+        with self._lock:
+            return sum(self._open(x) for x in self._live.values())
+
+    def stats(self):
+        return {
+            'engines': len(self._live),
+            'connections': self.open_connections(),
+            'evictions': self.evictions,
+        }
+
+    def after_fork(self):
+        """Makes a new lock in the child process.  The connections clean up
+        their own inherited pools.  Called automatically after os.fork().
+        """
+        self._lock = threading.Lock()
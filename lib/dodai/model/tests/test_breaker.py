@@ -0,0 +1,193 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from dodai.model.breaker import BreakerMetrics
+from dodai.model.breaker import CircuitBreaker
+from dodai.model.breaker import CircuitOpen
+from dodai.model.database import GetDatabase
+from dodai.model.metrics import render_prometheus
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _Clock()
+        self.breaker = CircuitBreaker('db.blue', failures=2, reset=10,
+                                      clock=self.clock)
+
+    def _fail(self):
+        def fail():
+            raise IOError("down")
+        self.assertRaises(IOError, self.breaker.call, fail)
+
+    def test_opens(self):
+        self._fail()
+        self.assertEqual('closed', self.breaker.state)
+        self._fail()
+        self.assertEqual('open', self.breaker.state)
+        self.assertRaises(CircuitOpen, self.breaker.call, lambda: 1)
+        self.assertEqual(1, self.breaker.stats()['rejected'])
+
+    def test_success_resets_count(self):
+        self._fail()
+        self.assertEqual(1, self.breaker.call(lambda: 1))
+        self._fail()
+        self.assertEqual('closed', self.breaker.state)
+
+    def test_half_open(self):
+        self._fail()
+        self._fail()
+        self.clock.now += 10
+        self.assertEqual('half_open', self.breaker.state)
+        self.breaker.allow()
+        # Only one trial at a time
+        self.assertRaises(CircuitOpen, self.breaker.allow)
+        self.breaker.success()
+        self.assertEqual('closed', self.breaker.state)
+
+    def test_half_open_failure(self):
+        self._fail()
+        self._fail()
+        self.clock.now += 10
+        self._fail()
+        self.assertEqual('open', self.breaker.state)
+        self.assertEqual(2, self.breaker.stats()['opened'])
+
+    def test_metrics(self):
+        self._fail()
+        self._fail()
+        out = render_prometheus(BreakerMetrics([self.breaker]))
+        self.assertIn('dodai_circuit_breaker_state{section="db.blue",'
+                      'state="open"} 1', out)
+        self.assertIn('dodai_circuit_breaker_state{section="db.blue",'
+                      'state="closed"} 0', out)
+        self.assertIn('dodai_circuit_breaker_failures_total'
+                      '{section="db.blue"} 2', out)
+
+
+class TestBlackhole(unittest.TestCase):
+    """A listening socket that never accepts or answers stands in for a
+    database that is down
+    """
+
+    TIMEOUT = 0.2
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(0)
+        self.address = self.server.getsockname()
+
+    def tearDown(self):
+        self.server.close()
+
+    def _handshake(self):
+        client = socket.create_connection(self.address, self.TIMEOUT)
+        try:
+            return client.recv(1)
+        finally:
+            client.close()
+
+    def test_fails_fast_when_open(self):
+        breaker = CircuitBreaker('db.blackhole', failures=2, reset=60)
+        for x in range(2):
+            started = time.perf_counter()
+            self.assertRaises(socket.timeout, breaker.call, self._handshake)
+            self.assertTrue(time.perf_counter() - started >= self.TIMEOUT)
+        self.assertEqual('open', breaker.state)
+        started = time.perf_counter()
+        for x in range(100):
+            self.assertRaises(CircuitOpen, breaker.call, self._handshake)
+        self.assertLess((time.perf_counter() - started) / 100, 0.001)
+
+
+class TestSectionBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.missing = os.path.join(self.directory, 'missing')
+        self.get_database = GetDatabase.load({
+            'db.down': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.missing, 'down.sqlite'),
+                'breaker_failures': '2',
+                'breaker_reset': '0.2'
+            },
+            'db.plain': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'plain.sqlite')
+            },
+            'db.bad': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'bad.sqlite'),
+                'breaker_failures': '-1'
+            },
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _select(self, connection):
+        with connection.engine.connect() as db:
+            return db.execute(text("SELECT 1")).scalar()
+
+    def test_breaker(self):
+        connection = self.get_database('db.down')
+        for x in range(2):
+            self.assertRaises(OperationalError, self._select, connection)
+        self.assertEqual('open', connection.breaker.state)
+        self.assertRaises(CircuitOpen, self._select, connection)
+        # The database comes back and the trial after the reset closes it
+        os.mkdir(self.missing)
+        time.sleep(0.25)
+        self.assertEqual(1, self._select(connection))
+        self.assertEqual('closed', connection.breaker.state)
+
+    def test_no_breaker(self):
+        connection = self.get_database('db.plain')
+        self.assertIsNone(connection.breaker)
+        self.assertIsNone(self.get_database.spec('db.plain').breaker)
+        self.assertEqual(1, self._select(connection))
+
+    def test_spec(self):
+        self.assertEqual((2, 0.2), self.get_database.spec('db.down').breaker)
+
+    def test_bad_option(self):
+        self.assertRaises(ValueError, self.get_database, 'db.bad')
+
+
+if __name__ == '__main__':
+    unittest.main()
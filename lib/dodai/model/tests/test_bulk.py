@@ -0,0 +1,144 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import text
+from dodai.model.bulk import BulkLoad
+from dodai.model.bulk import _CopyBuffer
+from dodai.model.database import GetDatabase
+
+
+class TestBulkLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+            },
+        })
+        self.database = self.get_database('db.blue')
+        self.metadata = MetaData()
+        self.table = Table('foo', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('name', String(20)))
+        self.metadata.create_all(self.database.engine)
+
+    def tearDown(self):
+        self.database.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def _rows(self):
+        with self.database.engine.connect() as connection:
+            return connection.execute(text(
+                    "SELECT id, name FROM foo ORDER BY id")).all()
+
+    def test_tuples(self):
+        rows = ((x, 'name{0}'.format(x)) for x in range(2500))
+        result = self.database.bulk_load(self.table, rows, batch_size=1000)
+        self.assertEqual(result.method, 'values')
+        self.assertEqual(result.rows, 2500)
+        self.assertEqual(result.batches, 3)
+        self.assertIsNotNone(result.rows_per_second)
+        out = self._rows()
+        self.assertEqual(len(out), 2500)
+        self.assertEqual(tuple(out[-1]), (2499, 'name2499'))
+
+    def test_dicts_by_name(self):
+        rows = [{'name': 'a', 'id': 1}, {'name': None, 'id': 2}]
+        result = self.database.bulk_load('foo', rows,
+                                         method='executemany')
+        self.assertEqual(result.rows, 2)
+        self.assertEqual([tuple(x) for x in self._rows()],
+                         [(1, 'a'), (2, None)])
+
+    def test_one_column(self):
+        self.database.bulk_load('foo', [{'id': 1}, {'id': 2}])
+        self.assertEqual([tuple(x) for x in self._rows()],
+                         [(1, None), (2, None)])
+
+    def test_parameter_limit(self):
+        load = BulkLoad(self.database.engine)
+        load.SQLITE_MAX_VARIABLES = load.SQLITE_MAX_VARIABLES_NEW = 10
+        statements = []
+        execute = load._values_statement
+
+        def values_statement(target, columns, count):
+            statements.append(count)
+            return execute(target, columns, count)
+        load._values_statement = values_statement
+        result = load(self.table, ((x, None) for x in range(23)))
+        self.assertEqual(result.batches, 1)
+        self.assertEqual(statements, [5, 5, 5, 5, 3])
+        self.assertEqual(len(self._rows()), 23)
+
+    def test_one_transaction(self):
+        rows = [(1, 'a'), (2, 'b'), (1, 'duplicate')]
+        with self.assertRaises(Exception):
+            self.database.bulk_load(self.table, rows, batch_size=1)
+        self.assertEqual(self._rows(), [])
+
+    def test_progress(self):
+        out = []
+        self.database.bulk_load(self.table, [(x, None) for x in range(10)],
+                                batch_size=4,
+                                progress=lambda x: out.append(x.rows))
+        self.assertEqual(out, [4, 8, 10])
+
+    def test_empty(self):
+        result = self.database.bulk_load(self.table, [])
+        self.assertEqual(result.rows, 0)
+
+    def test_empty_without_columns(self):
+        result = self.database.bulk_load('foo', iter([]))
+        self.assertEqual('foo', result.table)
+        self.assertEqual(0, result.rows)
+
+    def test_unknown_columns(self):
+        with self.assertRaises(ValueError):
+            self.database.bulk_load('foo', [(1, 'a')])
+
+    def test_bad_method(self):
+        with self.assertRaises(ValueError):
+            self.database.bulk_load(self.table, [], method='magic')
+
+
+class TestCopyBuffer(unittest.TestCase):
+
+    def test_read(self):
+        buffer = _CopyBuffer([(1, 'a\tb'), (None, 'c\\d\n')])
+        self.assertEqual(buffer.read(3), '1\ta')
+        self.assertEqual(buffer.read(), '\\tb\n\\N\tc\\\\d\\n\n')
+        self.assertEqual(buffer.read(), '')
+
+    def test_bytes(self):
+        buffer = _CopyBuffer([(1, b'\x00\xffa'), (2, bytearray(b'\\'))])
+        self.assertEqual(buffer.read(), '1\t\\\\x00ff61\n2\t\\\\x5c\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+from dodai.model.catalog import PrefixTrie
+from dodai.model.catalog import SectionCatalog
+from dodai.model.database import DatabaseSectionConnectionValidator
+from dodai.model.database import FindDatabaseSectionTrigger
+from dodai.model.database import GetAllDatabaseSections
+from dodai.model.database import GetDatabase
+from dodai.validate.role import IsValidRole
+
+
+class TestPrefixTrie(unittest.TestCase):
+
+    def test_prefix(self):
+        trie = PrefixTrie(['db.b', 'server', 'db.a', 'dbx', 'db.a'])
+        self.assertEqual(('db.b', 'db.a', 'dbx'), trie('db'))
+        self.assertEqual(('db.b', 'db.a'), trie('db.'))
+        self.assertEqual(('db.a',), trie('db.a'))
+        self.assertEqual((), trie('db.c'))
+        self.assertEqual(4, len(trie))
+        self.assertEqual(4, len(trie()))
+        self.assertTrue('dbx' in trie)
+
+
+class TestSectionCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = SectionCatalog(['default', 'db.a', 'db.b', 'db.c'])
+        self.catalog.add_database('db.a', 'shop', 'prod', 'primary')
+        self.catalog.add_database('db.b', 'shop', 'prod', 'replica')
+        self.catalog.add_database('db.c', 'shop', 'dev', 'primary')
+
+    def test_queries(self):
+        self.assertEqual(('db.a', 'db.b', 'db.c'), self.catalog.databases())
+        self.assertEqual(('db.a', 'db.b', 'db.c'), self.catalog.group('shop'))
+        self.assertEqual(('db.a', 'db.b'),
+                         self.catalog.group('shop', 'prod'))
+        self.assertEqual(('db.b',),
+                         self.catalog.group('shop', 'prod', 'replica'))
+        self.assertEqual(('db.a', 'db.c'),
+                         self.catalog.group('shop', role='primary'))
+        self.assertEqual(('db.c',), self.catalog.environment('dev'))
+        self.assertEqual(('shop',), self.catalog.groups())
+        self.assertEqual(('default',), self.catalog.prefix('def'))
+
+    def test_negative_cached(self):
+        self.assertEqual((), self.catalog.group('nope', 'prod'))
+        self.assertEqual((), self.catalog.prefix('x'))
+        self.assertTrue(('group', 'nope', 'prod', None) in
+                        self.catalog._results)
+        self.assertTrue(self.catalog.group('shop') is
+                        self.catalog.group('shop'))
+
+
+class _CountingValidator(object):
+
+    def __init__(self, validate):
+        self._validate = validate
+        self.names = []
+
+    def __call__(self, section_name, raise_errors=True):
+        self.names.append(section_name)
+        return self._validate(section_name, raise_errors)
+
+
+class TestGetAllDatabaseSectionsCatalog(unittest.TestCase):
+
+    def _load(self, sections):
+        validate = DatabaseSectionConnectionValidator.load(
+                sections, FindDatabaseSectionTrigger(sections))
+        counting = _CountingValidator(validate)
+        return counting, GetAllDatabaseSections(sections, counting,
+                                                IsValidRole.load(sections))
+
+    def test_only_prefixed_sections_validated(self):
+        sections = {
+            'server': {'environment': 'prod'},
+            'logging': {'level': 'debug'},
+            'db.a': {'dialect': 'sqlite', 'filename': '/tmp/a.sqlite',
+                     'group': 'shop', 'environment': 'prod'},
+        }
+        counting, get_all = self._load(sections)
+        data = get_all()
+        self.assertEqual(['db.a'], counting.names)
+        self.assertEqual(('db.a',), data['catalog'].group('shop', 'prod'))
+
+    def test_built_once_without_database_sections(self):
+        counting, get_all = self._load({'db.x': {'ignore': 'true'},
+                                        'server': {}})
+        get_all()
+        get_all()
+        self.assertEqual(['db.x'], counting.names)
+        self.assertEqual({}, get_all()['names'])
+
+    def test_get_database_catalog(self):
+        get_database = GetDatabase.load({
+            'db.a': {'dialect': 'sqlite', 'filename': '/tmp/a.sqlite',
+                     'group': 'shop', 'environment': 'dev'},
+        })
+        self.assertEqual(('db.a',), get_database.catalog.databases())
+        self.assertEqual(['db.a'], get_database.group_sections('shop'))
+        self.assertRaises(KeyError, get_database.group_sections, 'shop',
+                          'prod')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from array import array
+from sqlalchemy import text
+from dodai.model import columnar
+from dodai.model.columnar import ColumnBuffer
+from dodai.model.database import GetDatabase
+
+
+class TestColumnBuffer(unittest.TestCase):
+
+    def test_ints(self):
+        column = ColumnBuffer('a')
+        column.extend((1, 2))
+        column.extend((3,))
+        self.assertEqual(column.values, array('q', [1, 2, 3]))
+        self.assertIsNone(column.mask)
+
+    def test_nulls(self):
+        column = ColumnBuffer('a')
+        column.extend((1.5, None))
+        column.extend((2.5,))
+        self.assertEqual(column.values, array('d', [1.5, 0, 2.5]))
+        self.assertEqual(column.mask, bytearray([0, 1, 0]))
+        self.assertTrue(column.is_null(1))
+        self.assertEqual(column.tolist(), [1.5, None, 2.5])
+
+    def test_leading_nulls(self):
+        column = ColumnBuffer('a')
+        column.extend((None, None))
+        column.extend((7, None))
+        self.assertEqual(column.values, array('q', [0, 0, 7, 0]))
+        self.assertEqual(column.mask, bytearray([1, 1, 0, 1]))
+
+    def test_int_becomes_float(self):
+        column = ColumnBuffer('a')
+        column.extend((1, 2))
+        column.extend((3, 4.5))
+        self.assertEqual(column.typecode, 'd')
+        self.assertEqual(column.values, array('d', [1, 2, 3, 4.5]))
+
+    def test_becomes_list(self):
+        column = ColumnBuffer('a')
+        column.extend((1, None))
+        column.extend((2, 'three'))
+        self.assertIsNone(column.typecode)
+        self.assertEqual(column.values, [1, None, 2, 'three'])
+
+    def test_strings(self):
+        column = ColumnBuffer('a')
+        column.extend(('x', None))
+        self.assertEqual(column.values, ['x', None])
+        self.assertEqual(column.mask, bytearray([0, 1]))
+
+    def test_typecode(self):
+        column = ColumnBuffer('a', 'd')
+        column.extend((1, 2))
+        self.assertEqual(column.values, array('d', [1.0, 2.0]))
+
+
+class TestFetchColumns(unittest.TestCase):
+
+    def setUp(self):
+        get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': ':memory:',
+            },
+        })
+        self.database = get_database('db.blue')
+        with self.database.engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE prices (day INT, close REAL, note TEXT)"))
+            connection.execute(text(
+                "WITH RECURSIVE x(n) AS (SELECT 1 UNION ALL "
+                "SELECT n + 1 FROM x WHERE n < 2500) "
+                "INSERT INTO prices SELECT n, "
+                "CASE WHEN n % 10 = 0 THEN NULL ELSE n * 0.5 END, "
+                "'note' FROM x"))
+
+    def _fetch(self, **kwargs):
+        return self.database.fetch_columns(
+                text("SELECT day, close, note FROM prices ORDER BY day"),
+                **kwargs)
+
+    def test_fetch(self):
+        result = self._fetch(chunk_size=1000)
+        self.assertEqual(len(result), 2500)
+        self.assertEqual(result.names, ['day', 'close', 'note'])
+        self.assertEqual(result['day'].typecode, 'q')
+        self.assertEqual(result['close'].typecode, 'd')
+        self.assertEqual(result['day'][-1], 2500)
+        self.assertIsNone(result.mask('day'))
+        self.assertEqual(sum(result.mask('close')), 250)
+        self.assertEqual(result['note'][0], 'note')
+        self.assertIsNone(result.to_dict()['close'][9])
+
+    def test_typecodes(self):
+        result = self._fetch(typecodes={'day': 'd'})
+        self.assertEqual(result['day'].typecode, 'd')
+
+    def test_empty(self):
+        result = self.database.fetch_columns(
+                text("SELECT day FROM prices WHERE day < 0"))
+        self.assertEqual(len(result), 0)
+        self.assertEqual(list(result['day']), [])
+
+    @unittest.skipUnless(columnar.numpy, "numpy is not installed")
+    def test_numpy(self):
+        result = self._fetch().numpy()
+        self.assertEqual(str(result['day'].dtype), 'int64')
+        self.assertEqual(result['close'].count(), 2250)
+        self.assertEqual(result['note'].dtype, object)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from sqlalchemy import column
+from sqlalchemy import select
+from sqlalchemy import table
+from dodai.model.compiled import CompiledCacheStats
+from dodai.model.compiled import lru_hit_counts
+from dodai.model.database import GetDatabase
+
+
+class TestLruHitCounts(unittest.TestCase):
+
+    def test_counts(self):
+        trace = ['a', 'b', 'c', 'a', 'b', 'c', 'a']
+        self.assertEqual(lru_hit_counts(trace, [1, 2, 3]),
+                         {1: 0, 2: 0, 3: 4})
+
+    def test_repeats(self):
+        trace = ['a', 'a', 'b', 'a']
+        self.assertEqual(lru_hit_counts(trace, [1, 2]), {1: 1, 2: 2})
+
+
+class TestCompiledCacheStats(unittest.TestCase):
+
+    def setUp(self):
+        self.sections = {
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': ':memory:',
+                'query_cache_size': '4'
+            },
+            'db.red': {
+                'dialect': 'sqlite',
+                'filename': ':memory:',
+                'query_cache_size': 'lots'
+            },
+        }
+        self.stats = CompiledCacheStats(record=1000)
+        self.get_database = GetDatabase.load(self.sections,
+                                             listeners=[self.stats])
+        self.connection = self.get_database('db.blue').connection
+        self.table = table('foo', column('a'), column('b'))
+
+    def _statement(self, x):
+        columns = [self.table.c.a] * (x + 1)
+        return select(*columns)
+
+    def _run(self, *xs):
+        for x in xs:
+            self.connection.execute(self._statement(x).where(
+                    self.table.c.b == x))
+
+    def test_query_cache_size(self):
+        engine = self.get_database('db.blue').engine
+        self.assertEqual(engine._compiled_cache.capacity, 4)
+        self.assertEqual(self.stats.stats('db.blue')['capacity'], 4)
+
+    def test_bad_query_cache_size(self):
+        with self.assertRaises(ValueError):
+            self.get_database('db.red')
+
+    def _create(self):
+        self.connection.exec_driver_sql("CREATE TABLE foo (a INT, b INT)")
+
+    def test_hits_and_misses(self):
+        self._create()
+        self._run(0, 0, 1, 0)
+        stats = self.stats.stats('db.blue')
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['uncached'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_evictions(self):
+        self._create()
+        self._run(*range(7))
+        stats = self.stats.stats('db.blue')
+        self.assertEqual(stats['misses'], 7)
+        self.assertEqual(stats['evictions'], 3)
+        self.assertEqual(stats['size'], 4)
+
+    def test_report(self):
+        self._create()
+        for x in range(10):
+            self._run(*range(6))
+        report = self.stats.report('db.blue')
+        self.assertEqual(report['executions'], 60)
+        self.assertEqual(report['distinct'], 6)
+        self.assertEqual(report['recommended'], 6)
+        self.assertEqual(report['hit_ratios'][4], 0)
+        self.assertEqual(report['hit_ratios'][6], 54 / 60.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
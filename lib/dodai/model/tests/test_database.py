@@ -26,7 +26,7 @@ from dodai.model.database import GetAllDatabaseSections
 class _BaseTest(unittest.TestCase):
 
     def setUp(self):
-        self.is_database_section = IsDatabaseSection(self.sections)
+        self.is_database_section = IsDatabaseSection.load(self.sections)
 
     @property
     def sections(self):
@@ -105,6 +105,111 @@ class TestBadDatabaseSections(_BaseTest):
 
 
 
+class TestConnectionSpec(unittest.TestCase):
+
+    def setUp(self):
+        self.sections = {
+            'default': {
+                'environment': 'prod'
+            },
+            'db.blue': {
+                'dialect': 'postgresql',
+                'driver': 'psycopg2',
+                'group': 'frontend',
+                'environment': 'prod',
+                'hostname': 'localhost',
+                'port': '5433',
+                'username': 'abcd',
+                'password': 'p@ss/word:1',
+                'database': 'shop',
+                'schema': 'test',
+                'query_cache_size': '50'
+            },
+            'db.purple': {
+                'dialect': 'sqlite',
+                'filename': '/a/b/c.sqlite'
+            },
+            'db.red': {
+                'dialect': 'sqlite',
+                'filename': '/a/b/d.sqlite',
+                'query_cache_size': 'lots'
+            },
+        }
+        self.get_database = GetDatabase.load(self.sections)
+
+    def test_network_url(self):
+        spec = self.get_database.spec('frontend')
+        self.assertEqual('db.blue', spec.name)
+        self.assertEqual(5433, spec.url.port)
+        self.assertEqual('p@ss/word:1', spec.url.password)
+        self.assertEqual('postgresql+psycopg2://abcd:p%40ss%2Fword%3A1@'
+                         'localhost:5433/shop',
+                         spec.url.render_as_string(hide_password=False))
+        self.assertEqual({'query_cache_size': 50}, spec.engine_kwargs())
+        self.assertEqual(('test', 'frontend', 'prod', 'primary'),
+                         (spec.schema, spec.group, spec.environment,
+                          spec.role))
+
+    def test_file_url(self):
+        spec = self.get_database.spec('db.purple')
+        self.assertEqual('sqlite:////a/b/c.sqlite', str(spec.url))
+        self.assertEqual(None, spec.group)
+
+    def test_bad_option(self):
+        self.assertRaises(ValueError, self.get_database.spec, 'db.red')
+        self.assertRaises(ValueError, self.get_database, 'db.red')
+        self.assertRaises(KeyError, self.get_database.spec, 'db.nope')
+
+    def test_cached(self):
+        self.assertTrue(self.get_database('frontend') is
+                        self.get_database('db.blue'))
+        self.assertTrue(self.get_database.spec('db.purple') is
+                        self.get_database.spec('db.purple'))
+
+    def test_password_not_in_fingerprint(self):
+        spec = self.get_database.spec('db.blue')
+        sections = dict(self.sections)
+        sections['db.blue'] = dict(sections['db.blue'], password='other')
+        self.assertEqual(['db.blue'], self.get_database.reload(sections))
+        self.assertEqual(spec.fingerprint,
+                         self.get_database.spec('db.blue').fingerprint)
+        self.assertEqual('other',
+                         self.get_database.spec('db.blue').url.password)
+        self.assertEqual([], self.get_database.reload(sections))
+
+    def test_reload_keeps_bad_section(self):
+        self.assertEqual([], self.get_database.reload(dict(self.sections)))
+        self.assertRaises(ValueError, self.get_database, 'db.red')
+        sections = dict(self.sections)
+        del sections['db.red']
+        self.assertEqual(['db.red'], self.get_database.reload(sections))
+        self.assertRaises(KeyError, self.get_database.spec, 'db.red')
+
+    def test_reload(self):
+        blue = self.get_database('db.blue')
+        purple = self.get_database('db.purple')
+        spec = self.get_database.spec('db.purple')
+        sections = dict(self.sections)
+        sections['db.blue'] = dict(sections['db.blue'], port='5434')
+        sections['db.red'] = dict(sections['db.red'], query_cache_size='10')
+        del sections['db.purple']
+        sections['db.green'] = dict(self.sections['db.purple'])
+        changed = self.get_database.reload(sections)
+        self.assertEqual(['db.blue', 'db.green', 'db.purple', 'db.red'],
+                         changed)
+        self.assertEqual(5434, self.get_database.spec('frontend').url.port)
+        self.assertFalse(blue is self.get_database('db.blue'))
+        self.assertRaises(KeyError, self.get_database, 'db.purple')
+        self.assertEqual(10, self.get_database.spec(
+                'db.red').engine_kwargs()['query_cache_size'])
+        sections = dict(sections, **{'db.purple': self.sections['db.purple']})
+        self.get_database.reload(sections)
+        green = self.get_database('db.green')
+        self.assertEqual([], self.get_database.reload(sections))
+        self.assertTrue(green is self.get_database('db.green'))
+        self.assertFalse(spec is self.get_database.spec('db.purple'))
+        self.assertFalse(purple is self.get_database('db.purple'))
+
 
 if __name__ == '__main__':
     unittest.main()
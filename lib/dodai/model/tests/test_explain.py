@@ -0,0 +1,148 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.explain import ExplainCapture
+
+
+class TestExplainCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sections = {
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+                'explain_threshold': '0'
+            },
+            'db.green': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'green.sqlite'),
+            }
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _load(self, **kwargs):
+        self.capture = ExplainCapture.load(self.sections, **kwargs)
+        self.get_database = GetDatabase.load(self.sections,
+                                             listeners=[self.capture])
+
+    def _connection(self, name):
+        connection = self.get_database(name).connection
+        connection.execute(text("CREATE TABLE foo (id INT, name TEXT)"))
+        connection.execute(text("CREATE INDEX foo_id ON foo (id)"))
+        connection.commit()
+        return connection
+
+    def test_capture(self):
+        self._load()
+        connection = self._connection('db.blue')
+        connection.execute(text("SELECT name FROM foo WHERE id = :id"),
+                           {'id': 1})
+        plans = self.capture.plans('db.blue')
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(plans[0]['statement'],
+                         "SELECT name FROM foo WHERE id = ?")
+        self.assertEqual(plans[0]['dialect'], 'sqlite')
+        self.assertIn('foo_id', plans[0]['text'])
+
+    def test_not_slow(self):
+        self._load()
+        connection = self._connection('db.green')
+        connection.execute(text("SELECT name FROM foo"))
+        self.assertEqual(self.capture.plans(), [])
+
+    def test_deduplicated(self):
+        self._load()
+        connection = self._connection('db.blue')
+        for x in range(5):
+            connection.execute(text("SELECT name FROM foo WHERE id = {0}"
+                                    .format(x)))
+        plans = self.capture.plans()
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(plans[0]['count'], 5)
+        plan = self.capture.plan('db.blue', "SELECT name FROM foo "
+                                            "WHERE id = 42")
+        self.assertEqual(plan['count'], 5)
+
+    def test_bounded(self):
+        self._load(size=2)
+        connection = self._connection('db.blue')
+        for column in ('id', 'name', 'id, name'):
+            connection.execute(text("SELECT {0} FROM foo".format(column)))
+        plans = self.capture.plans()
+        self.assertEqual([x['statement'] for x in plans],
+                         ["SELECT name FROM foo", "SELECT id, name FROM foo"])
+
+    def test_rate_limited(self):
+        self._load(limit=1, period=3600)
+        connection = self._connection('db.blue')
+        connection.execute(text("SELECT id FROM foo"))
+        connection.execute(text("SELECT name FROM foo"))
+        self.assertEqual(len(self.capture.plans()), 1)
+        self.assertEqual(self.capture.skipped, 1)
+
+    def test_sampled_out(self):
+        self._load(sample_rate=0)
+        connection = self._connection('db.blue')
+        connection.execute(text("SELECT id FROM foo"))
+        self.assertEqual(self.capture.plans(), [])
+
+    def test_ddl_is_not_explained(self):
+        self._load()
+        self._connection('db.blue')
+        self.assertEqual(self.capture.plans(), [])
+
+    def test_not_on_callers_connection(self):
+        self._load()
+        connection = self._connection('db.blue')
+        statements = []
+        connection.connection.dbapi_connection.set_trace_callback(
+                statements.append)
+        result = connection.execute(text("SELECT name FROM foo"))
+        self.assertEqual(len(self.capture.plans()), 1)
+        self.assertEqual(result.all(), [])
+        self.assertEqual(statements, ['SELECT name FROM foo'])
+
+    def test_failure(self):
+        self._load()
+        self.capture.PREFIXES = {'sqlite': 'EXPLAIN NOPE '}
+        self.get_database = GetDatabase.load(self.sections,
+                                             listeners=[self.capture])
+        connection = self._connection('db.blue')
+        connection.execute(text("SELECT name FROM foo"))
+        self.assertEqual(self.capture.plans(), [])
+        self.assertEqual(self.capture.failed, 1)
+
+    def test_clear(self):
+        self._load()
+        connection = self._connection('db.blue')
+        connection.execute(text("SELECT id FROM foo"))
+        self.capture.clear()
+        self.assertEqual(self.capture.plans(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from dodai.model.database import GetDatabase
+from dodai.model.failover import HealthProbe
+
+
+class _BaseTest(unittest.TestCase):
+
+    NAMES = ('first', 'second', 'third')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in self.NAMES:
+            os.mkdir(os.path.join(self.directory, name))
+            sqlite3.connect(self._filename(name)).close()
+        self.get_database = GetDatabase.load(self.sections)
+        self.failover = self.get_database.failover('frontend', start=False,
+                                                   interval=0.05,
+                                                   timeout=1.0)
+
+    def tearDown(self):
+        self.failover.stop()
+        shutil.rmtree(self.directory)
+
+    def _filename(self, name):
+        return os.path.join(self.directory, name, 'data.sqlite')
+
+    def _fail(self, name):
+        """Simulates an outage by moving the database's directory away
+        """
+        path = os.path.join(self.directory, name)
+        os.rename(path, path + '.down')
+
+    def _recover(self, name):
+        path = os.path.join(self.directory, name)
+        os.rename(path + '.down', path)
+
+    @property
+    def sections(self):
+        if not hasattr(self, '_sections_') or not self._sections_:
+            self._sections_ = {'default': {'environment': 'prod'}}
+            for name in self.NAMES:
+                self._sections_['db.{0}'.format(name)] = {
+                    'dialect': 'sqlite',
+                    'filename': self._filename(name),
+                    'group': 'frontend',
+                    'environment': 'prod'
+                }
+        return self._sections_
+
+
+class TestHealthProbe(_BaseTest):
+
+    def test_probe(self):
+        probe = HealthProbe()
+        connection = self.get_database('db.first')
+        self.assertTrue(probe(connection))
+        self._fail('first')
+        self.assertFalse(probe(connection))
+
+    def test_probe_does_not_create_file(self):
+        os.remove(self._filename('first'))
+        self.assertFalse(HealthProbe()(self.get_database('db.first')))
+        self.assertFalse(os.path.exists(self._filename('first')))
+
+
+class TestFailover(_BaseTest):
+
+    def test_candidates_in_order(self):
+        self.assertEqual([x.name for x in self.failover.candidates],
+                         ['db.first', 'db.second', 'db.third'])
+        self.assertEqual(self.failover.name, 'db.first')
+
+    def test_explicit_candidates(self):
+        failover = self.get_database.failover(['db.third', 'db.first'],
+                                              start=False)
+        self.assertEqual(failover.name, 'db.third')
+
+    def test_switch(self):
+        self.assertEqual(self.failover.check(), [True, True, True])
+        self.assertEqual(self.failover.switches, 0)
+        self._fail('first')
+        self._fail('second')
+        self.assertEqual(self.failover.check(), [False, False, True])
+        self.assertEqual(self.failover.name, 'db.third')
+        self.assertIs(self.failover.engine,
+                      self.get_database('db.third').engine)
+        self.assertEqual(self.failover.switches, 1)
+        self.assertIsNotNone(self.failover.last_switch)
+        timestamp, previous, current = self.failover.history[-1]
+        self.assertEqual((previous, current), ('db.first', 'db.third'))
+
+    def test_no_failback(self):
+        self._fail('first')
+        self.failover.check()
+        self._recover('first')
+        self.failover.check()
+        self.assertEqual(self.failover.name, 'db.second')
+
+    def test_failback(self):
+        self.failover.failback = True
+        self._fail('first')
+        self.failover.check()
+        self._recover('first')
+        self.failover.check()
+        self.assertEqual(self.failover.name, 'db.first')
+        self.assertEqual(self.failover.switches, 2)
+
+    def test_everything_down(self):
+        for name in self.NAMES:
+            self._fail(name)
+        self.failover.check()
+        self.assertEqual(self.failover.name, 'db.first')
+        self.assertEqual(self.failover.switches, 0)
+
+    def test_slow_probe_is_a_failure(self):
+        def probe(connection):
+            if connection.name == 'db.first':
+                time.sleep(0.5)
+            return True
+        failover = self.get_database.failover('frontend', start=False,
+                                              probe=probe, timeout=0.1)
+        self.assertEqual(failover.check(), [False, True, True])
+        self.assertEqual(failover.name, 'db.second')
+        failover.stop()
+
+    def test_hung_probe_is_not_resubmitted(self):
+        release = threading.Event()
+        calls = []
+
+        def probe(connection):
+            calls.append(connection.name)
+            if connection.name == 'db.first':
+                release.wait(10)
+            return True
+        failover = self.get_database.failover('frontend', start=False,
+                                              probe=probe, timeout=0.1)
+        for x in range(3):
+            self.assertEqual(failover.check(), [False, True, True])
+        self.assertEqual(1, calls.count('db.first'))
+        self.assertEqual(3, calls.count('db.second'))
+        release.set()
+        deadline = time.monotonic() + 5
+        while failover._pending[0].running() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(failover.check(), [True, True, True])
+        failover.stop()
+
+    def test_concurrent_checks(self):
+        release = threading.Event()
+        calls = []
+
+        def probe(connection):
+            calls.append(connection.name)
+            release.wait(10)
+            return True
+        failover = self.get_database.failover('frontend', start=False,
+                                              probe=probe, timeout=0.05)
+        threads = [threading.Thread(target=failover.check)
+                   for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        release.set()
+        self.assertEqual(sorted(calls),
+                         ['db.first', 'db.second', 'db.third'])
+        failover.stop()
+
+    def test_probe_timeout(self):
+        self.assertEqual(1.0, self.failover._probe.timeout)
+
+    def test_background_detection(self):
+        self.failover.start()
+        self._fail('first')
+        deadline = time.monotonic() + self.failover.interval + \
+                   self.failover.timeout + 1
+        while time.monotonic() < deadline:
+            if self.failover.switches:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.failover.name, 'db.second')
+
+
+if __name__ == '__main__':
+    unittest.main()
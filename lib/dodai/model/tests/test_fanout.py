@@ -0,0 +1,115 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.fanout import FanOutTimeout
+
+
+SLOW = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c "\
+       "WHERE x < 100000000) SELECT COUNT(*) FROM c"
+
+
+class TestFanOut(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.shards = ['db.shard{0}'.format(x) for x in range(4)]
+        sections = {'default': {'environment': 'prod'}}
+        for name in self.shards:
+            sections[name] = {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, name + '.sqlite'),
+                'group': 'customers',
+                'environment': 'prod',
+            }
+        sections['db.other'] = dict(sections['db.shard0'],
+                                    filename=os.path.join(self.directory,
+                                                          'other.sqlite'),
+                                    role='replica')
+        self.get_database = GetDatabase.load(sections)
+        for number, name in enumerate(self.shards):
+            with self.get_database(name).engine.begin() as connection:
+                connection.execute(text("CREATE TABLE foo (id INTEGER)"))
+                connection.execute(text("INSERT INTO foo VALUES (:a), (:b)"),
+                                   {'a': number, 'b': number + 10})
+
+    def tearDown(self):
+        for name in self.shards:
+            self.get_database(name).engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_group_sections(self):
+        fan_out = self.get_database.fan_out('customers')
+        self.assertEqual(sorted(self.shards), sorted(fan_out.names))
+        fan_out = self.get_database.fan_out('customers',
+                                            sections=['db.shard1'])
+        self.assertEqual(['db.shard1'], fan_out.names)
+        fan_out = self.get_database.fan_out('customers', role='replica')
+        self.assertEqual(['db.other'], fan_out.names)
+        self.assertRaises(KeyError, self.get_database.fan_out, 'nope')
+
+    def test_merge(self):
+        fan_out = self.get_database.fan_out(self.shards, workers=2)
+        result = fan_out("SELECT id FROM foo ORDER BY id")
+        self.assertEqual({}, result.errors)
+        self.assertEqual([0, 10, 1, 11, 2, 12, 3, 13],
+                         [x[0] for x in result.rows()])
+        self.assertEqual([0, 1, 2, 3, 10, 11, 12, 13],
+                         [x[0] for x in result.rows(key=lambda x: x[0])])
+        self.assertEqual(['id'], result['db.shard2'].keys)
+        self.assertTrue(all(x >= 0 for x in result.timings.values()))
+
+    def test_shard_errors(self):
+        with self.get_database('db.shard2').engine.begin() as connection:
+            connection.execute(text("DROP TABLE foo"))
+        result = self.get_database.fan_out('customers')(
+                "SELECT id FROM foo WHERE id > :id", {'id': 5})
+        self.assertEqual(['db.shard2'], list(result.errors))
+        self.assertEqual([10, 11, 13], sorted(x[0] for x in result.rows()))
+
+    def test_stream(self):
+        fan_out = self.get_database.fan_out('customers')
+        shards = list(fan_out.stream("SELECT COUNT(*) FROM foo"))
+        self.assertEqual(sorted(self.shards), sorted(x.name for x in shards))
+        self.assertTrue(all(x.rows == [(2,)] for x in shards))
+
+    def test_timeout(self):
+        fan_out = self.get_database.fan_out(self.shards[:2])
+        started = time.monotonic()
+        result = fan_out(SLOW, timeout=0.2)
+        self.assertTrue(time.monotonic() - started < 2)
+        self.assertEqual(2, len(result.errors))
+        self.assertTrue(all(isinstance(x, FanOutTimeout)
+                            for x in result.errors.values()))
+
+    def test_timeout_order(self):
+        names = [self.shards[2], self.shards[0], self.shards[1]]
+        fan_out = self.get_database.fan_out(names)
+        shards = list(fan_out.stream(SLOW, timeout=0.2))
+        self.assertEqual(names, [x.name for x in shards])
+
+
+if __name__ == '__main__':
+    unittest.main()
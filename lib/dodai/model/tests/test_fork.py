@@ -0,0 +1,135 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import text
+from dodai.model import fork
+from dodai.model.database import GetDatabase
+from dodai.model.database import DodaiDatabaseObject
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "os.fork() is not available")
+class TestForkSafety(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'data.sqlite')
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': self.filename,
+                'group': 'frontend',
+                'environment': 'dev'
+            },
+        })
+        self.database = self.get_database('frontend')
+        self.database.connection.execute(text("CREATE TABLE foo (id INT)"))
+        self.database.connection.execute(text("INSERT INTO foo VALUES (1)"))
+        self.database.connection.commit()
+        self.database.set_active_connection_key('other')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _in_child(self, function):
+        """Runs the function in a forked child and returns what it returned
+        """
+        read, write = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(read)
+            try:
+                out = function()
+            except Exception as e:
+                out = repr(e)
+            os.write(write, json.dumps(out).encode('utf-8'))
+            os._exit(0)
+        os.close(write)
+        with os.fdopen(read, 'rb') as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        return json.loads(data.decode('utf-8'))
+
+    def test_registered(self):
+        self.assertIn(self.database, fork.registered())
+
+    def test_child_gets_new_pool(self):
+        parent_pool = id(self.database.engine.pool)
+        parent_connection = id(self.database.connection)
+
+        def child():
+            return {
+                'engine': id(self.database.engine),
+                'pool': id(self.database.engine.pool),
+                'key': self.database.active_connection_key,
+                'connection': id(self.database.connection),
+                'count': self.database.connection.execute(
+                                text("SELECT COUNT(*) FROM foo")).scalar(),
+            }
+
+        out = self._in_child(child)
+        self.assertEqual(out['engine'], id(self.database.engine))
+        self.assertNotEqual(out['pool'], parent_pool)
+        self.assertEqual(out['key'], self.database.DEFAULT_KEY)
+        self.assertNotEqual(out['connection'], parent_connection)
+        self.assertEqual(out['count'], 1)
+
+    def test_parent_connection_survives(self):
+        self._in_child(lambda: len(self.database.session_cache))
+        count = self.database.connection.execute(
+                        text("SELECT COUNT(*) FROM foo")).scalar()
+        self.assertEqual(count, 1)
+
+    def test_inherited_until_parent_exits(self):
+        def child():
+            parent = os.getppid()
+            return [parent in fork._inherited, len(fork._inherited)]
+        self.assertEqual([True, 1], self._in_child(child))
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        fork._inherited[pid] = [object()]
+        try:
+            fork._forget_dead()
+            self.assertNotIn(pid, fork._inherited)
+        finally:
+            fork._inherited.pop(pid, None)
+
+    def test_database_object(self):
+        database = DodaiDatabaseObject("sqlite:///{0}".format(self.filename))
+        session = database.session
+        out = self._in_child(lambda: database.session is session)
+        self.assertFalse(out)
+        self.assertIs(database.session, session)
+
+    def test_failover_restarts_probes(self):
+        failover = self.get_database.failover('frontend', interval=0.05)
+        try:
+            out = self._in_child(lambda: failover._thread.is_alive())
+        finally:
+            failover.stop()
+        self.assertTrue(out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import text
+from dodai.model import handle
+from dodai.model.database import GetDatabase
+
+
+def _count(connection_handle, low):
+    with connection_handle.engine.connect() as connection:
+        count = connection.execute(text(
+                "SELECT COUNT(*) FROM foo WHERE id >= :low"),
+                {'low': low}).scalar()
+    return os.getpid(), id(connection_handle.engine), count
+
+
+class TestConnectionHandle(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sections = {
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+                'group': 'warehouse',
+                'environment': 'dev',
+            },
+        }
+        self.get_database = GetDatabase.load(self.sections)
+        with self.get_database('db.blue').engine.begin() as connection:
+            connection.execute(text("CREATE TABLE foo (id INTEGER)"))
+            connection.execute(text("INSERT INTO foo VALUES (1), (2), (3)"))
+
+    def tearDown(self):
+        self.get_database('db.blue').dispose()
+        shutil.rmtree(self.directory)
+
+    def test_pickle(self):
+        connection_handle = self.get_database.handle('warehouse')
+        data = pickle.dumps(connection_handle)
+        self.assertTrue(len(data) < 200)
+        self.assertFalse(b'sqlite' in data)
+        copy = pickle.loads(data)
+        self.assertEqual(connection_handle, copy)
+        self.assertTrue(copy.connection is self.get_database('db.blue'))
+
+    def test_changed_config(self):
+        connection_handle = self.get_database.handle('db.blue')
+        self.get_database.reload({'db.blue': dict(self.sections['db.blue'],
+                                                  group='other')})
+        self.assertRaises(KeyError, getattr, connection_handle, 'engine')
+
+    def test_fork_pool(self):
+        connection_handle = self.get_database.handle('db.blue')
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(2, mp_context=context) as pool:
+            results = list(pool.map(_count, [connection_handle] * 6,
+                                    [1, 2, 3, 1, 2, 3]))
+        self.assertEqual([3, 2, 1, 3, 2, 1], [x[2] for x in results])
+        engines = {}
+        for pid, engine, count in results:
+            engines.setdefault(pid, set()).add(engine)
+        self.assertTrue(all(len(x) == 1 for x in engines.values()))
+        self.assertFalse(os.getpid() in engines)
+
+    def test_spawn_pool(self):
+        connection_handle = self.get_database.handle('db.blue')
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(1, mp_context=context,
+                                 initializer=handle.install,
+                                 initargs=(self.sections,)) as pool:
+            self.assertEqual(2, pool.submit(_count, connection_handle,
+                                            2).result()[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
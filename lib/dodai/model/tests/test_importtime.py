@@ -0,0 +1,102 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import glob
+import os
+import subprocess
+import sys
+import unittest
+
+
+LIB = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))))
+
+
+def import_times(module):
+    """Imports the module in a new interpreter with -X importtime and returns
+    a dictionary of each module imported to its cumulative microseconds
+    """
+    env = dict(os.environ, PYTHONPATH=LIB)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                              'import {0}'.format(module)],
+                             env=env, capture_output=True, text=True,
+                             check=True)
+    out = {}
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_time, cumulative, name = line[12:].split('|')
+            if cumulative.strip().isdigit():
+                out[name.strip()] = int(cumulative)
+    return out
+
+
+class TestImportTime(unittest.TestCase):
+    """Config-only modules have to stay cheap to import for short lived
+    command line tools, so none of them may pull in sqlalchemy
+    """
+
+    # Microseconds; the modules take around 20ms, sqlalchemy alone 350ms
+    BUDGET = 150000
+    RUNS = 3
+    HEAVY = ('sqlalchemy', 'numpy')
+
+    def _modules(self):
+        names = ['dodai.util.find', 'dodai.model.parse']
+        for path in sorted(glob.glob(os.path.join(LIB, 'dodai', 'validate',
+                                                  '*.py'))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name != '__init__':
+                names.append('dodai.validate.{0}'.format(name))
+        return names
+
+    def _check_heavy(self, module, times):
+        heavy = [x for x in times if x.split('.')[0] in self.HEAVY]
+        self.assertEqual([], heavy, "{0} imports {1}".format(module, heavy))
+
+    def test_budget(self):
+        for module in self._modules():
+            best = None
+            for x in range(self.RUNS):
+                times = import_times(module)
+                self._check_heavy(module, times)
+                best = min(best or times[module], times[module])
+            self.assertTrue(best < self.BUDGET,
+                            "{0} took {1}us to import".format(module, best))
+
+    def test_database_is_lazy(self):
+        self._check_heavy('dodai.model.database',
+                          import_times('dodai.model.database'))
+
+    def test_load_is_lazy(self):
+        code = ("import sys\n"
+                "from dodai.model.database import GetDatabase\n"
+                "GetDatabase.load({'db.blue': {\n"
+                "    'dialect': 'sqlite', 'filename': 'blue.sqlite',\n"
+                "    'journal_mode': 'wal', 'pool_classes': 'a:2, b:1',\n"
+                "    'breaker_failures': '3'}}).spec('db.blue')\n"
+                "print(sorted(x for x in sys.modules\n"
+                "             if x.split('.')[0] in %r))\n" % (self.HEAVY,))
+        env = dict(os.environ, PYTHONPATH=LIB)
+        process = subprocess.run([sys.executable, '-c', code], env=env,
+                                 capture_output=True, text=True, check=True)
+        self.assertEqual('[]', process.stdout.strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from urllib.request import urlopen
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.metrics import PoolMetrics
+from dodai.model.metrics import render_prometheus
+from dodai.model.metrics import serve
+from dodai.model.timing import QueryTimings
+
+
+class TestPoolMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sections = {
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+            },
+        }
+        self.metrics = PoolMetrics()
+        self.timings = QueryTimings()
+        self.get_database = GetDatabase.load(
+                self.sections, listeners=[self.metrics, self.timings])
+        self.engine = self.get_database('db.blue').engine
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_checkouts(self):
+        first = self.engine.connect()
+        second = self.engine.connect()
+        stats = self.metrics.stats('db.blue')
+        self.assertEqual(stats['engines'], 1)
+        self.assertEqual(stats['connects'], 2)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['checked_out'], 2)
+        self.assertEqual(stats['wait_count'], 2)
+        first.close()
+        second.close()
+        self.assertEqual(self.metrics.stats('db.blue')['checked_out'], 0)
+
+    def test_overflow(self):
+        connections = [self.engine.connect()
+                       for x in range(self.engine.pool.size() + 2)]
+        self.assertEqual(self.metrics.stats('db.blue')['overflow'], 2)
+        for connection in connections:
+            connection.close()
+
+    def test_invalidate_and_dispose(self):
+        connection = self.engine.connect()
+        connection.invalidate()
+        connection.close()
+        self.engine.connect().close()
+        self.engine.dispose()
+        self.engine.connect().close()
+        stats = self.metrics.stats('db.blue')
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['disconnects'], 2)
+        self.assertEqual(stats['connects'], 3)
+        self.assertEqual(stats['wait_count'], 3)
+
+    def test_reset(self):
+        self.engine.connect().close()
+        self.metrics.reset()
+        stats = self.metrics.stats('db.blue')
+        self.assertEqual(stats['connects'], 0)
+        self.assertEqual(stats['engines'], 1)
+
+    def test_render(self):
+        with self.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            out = render_prometheus(self.metrics, self.timings)
+        lines = out.splitlines()
+        self.assertIn('# TYPE dodai_pool_checked_out gauge', lines)
+        self.assertIn('dodai_pool_checked_out{section="db.blue"} 1', lines)
+        self.assertIn('dodai_pool_connects_total{section="db.blue"} 1',
+                      lines)
+        self.assertIn('dodai_engines{section="db.blue"} 1', lines)
+        self.assertIn('dodai_pool_wait_seconds_count{section="db.blue"} 1',
+                      lines)
+        self.assertIn('dodai_query_queries_total{section="db.blue"} 1',
+                      lines)
+        self.assertTrue(any(line.startswith(
+            'dodai_query_duration_seconds{quantile="0.99",section="db.blue"}')
+            for line in lines))
+        self.assertTrue(any(line.startswith(
+            'dodai_query_duration_seconds{quantile="0.999",section="db.blue"}')
+            for line in lines))
+        self.assertTrue(out.endswith('\n'))
+
+    def test_escape(self):
+        self.metrics('db."red"\\', self.engine)
+        out = render_prometheus(self.metrics)
+        self.assertIn('dodai_engines{section="db.\\"red\\"\\\\"} 1', out)
+
+    def test_serve(self):
+        server = serve(0, self.metrics, host='127.0.0.1')
+        try:
+            url = "http://127.0.0.1:{0}/metrics".format(
+                    server.server_address[1])
+            with urlopen(url) as response:
+                body = response.read().decode('utf-8')
+                content_type = response.headers['Content-Type']
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('dodai_engines{section="db.blue"} 1', body)
+        self.assertTrue(content_type.startswith('text/plain'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.pragmas import SqliteProfile
+
+
+class TestSqliteProfile(unittest.TestCase):
+
+    def test_load(self):
+        profile = SqliteProfile.load({'synchronous': '1',
+                                      'journal_mode': 'WAL',
+                                      'temp_store': 'memory',
+                                      'filename': 'x'})
+        self.assertEqual((('journal_mode', 'wal'), ('synchronous', 'normal'),
+                          ('temp_store', 'memory')), profile.pragmas)
+
+    def test_bad_values(self):
+        for key, val in (('journal_mode', '4'), ('synchronous', 'sometimes'),
+                         ('cache_size', 'big'), ('mmap_size', '-1'),
+                         ('busy_timeout', '1.5')):
+            with self.assertRaises(ValueError) as context:
+                SqliteProfile.load({key: val})
+            self.assertEqual(key, context.exception.args[0])
+
+
+class TestSectionPragmas(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+                'journal_mode': 'wal',
+                'synchronous': 'normal',
+                'cache_size': '-8000',
+                'mmap_size': '1048576',
+                'temp_store': 'memory',
+                'busy_timeout': '2500'
+            },
+            'db.plain': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'plain.sqlite')
+            },
+            'db.bad': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'bad.sqlite'),
+                'synchronous': 'sometimes'
+            },
+            'db.network': {
+                'dialect': 'postgresql',
+                'hostname': 'localhost',
+                'port': '5432',
+                'username': 'abcd',
+                'password': 'efgh',
+                'database': 'shop',
+                'schema': 'test',
+                'journal_mode': 'wal'
+            },
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _pragma(self, name, key):
+        engine = self.get_database(name).engine
+        with engine.connect() as connection:
+            return connection.execute(text("PRAGMA " + key)).scalar()
+
+    def test_applied(self):
+        self.assertEqual('wal', self._pragma('db.blue', 'journal_mode'))
+        self.assertEqual(1, self._pragma('db.blue', 'synchronous'))
+        self.assertEqual(-8000, self._pragma('db.blue', 'cache_size'))
+        self.assertEqual(1048576, self._pragma('db.blue', 'mmap_size'))
+        self.assertEqual(2, self._pragma('db.blue', 'temp_store'))
+        self.assertEqual(2500, self._pragma('db.blue', 'busy_timeout'))
+
+    def test_every_connection(self):
+        engine = self.get_database('db.blue').engine
+        with engine.connect() as first, engine.connect() as second:
+            for connection in (first, second):
+                self.assertEqual(-8000, connection.execute(
+                        text("PRAGMA cache_size")).scalar())
+
+    def test_defaults(self):
+        self.assertEqual((), self.get_database.spec('db.plain').pragmas)
+        self.assertEqual('delete', self._pragma('db.plain', 'journal_mode'))
+
+    def test_other_dialects(self):
+        self.assertEqual((), self.get_database.spec('db.network').pragmas)
+
+    def test_bad_option(self):
+        self.assertRaises(ValueError, self.get_database, 'db.bad')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.priority import PoolClassTimeout
+from dodai.model.priority import PriorityGate
+from dodai.model.priority import parse_pool_classes
+
+
+class TestParse(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual((('interactive', 8), ('batch', 2)),
+                         parse_pool_classes('interactive:8, batch:2'))
+        for val in ('', 'a', 'a:0', 'a:1,a:2', 'a:x'):
+            self.assertRaises(ValueError, parse_pool_classes, val)
+
+
+class TestPriorityGate(unittest.TestCase):
+
+    def _wait_for(self, gate, class_name, count):
+        deadline = time.monotonic() + 5
+        while gate.stats(class_name)['waiting'] < count:
+            self.assertTrue(time.monotonic() < deadline)
+            time.sleep(0.005)
+
+    def _waiter(self, gate, class_name, order):
+        def run():
+            gate.acquire(class_name)
+            order.append(class_name)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def test_priority(self):
+        gate = PriorityGate('db.blue', [('interactive', 1), ('batch', 1)],
+                            total=1)
+        gate.acquire('batch')
+        order = []
+        threads = [self._waiter(gate, 'batch', order)]
+        self._wait_for(gate, 'batch', 1)
+        threads.append(self._waiter(gate, 'interactive', order))
+        self._wait_for(gate, 'interactive', 1)
+        gate.release('batch')
+        deadline = time.monotonic() + 5
+        while not order and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(['interactive'], order)
+        gate.release('interactive')
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(['interactive', 'batch'], order)
+
+    def test_class_limit(self):
+        gate = PriorityGate('db.blue', [('interactive', 3), ('batch', 1)],
+                            total=3)
+        gate.acquire('batch')
+        self.assertRaises(PoolClassTimeout, gate.acquire, 'batch',
+                          timeout=0.01)
+        gate.acquire('interactive', timeout=0.01)
+        gate.acquire('interactive', timeout=0.01)
+        self.assertRaises(PoolClassTimeout, gate.acquire, 'interactive',
+                          timeout=0.01)
+        stats = gate.stats()
+        self.assertEqual(1, stats['batch']['timeouts'])
+        self.assertEqual(2, stats['interactive']['in_use'])
+        self.assertRaises(KeyError, gate.acquire, 'reports')
+
+    def test_blocked_class_does_not_block_others(self):
+        gate = PriorityGate('db.blue', [('interactive', 2), ('batch', 1)])
+        gate.acquire('batch')
+        order = []
+        thread = self._waiter(gate, 'batch', order)
+        self._wait_for(gate, 'batch', 1)
+        gate.acquire('interactive', timeout=1)
+        self.assertEqual([], order)
+        gate.release('batch')
+        thread.join(5)
+        self.assertEqual(['batch'], order)
+
+    def test_queue_time(self):
+        gate = PriorityGate('db.blue', [('batch', 1)])
+        gate.acquire('batch')
+        timer = threading.Timer(0.05, gate.release, ('batch',))
+        timer.start()
+        gate.acquire('batch')
+        stats = gate.stats('batch')
+        self.assertEqual(2, stats['acquired'])
+        self.assertTrue(stats['queue_time'][99] >= 0.04)
+        families = dict((x.name, x) for x in gate.collect())
+        self.assertEqual(
+                2, families['dodai_pool_class_queue_seconds'].samples[-1][2])
+        self.assertEqual([('', {'section': 'db.blue', 'pool_class': 'batch'},
+                           1)],
+                         families['dodai_pool_class_in_use'].samples)
+
+
+class TestPoolClasses(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+                'pool_classes': 'interactive:3, batch:1',
+            },
+            'db.red': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'red.sqlite'),
+                'pool_classes': 'interactive',
+            },
+            'db.green': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'green.sqlite'),
+            },
+        })
+        self.database = self.get_database('db.blue')
+
+    def tearDown(self):
+        self.database.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_config(self):
+        self.assertEqual(['interactive', 'batch'],
+                         self.database.pool_classes.classes)
+        self.assertEqual(4, self.database.pool_classes.total)
+        self.assertEqual(4, self.database.engine.pool.size())
+        self.assertRaises(ValueError, self.get_database, 'db.red')
+        self.assertEqual(None, self.get_database('db.green').pool_classes)
+        self.assertRaises(KeyError, self.get_database('db.green').pool_class,
+                          'batch')
+        self.assertRaises(KeyError, self.database.pool_class, 'reports')
+
+    def test_default_paths_are_gated(self):
+        interactive = self.database.pool_class('interactive')
+        stats = self.database.pool_classes.stats
+        first = self.database.connection
+        self.assertEqual(1, stats('batch')['in_use'])
+        taken = []
+        thread = threading.Thread(target=lambda: taken.append(
+                self.database.engine.connect()))
+        thread.start()
+        deadline = time.monotonic() + 5
+        while not stats('batch')['waiting'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(1, stats('batch')['waiting'])
+        # Ungated work waiting on its class does not hold up interactive
+        with interactive.connect(timeout=1) as connection:
+            self.assertEqual(1, connection.execute(text("SELECT 1"))
+                             .scalar())
+            self.assertEqual(1, stats('interactive')['in_use'])
+        first.close()
+        thread.join(5)
+        self.assertEqual(1, len(taken))
+        self.assertEqual(1, stats('batch')['in_use'])
+        taken[0].close()
+        self.assertEqual(0, stats('batch')['in_use'])
+        self.assertEqual(0, stats('interactive')['in_use'])
+
+    def test_one_gate(self):
+        gates = []
+        threads = [threading.Thread(
+                target=lambda: gates.append(self.database.pool_classes))
+                for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(set(id(x) for x in gates)))
+
+    def test_connections(self):
+        batch = self.database.pool_class('batch')
+        interactive = self.database.pool_class('interactive')
+        with batch.begin() as connection:
+            connection.execute(text("CREATE TABLE foo (id INTEGER)"))
+            with self.assertRaises(PoolClassTimeout):
+                with batch.connect(timeout=0.01):
+                    pass
+            with interactive.session(timeout=1) as session:
+                self.assertEqual(2, session.execute(text("SELECT 2"))
+                                 .scalar())
+        self.assertEqual(0, self.database.pool_classes.stats(
+                'batch')['in_use'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import MetaData
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.reflection import ReflectionCache
+from dodai.model.reflection import SchemaVersion
+
+
+class TestReflectionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = os.path.join(self.directory, 'cache')
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+            },
+        })
+        self.database = self.get_database('db.blue')
+        self._execute("CREATE TABLE foo (id INTEGER PRIMARY KEY, name TEXT)",
+                      "CREATE TABLE bar (id INTEGER PRIMARY KEY, "
+                      "foo_id INTEGER REFERENCES foo (id))")
+
+    def tearDown(self):
+        self.database.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def _execute(self, *statements):
+        with self.database.engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+
+    def _cache(self):
+        return ReflectionCache(self.database.engine, self.cache_directory)
+
+    def test_warm_start(self):
+        cache = self._cache()
+        metadata = cache()
+        self.assertEqual('database', cache.source)
+        self.assertEqual(['bar', 'foo'], sorted(metadata.tables))
+        self.assertTrue(os.path.exists(cache.path()))
+        cache = self._cache()
+        metadata = cache()
+        self.assertEqual('file', cache.source)
+        self.assertEqual(['id', 'name'],
+                         list(metadata.tables['foo'].columns.keys()))
+        self.assertEqual(1, len(metadata.tables['bar'].foreign_keys))
+
+    def test_schema_change(self):
+        self._cache()()
+        self._execute("ALTER TABLE foo ADD COLUMN age INTEGER")
+        cache = self._cache()
+        metadata = cache()
+        self.assertEqual('database', cache.source)
+        self.assertTrue('age' in metadata.tables['foo'].columns)
+        cache()
+        self.assertEqual('file', cache.source)
+
+    def test_file_recreated(self):
+        self._cache()()
+        self.database.engine.dispose()
+        os.remove(os.path.join(self.directory, 'blue.sqlite'))
+        # A new file with one change to the schema, so PRAGMA schema_version
+        # is the same as before
+        self._execute("CREATE TABLE foo (id INTEGER PRIMARY KEY, age INTEGER)",
+                      "CREATE TABLE bar (id INTEGER PRIMARY KEY)")
+        cache = self._cache()
+        metadata = cache()
+        self.assertEqual('database', cache.source)
+        self.assertTrue('age' in metadata.tables['foo'].columns)
+
+    def test_only_and_metadata(self):
+        cache = self._cache()
+        metadata = MetaData()
+        self.assertTrue(cache(only=['foo'], metadata=metadata) is metadata)
+        self.assertEqual(['foo'], list(metadata.tables))
+        self.assertNotEqual(cache.path(), cache.path(only=['foo']))
+        cache()
+        self.assertEqual('database', cache.source)
+
+    def test_corrupt_file(self):
+        cache = self._cache()
+        cache()
+        with open(cache.path(), 'wb') as stream:
+            stream.write(b'nope')
+        cache()
+        self.assertEqual('database', cache.source)
+
+    def test_untrusted_file(self):
+        cache = self._cache()
+        cache()
+        self.assertEqual(0o700, os.stat(self.cache_directory).st_mode & 0o777)
+        self.assertEqual(0o600, os.stat(cache.path()).st_mode & 0o777)
+        os.chmod(cache.path(), 0o666)
+        cache()
+        self.assertEqual('database', cache.source)
+        cache()
+        self.assertEqual('file', cache.source)
+
+    def test_connection_reflect(self):
+        metadata = self.database.reflect(directory=self.cache_directory)
+        self.assertEqual(['bar', 'foo'], sorted(metadata.tables))
+        self.assertEqual(1, len(os.listdir(self.cache_directory)))
+
+    def test_sqlite_version(self):
+        with self.database.engine.connect() as connection:
+            before = SchemaVersion()(connection)
+        self._execute("CREATE INDEX foo_name ON foo (name)")
+        with self.database.engine.connect() as connection:
+            self.assertNotEqual(before, SchemaVersion()(connection))
+
+
+if __name__ == '__main__':
+    unittest.main()
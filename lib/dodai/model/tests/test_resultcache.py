@@ -0,0 +1,225 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import select
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.resultcache import ResultCache
+from dodai.model.resultcache import SqliteBackend
+from dodai.model.resultcache import read_tables
+from dodai.model.resultcache import written_table
+
+
+class TestTables(unittest.TestCase):
+
+    def test_written_table(self):
+        self.assertEqual('foo',
+                         written_table("INSERT INTO foo (a) VALUES (1)"))
+        self.assertEqual('foo', written_table("insert or replace into "
+                                              "main.\"Foo\" VALUES (1)"))
+        self.assertEqual('foo', written_table("  UPDATE foo SET a = 1"))
+        self.assertEqual('foo', written_table("DELETE FROM `foo`"))
+        self.assertEqual('foo', written_table("DROP TABLE IF EXISTS foo"))
+        self.assertEqual(None, written_table("SELECT * FROM foo"))
+
+    def test_read_tables(self):
+        self.assertEqual(set(['foo', 'bar']), read_tables(
+                "SELECT * FROM foo JOIN s.bar ON foo.id = bar.id"))
+        metadata = MetaData()
+        foo = Table('foo', metadata, Column('id', Integer))
+        bar = Table('bar', metadata, Column('id', Integer))
+        statement = select(foo).join(bar, foo.c.id == bar.c.id)
+        self.assertEqual(set(['foo', 'bar']), read_tables(statement))
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+            },
+        })
+        self.database = self.get_database('db.blue')
+        self.metadata = MetaData()
+        self.table = Table('foo', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('name', String(20)))
+        self.other = Table('bar', self.metadata,
+                           Column('id', Integer, primary_key=True))
+        self.metadata.create_all(self.database.engine)
+        with self.database.engine.begin() as connection:
+            connection.execute(self.table.insert(),
+                               [{'id': 1, 'name': 'a'},
+                                {'id': 2, 'name': 'b'}])
+        self.queries = []
+        self.statement = select(self.table).order_by(self.table.c.id)
+
+    def tearDown(self):
+        self.database.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def _write(self, sql):
+        with self.database.engine.begin() as connection:
+            connection.execute(text(sql))
+
+    def test_hit(self):
+        cache = self.database.result_cache()
+        self.assertTrue(cache is self.database.result_cache())
+        first = cache.execute(self.statement)
+        self.assertEqual([(1, 'a'), (2, 'b')], first.all())
+        self.assertEqual(['id', 'name'], first.keys())
+        self._write("INSERT INTO bar VALUES (1)")
+        self.assertEqual(first.all(), cache.execute(self.statement).all())
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(0.5, cache.hit_ratio)
+
+    def test_params_in_key(self):
+        cache = ResultCache(self.database.engine)
+        sql = "SELECT name FROM foo WHERE id = :id"
+        self.assertEqual([('a',)], cache.execute(sql, {'id': 1}).all())
+        self.assertEqual([('b',)], cache.execute(sql, {'id': 2}).all())
+        self.assertEqual(2, cache.misses)
+        statement = self.statement.where(self.table.c.id == 2)
+        cache.execute(statement)
+        cache.execute(self.statement.where(self.table.c.id == 1))
+        self.assertEqual(4, cache.misses)
+
+    def test_write_invalidates(self):
+        cache = ResultCache(self.database.engine)
+        cache.execute(self.statement)
+        self._write("UPDATE foo SET name = 'c' WHERE id = 1")
+        self.assertEqual([(1, 'c'), (2, 'b')],
+                         cache.execute(self.statement).all())
+        self.assertEqual(1, cache.invalidations)
+        self.database.session.execute(self.table.delete().where(
+                self.table.c.id == 2))
+        self.database.session.commit()
+        self.assertEqual([(1, 'c')], cache.execute(self.statement).all())
+        self.assertEqual(3, cache.misses)
+
+    def test_ttl(self):
+        cache = ResultCache(self.database.engine, ttl=60)
+        cache.execute(self.statement, ttl=-1)
+        cache.execute(self.statement)
+        self.assertEqual(2, cache.misses)
+        cache.execute(self.statement)
+        self.assertEqual(1, cache.hits)
+
+    def test_max_entries(self):
+        cache = ResultCache(self.database.engine, max_entries=2)
+        for x in range(3):
+            cache.execute(self.statement.where(self.table.c.id == x))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        cache.execute(self.statement.where(self.table.c.id == 0))
+        self.assertEqual(4, cache.misses)
+
+    def test_max_bytes(self):
+        cache = ResultCache(self.database.engine, max_bytes=1)
+        cache.execute(self.statement)
+        self.assertEqual(0, len(cache))
+
+    def test_sqlite_backend(self):
+        path = os.path.join(self.directory, 'cache.sqlite')
+        cache = ResultCache(self.database.engine, path=path)
+        cache.execute(self.statement)
+        cache = ResultCache(self.database.engine, path=path)
+        self.assertEqual([(1, 'a'), (2, 'b')],
+                         cache.execute(self.statement).all())
+        self.assertEqual(1, cache.hits)
+        self._write("DELETE FROM foo WHERE id = 2")
+        self.assertEqual(0, len(cache))
+        self.assertEqual([(1, 'a')], cache.execute(self.statement).all())
+
+    def test_sqlite_invalidate_literal(self):
+        backend = SqliteBackend(os.path.join(self.directory, 'cache.sqlite'))
+        backend.put('a', b'a', ['userxlog'], None, 1)
+        backend.put('b', b'b', ['user_log'], None, 1)
+        backend.put('c', b'c', ['user%'], None, 1)
+        self.assertEqual(0, backend.invalidate(['user%log']))
+        self.assertEqual(1, backend.invalidate(['user_log']))
+        self.assertEqual(1, backend.invalidate(['user%']))
+        self.assertEqual(1, len(backend))
+
+    def test_sqlite_used_in_batches(self):
+        backend = SqliteBackend(os.path.join(self.directory, 'cache.sqlite'))
+        backend.USED_BATCH = 3
+        backend.put('a', b'a', [], None, 1)
+        backend.put('b', b'b', [], None, 2)
+
+        def used():
+            return backend._db.execute("SELECT key FROM dodai_result_cache "
+                                       "ORDER BY used").fetchall()
+        backend.get('a', 3)
+        backend.get('a', 4)
+        self.assertEqual([('a',), ('b',)], used())
+        backend.evict(1, None)
+        self.assertEqual([('a',)], used())
+        backend.put('b', b'b', [], None, 5)
+        backend.put('c', b'c', [], None, 6)
+        backend.get('c', 7)
+        backend.get('b', 8)
+        self.assertEqual([('a',), ('b',), ('c',)], used())
+        backend.get('a', 9)
+        self.assertEqual([('c',), ('b',), ('a',)], used())
+
+    def test_shared_path(self):
+        path = os.path.join(self.directory, 'cache.sqlite')
+        green = GetDatabase.load({
+            'db.green': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'green.sqlite'),
+            },
+        })('db.green')
+        self.metadata.create_all(green.engine)
+        try:
+            ResultCache(self.database.engine, path=path).execute(
+                    self.statement)
+            cache = ResultCache(green.engine, path=path)
+            self.assertEqual([], cache.execute(self.statement).all())
+            self.assertEqual(0, cache.hits)
+            self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+        finally:
+            green.engine.dispose()
+
+    def test_collect(self):
+        cache = self.database.result_cache()
+        cache.execute(self.statement)
+        families = dict((x.name, x) for x in cache.collect())
+        self.assertEqual([('', {'section': 'db.blue'}, 1)],
+                         families['dodai_result_cache_misses_total'].samples)
+        self.assertEqual(1, families['dodai_result_cache_entries']
+                         .samples[0][2])
+
+
+if __name__ == '__main__':
+    unittest.main()
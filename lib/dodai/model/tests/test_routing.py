@@ -0,0 +1,207 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from sqlalchemy import text
+from dodai.model.database import GetAllDatabaseSections
+from dodai.model.database import GetDatabase
+from dodai.model.routing import LeastOutstandingPicker
+from dodai.model.routing import RoundRobinPicker
+
+
+class _BaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load(self.sections)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _filename(self, name):
+        return os.path.join(self.directory, "{0}.sqlite".format(name))
+
+    @property
+    def sections(self):
+        if not hasattr(self, '_sections_') or not self._sections_:
+            self._sections_ = {
+                'default': {
+                    'environment': 'prod'
+                },
+                'db.replica1': {
+                    'dialect': 'sqlite',
+                    'filename': self._filename('replica1'),
+                    'group': 'frontend',
+                    'environment': 'prod',
+                    'role': 'replica'
+                },
+                'db.primary': {
+                    'dialect': 'sqlite',
+                    'filename': self._filename('primary'),
+                    'group': 'frontend',
+                    'environment': 'prod',
+                    'role': 'primary'
+                },
+                'db.replica2': {
+                    'dialect': 'sqlite',
+                    'filename': self._filename('replica2'),
+                    'group': 'frontend',
+                    'environment': 'prod',
+                    'role': 'replica'
+                },
+                'db.lonely': {
+                    'dialect': 'sqlite',
+                    'filename': self._filename('lonely'),
+                    'group': 'backend',
+                    'environment': 'prod'
+                },
+                'db.orphans': {
+                    'dialect': 'sqlite',
+                    'filename': self._filename('orphans'),
+                    'group': 'orphans',
+                    'environment': 'prod',
+                    'role': 'replica'
+                }
+            }
+        return self._sections_
+
+    def _database_name(self, connection):
+        return connection.execute(text(
+                "SELECT file FROM pragma_database_list "
+                "WHERE name = 'main'")).scalar()
+
+
+class TestGetAllDatabaseSectionsRoles(_BaseTest):
+
+    def test_roles(self):
+        data = GetAllDatabaseSections.load(self.sections)()
+        roles = data['roles']['frontend']['prod']
+        self.assertEqual(roles['primary'], ['db.primary'])
+        self.assertEqual(sorted(roles['replica']),
+                         ['db.replica1', 'db.replica2'])
+
+    def test_group_prefers_primary(self):
+        data = GetAllDatabaseSections.load(self.sections)()
+        self.assertEqual(data['groups']['frontend']['prod'], 'db.primary')
+
+
+class TestGetDatabase(_BaseTest):
+
+    def test_group(self):
+        database = self.get_database('frontend')
+        self.assertEqual(database.name, 'db.primary')
+
+    def test_same_object(self):
+        self.assertIs(self.get_database('frontend'),
+                      self.get_database('db.primary'))
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            self.get_database('frontend', 'dev')
+
+
+class TestRouting(_BaseTest):
+
+    def test_writes_go_to_primary(self):
+        routing = self.get_database.routing('frontend')
+        self.assertIs(routing.engine, self.get_database('db.primary').engine)
+        self.assertIs(routing.session, self.get_database('db.primary').session)
+
+    def test_round_robin(self):
+        routing = self.get_database.routing('frontend')
+        first = routing.read_engine
+        second = routing.read_engine
+        self.assertIsNot(first, second)
+        self.assertIs(first, routing.read_engine)
+        self.assertNotIn(routing.engine, (first, second))
+
+    def test_read_your_writes(self):
+        routing = self.get_database.routing('frontend')
+        with routing.read_your_writes():
+            self.assertIs(routing.read_engine, routing.engine)
+            with routing.reader() as connection:
+                self.assertEqual(self._database_name(connection),
+                                 self._filename('primary'))
+        self.assertIsNot(routing.read_engine, routing.engine)
+
+    def test_read_your_writes_is_per_thread(self):
+        routing = self.get_database.routing('frontend')
+        out = []
+        with routing.read_your_writes():
+            thread = threading.Thread(
+                    target=lambda: out.append(routing.read_engine))
+            thread.start()
+            thread.join()
+        self.assertIsNot(out[0], routing.engine)
+
+    def test_least_outstanding(self):
+        routing = self.get_database.routing('frontend',
+                                            picker=LeastOutstandingPicker)
+        with routing.reader() as first:
+            with routing.reader() as second:
+                self.assertNotEqual(self._database_name(first),
+                                    self._database_name(second))
+                self.assertEqual(routing._picker.outstanding, [1, 1])
+        self.assertEqual(routing._picker.outstanding, [0, 0])
+
+    def test_least_outstanding_read_attributes(self):
+        routing = self.get_database.routing('frontend',
+                                            picker=LeastOutstandingPicker)
+        with routing.read_engine.connect() as first:
+            self.assertEqual(routing._picker.outstanding, [1, 0])
+            with routing.read_engine.connect() as second:
+                self.assertNotEqual(self._database_name(first),
+                                    self._database_name(second))
+            self.assertEqual(routing._picker.outstanding, [1, 0])
+        self.assertEqual(routing._picker.outstanding, [0, 0])
+        connection = routing.read_connection
+        self.assertEqual(routing._picker.outstanding, [1, 0])
+        with routing.reader() as reader:
+            self.assertNotEqual(self._database_name(connection),
+                                self._database_name(reader))
+            self.assertEqual(routing._picker.outstanding, [1, 1])
+        self.assertEqual(routing._picker.outstanding, [1, 0])
+
+    def test_no_replicas(self):
+        routing = self.get_database.routing('backend')
+        self.assertIs(routing.read_engine, routing.engine)
+
+    def test_no_primary(self):
+        with self.assertRaises(ValueError):
+            self.get_database.routing('orphans')
+
+
+class TestPickers(unittest.TestCase):
+
+    def test_round_robin(self):
+        picker = RoundRobinPicker(3)
+        self.assertEqual([picker() for x in range(4)], [0, 1, 2, 0])
+
+    def test_least_outstanding(self):
+        picker = LeastOutstandingPicker(3)
+        self.assertEqual([picker.acquire() for x in range(4)], [0, 1, 2, 0])
+        picker.release(1)
+        self.assertEqual(picker.acquire(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from decimal import Decimal
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import Numeric
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import event
+from sqlalchemy import select
+from dodai.model.database import GetDatabase
+from dodai.model.scan import ParallelScan
+from dodai.model.scan import make_partitions
+from dodai.model.scan import split_range
+from dodai.model.scan import split_sample
+
+
+class TestSplit(unittest.TestCase):
+
+    def test_split_range(self):
+        self.assertEqual([0, 25, 50, 75, 99], split_range(0, 99, 4))
+        self.assertEqual([5, 6, 7, 7], split_range(5, 7, 10))
+        self.assertEqual([0.0, 0.5, 1.0], split_range(0.0, 1.0, 2))
+        self.assertEqual([Decimal('1.00'), Decimal('1.50'), Decimal('2.00')],
+                         split_range(Decimal('1.00'), Decimal('2.00'), 2))
+
+    def test_split_sample(self):
+        self.assertEqual(['a', 'c', 'e'], split_sample(list('edcba'), 2))
+        self.assertEqual(['a'], split_sample(['a'] * 10, 4))
+        self.assertEqual([], split_sample([], 4))
+
+    def test_make_partitions(self):
+        partitions = make_partitions([0, 10, 20])
+        self.assertEqual(3, len(partitions))
+        self.assertEqual((0, 10, False), partitions[0][1:4])
+        self.assertEqual((10, 20, True), partitions[1][1:4])
+        self.assertTrue(partitions[2].null)
+
+
+class TestParallelScan(unittest.TestCase):
+
+    ROWS = 5000
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+            },
+        })
+        self.database = self.get_database('db.blue')
+        self.metadata = MetaData()
+        self.table = Table('foo', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('name', String(20)),
+                           Column('score', Integer))
+        self.metadata.create_all(self.database.engine)
+        rows = [(x, 'n{0:05d}'.format(x), None if x % 100 == 0 else x ** 2)
+                for x in range(self.ROWS)]
+        self.database.bulk_load(self.table, rows)
+        self.expected = sorted(rows)
+
+    def tearDown(self):
+        self.database.dispose()
+        shutil.rmtree(self.directory)
+
+    def _rows(self, scan):
+        out = []
+        for batch in scan:
+            self.assertTrue(len(batch) <= scan.batch_size)
+            out.extend(batch)
+        return sorted(out)
+
+    def test_threads_minmax(self):
+        reports = []
+        scan = ParallelScan(self.database, self.table, 'id', workers=3,
+                            batch_size=100, progress=reports.append)
+        self.assertEqual(self.expected, self._rows(scan))
+        self.assertEqual(13, scan.report.partitions)
+        self.assertEqual(13, scan.report.done)
+        self.assertEqual(self.ROWS, scan.report.rows)
+        self.assertEqual(13, len(reports))
+        self.assertTrue(' rows/s' in str(scan.report))
+
+    def test_quantiles_with_nulls(self):
+        scan = ParallelScan(self.database, self.table, 'score', workers=2,
+                            split='quantiles', partitions=5)
+        self.assertEqual(self.expected, self._rows(scan))
+        self.assertEqual(50, scan.report.partition_rows[
+                scan.report.partitions - 1])
+
+    def test_quantiles_by_offset(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = self.database.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            scan = ParallelScan(self.database, self.table, 'score',
+                                workers=2, split='quantiles', partitions=5,
+                                sample_size=100)
+            partitions = scan.plan()
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(6, len(partitions))
+        self.assertFalse([x for x in statements if 'random' in x])
+        self.assertEqual(self.expected, self._rows(scan))
+        self.assertEqual([990] * 5 + [50],
+                         [scan.report.partition_rows[x] for x in range(6)])
+
+    def test_string_key_and_filter(self):
+        statement = select(self.table).where(self.table.c.id < 1000)
+        scan = self.get_database.scan('db.blue', statement, 'name',
+                                      workers=2)
+        self.assertEqual(self.expected[:1000], self._rows(scan))
+
+    def test_decimal_key(self):
+        table = Table('prices', self.metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('price', Numeric(10, 2)))
+        self.metadata.create_all(self.database.engine)
+        rows = [(x, Decimal(x) / 4) for x in range(1000)]
+        with self.database.engine.begin() as connection:
+            connection.execute(table.insert(),
+                               [{'id': x, 'price': y} for x, y in rows])
+        scan = ParallelScan(self.database, table, 'price', workers=2)
+        self.assertEqual(rows, self._rows(scan))
+
+    def test_processes(self):
+        scan = self.get_database.scan('db.blue', self.table,
+                                      self.table.c.id, workers=2,
+                                      mode='process', partitions=6)
+        self.assertEqual(self.expected, self._rows(scan))
+        self.assertEqual(7, scan.report.done)
+        self.assertFalse(os.getpid() in scan.report.worker_rows)
+
+    def test_empty(self):
+        self.database.engine.dispose()
+        with self.database.engine.begin() as connection:
+            connection.execute(self.table.delete())
+        scan = ParallelScan(self.database, self.table, 'id')
+        self.assertEqual([], self._rows(scan))
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, ParallelScan, self.database,
+                          self.table, 'id', mode='process')
+        self.assertRaises(ValueError, ParallelScan, self.database,
+                          self.table, 'id', split='median')
+        for statement in (select(self.table).limit(10),
+                          select(self.table).offset(10)):
+            self.assertRaises(ValueError, ParallelScan, self.database,
+                              statement, 'id')
+
+    def test_stop_early(self):
+        scan = ParallelScan(self.database, self.table, 'id', workers=4,
+                            batch_size=10)
+        for batch in scan:
+            break
+        self.assertEqual([], self._scan_threads())
+        scan = iter(scan)
+        next(scan)
+        scan.close()
+        self.assertEqual([], self._scan_threads())
+
+    def _scan_threads(self):
+        return [x for x in threading.enumerate()
+                if x.name.startswith('dodai-scan-')]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from dodai.model.database import GetDatabase
+from dodai.model.shard import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['tenant-{0}'.format(x) for x in range(5000)]
+
+    def _owners(self, ring):
+        return dict((key, ring(key)) for key in self.keys)
+
+    def test_balance(self):
+        ring = HashRing({'a': 1, 'b': 1, 'c': 1, 'd': 1})
+        self.assertEqual(640, len(ring))
+        counts = {}
+        for name in self._owners(ring).values():
+            counts[name] = counts.get(name, 0) + 1
+        for count in counts.values():
+            self.assertTrue(900 < count < 1600, counts)
+        self.assertAlmostEqual(1.0, sum(ring.shares().values()))
+
+    def test_weights(self):
+        ring = HashRing({'a': 1, 'b': 3, 'c': 0})
+        shares = ring.shares()
+        self.assertEqual(0.0, shares['c'])
+        self.assertTrue(2.0 < shares['b'] / shares['a'] < 4.5, shares)
+
+    def test_stable(self):
+        self.assertEqual(self._owners(HashRing({'a': 1, 'b': 1})),
+                         self._owners(HashRing({'b': 1, 'a': 1})))
+
+    def test_add_moves_only_to_new(self):
+        ring = HashRing({'a': 1, 'b': 1, 'c': 1, 'd': 1})
+        before = self._owners(ring)
+        ring.update({'a': 1, 'b': 1, 'c': 1, 'd': 1, 'e': 1})
+        after = self._owners(ring)
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all(after[key] == 'e' for key in moved))
+        self.assertTrue(0.1 < len(moved) / 5000.0 < 0.3)
+
+    def test_remove_moves_only_removed(self):
+        ring = HashRing({'a': 1, 'b': 1, 'c': 1, 'd': 1})
+        before = self._owners(ring)
+        ring.update({'a': 1, 'b': 1, 'd': 1})
+        after = self._owners(ring)
+        for key in self.keys:
+            if before[key] != 'c':
+                self.assertEqual(before[key], after[key])
+
+    def test_empty(self):
+        self.assertRaises(KeyError, HashRing({}), 'x')
+
+
+class TestShardRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _get_database(self, weights):
+        sections = {'default': {'environment': 'prod'}}
+        for name, weight in weights.items():
+            sections[name] = {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, name + '.sqlite'),
+                'group': 'customers',
+                'environment': 'prod',
+                'shard_weight': weight,
+            }
+        return GetDatabase.load(sections)
+
+    def test_route(self):
+        get_database = self._get_database({'db.a': '1', 'db.b': '2'})
+        router = get_database.shard_router('customers')
+        name = router.section(42)
+        self.assertTrue(router.connection(42) is get_database(name))
+        self.assertTrue(router.engine(42) is get_database(name).engine)
+        self.assertEqual({'db.a': 1.0, 'db.b': 2.0}, router.ring.weights)
+
+    def test_reload(self):
+        router = self._get_database({'db.a': '1', 'db.b': '1'}
+                                    ).shard_router('customers')
+        keys = range(2000)
+        before = dict((x, router.section(x)) for x in keys)
+        get_database = self._get_database({'db.a': '1', 'db.b': '1',
+                                           'db.c': '1'})
+        self.assertTrue(router is get_database.shard_router(
+                'customers', router=router))
+        for key in keys:
+            name = router.section(key)
+            self.assertTrue(name in (before[key], 'db.c'))
+            self.assertTrue(router.connection(key) is get_database(name))
+
+    def test_reload_swaps_ring(self):
+        router = self._get_database({'db.a': '1', 'db.b': '1'}
+                                    ).shard_router('customers')
+        ring = router.ring
+        get_database = self._get_database({'db.a': '1', 'db.b': '1',
+                                           'db.c': '1'})
+        get_database.shard_router('customers', router=router)
+        # A ring taken before the update still only routes to the sections
+        # that had connections then
+        self.assertEqual({'db.a': 1.0, 'db.b': 1.0}, ring.weights)
+        self.assertEqual(['db.a', 'db.b'], sorted(set(ring(x)
+                                                      for x in range(500))))
+        self.assertFalse(ring is router.ring)
+        self.assertEqual(3, len(router.ring.weights))
+
+    def test_bad_weight(self):
+        get_database = self._get_database({'db.a': 'heavy'})
+        self.assertRaises(ValueError, get_database.shard_router, 'customers')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import gc
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import weakref
+from sqlalchemy import create_engine
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import OperationalError
+from dodai.model.database import GetDatabase
+from dodai.model.singlewriter import SingleWriter
+from dodai.model.singlewriter import WriterClosed
+
+
+class TestSingleWriter(unittest.TestCase):
+
+    INSERT = "INSERT INTO events (id, kind) VALUES (:id, :kind)"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load({
+            'db.events': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'events.sqlite'),
+                'cache_size': '-4000',
+                'busy_timeout': '200'
+            },
+        })
+        self.connection = self.get_database('db.events')
+        self.manager = self.connection.single_writer(readers=3,
+                                                     max_delay=0.01)
+        self.manager.write("CREATE TABLE events (id INTEGER PRIMARY KEY, "
+                           "kind TEXT)")
+
+    def tearDown(self):
+        self.manager.close()
+        self.connection.dispose()
+        shutil.rmtree(self.directory)
+
+    def _count(self):
+        return self.manager.read("SELECT count(*) FROM events")[0][0]
+
+    def test_same_object(self):
+        self.assertIs(self.manager, self.connection.single_writer())
+
+    def test_wal(self):
+        self.assertEqual([('wal',)],
+                         self.manager.read("PRAGMA journal_mode"))
+
+    def test_many_writers(self):
+        errors = []
+
+        def run(start):
+            try:
+                for x in range(start, start + 100):
+                    self.manager.write(self.INSERT, {'id': x, 'kind': 'a'})
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(x * 100,))
+                   for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(800, self._count())
+        stats = self.manager.stats()
+        self.assertEqual(801, stats['writes'])
+        self.assertLess(stats['commits'], stats['writes'])
+
+    def test_failed_write_is_isolated(self):
+        futures = [self.manager.submit(self.INSERT, {'id': x, 'kind': 'a'})
+                   for x in (1, 1, 2)]
+        self.assertEqual(1, futures[0].result())
+        self.assertRaises(IntegrityError, futures[1].result)
+        self.assertEqual(1, futures[2].result())
+        self.assertEqual(2, self._count())
+        self.assertEqual(1, self.manager.stats()['failed'])
+
+    def test_locked_by_another_process(self):
+        other = sqlite3.connect(os.path.join(self.directory, 'events.sqlite'),
+                                isolation_level=None)
+        try:
+            other.execute("BEGIN IMMEDIATE")
+            future = self.manager.submit(self.INSERT, {'id': 1, 'kind': 'a'})
+            self.assertRaises(OperationalError, future.result, 10)
+            other.execute("ROLLBACK")
+        finally:
+            other.close()
+        self.assertEqual(1, self.manager.write(self.INSERT,
+                                               {'id': 2, 'kind': 'a'},
+                                               timeout=10))
+        self.assertEqual(1, self.manager.stats()['failed'])
+
+    def test_callable(self):
+        def work(connection):
+            connection.execute(text(self.INSERT), {'id': 5, 'kind': 'b'})
+            return 'done'
+        self.assertEqual('done', self.manager.write(work))
+        self.assertEqual([('b',)], self.manager.read(
+                "SELECT kind FROM events WHERE id = 5"))
+
+    def test_readers_are_read_only(self):
+        with self.manager.reader() as connection:
+            self.assertRaises(OperationalError, connection.execute,
+                              text(self.INSERT), {'id': 1, 'kind': 'a'})
+            self.assertEqual(-4000, connection.execute(
+                    text("PRAGMA cache_size")).scalar())
+
+    def test_reads_during_writes(self):
+        results = []
+
+        def read():
+            for x in range(50):
+                results.append(self._count())
+
+        threads = [threading.Thread(target=read) for x in range(3)]
+        for thread in threads:
+            thread.start()
+        for x in range(200):
+            self.manager.submit(self.INSERT, {'id': x, 'kind': 'a'})
+        for thread in threads:
+            thread.join()
+        self.assertEqual(150, len(results))
+        self.assertEqual(results, sorted(results))
+
+    def test_close_commits_queued_writes(self):
+        for x in range(50):
+            self.manager.submit(self.INSERT, {'id': x, 'kind': 'a'})
+        self.manager.close()
+        self.assertRaises(WriterClosed, self.manager.submit, self.INSERT)
+        engine = self.connection.engine
+        with engine.connect() as connection:
+            self.assertEqual(50, connection.execute(
+                    text("SELECT count(*) FROM events")).scalar())
+
+    def test_submit_racing_close(self):
+        futures = []
+        started = threading.Event()
+
+        def submit():
+            started.set()
+            try:
+                while True:
+                    futures.append(self.manager.submit(
+                            "INSERT INTO events (kind) VALUES ('a')"))
+            except WriterClosed:
+                pass
+
+        threads = [threading.Thread(target=submit) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        self.manager.close()
+        for thread in threads:
+            thread.join(5)
+        for future in futures:
+            try:
+                future.result(5)
+            except WriterClosed:
+                pass
+
+    def test_writer_thread_dies(self):
+        def stop(connection):
+            raise SystemExit()
+        errors = []
+        excepthook = threading.excepthook
+        threading.excepthook = errors.append
+        try:
+            future = self.manager.submit(stop)
+            self.assertRaises(WriterClosed, future.result, 5)
+            self.manager._thread.join(5)
+        finally:
+            threading.excepthook = excepthook
+        self.assertEqual(SystemExit, errors[0].exc_type)
+        self.assertRaises(WriterClosed, self.manager.submit, self.INSERT)
+
+    def test_close_releases_writer(self):
+        manager = SingleWriter(self.connection.engine)
+        reference = weakref.ref(manager)
+        manager.close()
+        del manager
+        gc.collect()
+        self.assertIsNone(reference())
+
+    def test_needs_file(self):
+        self.assertRaises(ValueError, SingleWriter,
+                          create_engine('sqlite://'))
+
+
+if __name__ == '__main__':
+    unittest.main()
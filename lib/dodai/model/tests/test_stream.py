@@ -0,0 +1,167 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import column
+from sqlalchemy import select
+from sqlalchemy import table
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+
+
+class _BaseTest(unittest.TestCase):
+
+    ROWS = 1000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(cls.directory, 'blue.sqlite'),
+            },
+        })
+        cls.database = get_database('db.blue')
+        with cls.database.engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE big (id INTEGER PRIMARY KEY, grp INT, "
+                "name TEXT)"))
+            connection.execute(text(
+                "WITH RECURSIVE x(n) AS (SELECT 1 UNION ALL "
+                "SELECT n + 1 FROM x WHERE n < :rows) "
+                "INSERT INTO big SELECT n, n % 7, 'name-' || n FROM x"),
+                {'rows': cls.ROWS})
+        cls.table = table('big', column('id'), column('grp'), column('name'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.engine.dispose()
+        shutil.rmtree(cls.directory)
+
+
+class TestStream(_BaseTest):
+
+    def test_cursor(self):
+        rows = list(self.database.stream(select(self.table),
+                                         fetch_size=100))
+        self.assertEqual(len(rows), self.ROWS)
+        self.assertEqual(tuple(rows[-1]), (1000, 1000 % 7, 'name-1000'))
+
+    def test_batches(self):
+        batches = list(self.database.stream(
+                text("SELECT id FROM big WHERE id <= :top"), {'top': 250},
+                batch_size=100))
+        self.assertEqual([len(x) for x in batches], [100, 100, 50])
+
+    def test_keyset(self):
+        statement = select(self.table).where(self.table.c.grp == 3)
+        rows = list(self.database.stream(statement, key='id',
+                                         fetch_size=10))
+        expected = [x for x in range(1, 1001) if x % 7 == 3]
+        self.assertEqual([x.id for x in rows], expected)
+
+    def test_keyset_composite(self):
+        statement = select(self.table.c.grp, self.table.c.id)
+        batches = list(self.database.stream(statement, key=('grp', 'id'),
+                                            fetch_size=64, batch_size=64))
+        rows = [tuple(x) for batch in batches for x in batch]
+        self.assertEqual(rows, sorted(rows))
+        self.assertEqual(len(rows), self.ROWS)
+
+    def test_keyset_needs_select(self):
+        with self.assertRaises(ValueError):
+            list(self.database.stream(text("SELECT * FROM big"),
+                                      method='keyset', key='id'))
+
+    def test_keyset_needs_key(self):
+        with self.assertRaises(ValueError):
+            list(self.database.stream(select(self.table), method='keyset'))
+
+    def test_keyset_no_limit(self):
+        for statement in (select(self.table).limit(5),
+                          select(self.table).offset(10)):
+            with self.assertRaises(ValueError):
+                list(self.database.stream(statement, method='keyset',
+                                          key='id'))
+        rows = list(self.database.stream(
+                select(self.table).order_by(self.table.c.id).offset(10)
+                .limit(5), key='id'))
+        self.assertEqual(list(range(11, 16)), [x.id for x in rows])
+
+    def test_close_early(self):
+        rows = self.database.stream(select(self.table), fetch_size=10)
+        next(rows)
+        rows.close()
+        self.assertEqual(self.database.engine.pool.checkedout(), 0)
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/statm'),
+                     "/proc/self/statm is needed to read the memory used")
+class TestStreamMemory(_BaseTest):
+    """Streams a table of two million rows and checks that the resident
+    memory does not grow past a small ceiling while doing so.  Holding the
+    rows would take hundreds of megabytes.
+    """
+
+    ROWS = 2000000
+    CEILING = 32 * 1024 * 1024
+
+    def _rss(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _growth(self, rows):
+        start = self._rss()
+        peak = start
+        count = 0
+        for batch in rows:
+            count += len(batch)
+            peak = max(peak, self._rss())
+        return count, peak - start
+
+    def test_cursor(self):
+        count, growth = self._growth(self.database.stream(
+                select(self.table), fetch_size=5000, batch_size=5000))
+        self.assertEqual(count, self.ROWS)
+        self.assertLess(growth, self.CEILING)
+
+    def test_keyset(self):
+        count, growth = self._growth(self.database.stream(
+                select(self.table), key='id', fetch_size=5000,
+                batch_size=5000))
+        self.assertEqual(count, self.ROWS)
+        self.assertLess(growth, self.CEILING)
+
+    def test_ceiling_catches_buffering(self):
+        """Makes sure the check would notice the rows being held
+        """
+        def held():
+            with self.database.engine.connect() as connection:
+                result = connection.execute(select(self.table))
+                yield result.fetchmany(500000)
+
+        count, growth = self._growth(held())
+        self.assertGreater(growth, self.CEILING)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.tenants import EngineManager
+
+
+class TestEngineManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sections = {}
+        for x in range(10):
+            self.sections['db.tenant{0}'.format(x)] = {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory,
+                                         'tenant{0}.sqlite'.format(x)),
+                'pool_size': '2',
+                'max_overflow': '0',
+            }
+        self.get_database = GetDatabase.load(self.sections)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _use(self, manager, number):
+        connection = manager('db.tenant{0}'.format(number))
+        with connection.engine.connect() as db:
+            db.execute(text("SELECT 1"))
+        return connection
+
+    def test_lazy(self):
+        manager = EngineManager(self.get_database)
+        self.assertEqual([], manager.live())
+        self._use(manager, 3)
+        self.assertEqual(['db.tenant3'], manager.live())
+        self.assertEqual(1, manager.open_connections())
+
+    def test_max_engines(self):
+        manager = EngineManager(self.get_database, max_engines=3)
+        first = self._use(manager, 0)
+        for x in range(1, 5):
+            self._use(manager, x)
+        self.assertEqual(['db.tenant2', 'db.tenant3', 'db.tenant4'],
+                         manager.live())
+        self.assertEqual(2, manager.evictions)
+        self.assertEqual(0, first.engine.pool.checkedin())
+        again = self._use(manager, 0)
+        self.assertFalse(again is first)
+        self.assertEqual(['db.tenant3', 'db.tenant4', 'db.tenant0'],
+                         manager.live())
+
+    def test_evicted_listeners_removed(self):
+        manager = EngineManager(self.get_database, max_engines=1)
+        first = self._use(manager, 0)
+        dispatch = first.engine.pool.dispatch
+        checkout = len(dispatch.checkout)
+        connect = len(dispatch.connect)
+        second = self._use(manager, 1)
+        dispatch = first.engine.pool.dispatch
+        self.assertEqual(checkout - 1, len(dispatch.checkout))
+        self.assertEqual(connect - 1, len(dispatch.connect))
+        with first.engine.connect() as db:
+            db.execute(text("SELECT 1"))
+        self.assertEqual(['db.tenant1'], manager.live())
+        manager.close()
+        self.assertEqual(checkout - 1,
+                         len(second.engine.pool.dispatch.checkout))
+
+    def test_lru_order(self):
+        manager = EngineManager(self.get_database, max_engines=2)
+        self._use(manager, 0)
+        self._use(manager, 1)
+        connection = self.get_database('db.tenant0')
+        with connection.engine.connect() as db:
+            db.execute(text("SELECT 1"))
+        self._use(manager, 2)
+        self.assertEqual(['db.tenant0', 'db.tenant2'], manager.live())
+
+    def test_max_connections(self):
+        manager = EngineManager(self.get_database, max_engines=100,
+                                max_connections=3)
+        for x in range(6):
+            self._use(manager, x)
+            self.assertTrue(manager.open_connections() <= 3)
+        connection = manager('db.tenant5')
+        with connection.engine.connect() as a:
+            with connection.engine.connect() as b:
+                self.assertTrue(manager.open_connections() <= 3)
+        self.assertEqual(['db.tenant4', 'db.tenant5'], manager.live())
+
+    def test_evict_and_close(self):
+        manager = EngineManager(self.get_database)
+        self._use(manager, 0)
+        self._use(manager, 1)
+        self.assertTrue(manager.evict('db.tenant0'))
+        self.assertFalse(manager.evict('db.tenant0'))
+        manager.close()
+        self.assertEqual([], manager.live())
+        self.assertEqual(0, manager.stats()['connections'])
+
+
+if __name__ == '__main__':
+    unittest.main()
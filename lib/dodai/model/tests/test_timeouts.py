@@ -0,0 +1,125 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from sqlalchemy import text
+from sqlalchemy.dialects.mysql.pymysql import MySQLDialect_pymysql
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+from sqlalchemy.exc import OperationalError
+from dodai.model.database import GetDatabase
+from dodai.model.timeouts import ConnectTimeout
+from dodai.model.timeouts import StatementTimeout
+
+
+class TestConnectTimeout(unittest.TestCase):
+
+    def test_params(self):
+        timeout = ConnectTimeout(2.5)
+        self.assertEqual({'connect_timeout': 3}, timeout.params('psycopg2'))
+        self.assertEqual({'connect_timeout': 2.5}, timeout.params('pymysql'))
+        self.assertEqual({'login_timeout': 3}, timeout.params('pymssql'))
+        self.assertEqual({}, timeout.params('pysqlite'))
+
+    def test_keeps_connect_args(self):
+        cparams = {'connect_timeout': 10}
+        ConnectTimeout(2)(PGDialect_psycopg2(), None, [], cparams)
+        self.assertEqual({'connect_timeout': 10}, cparams)
+
+
+class TestStatementTimeout(unittest.TestCase):
+
+    def test_statement(self):
+        timeout = StatementTimeout(1.5)
+        self.assertEqual("SET statement_timeout = 1500",
+                         timeout.statement(PGDialect_psycopg2()))
+        self.assertEqual("SET SESSION max_execution_time = 1500",
+                         timeout.statement(MySQLDialect_pymysql()))
+
+
+class TestSqliteStatementTimeout(unittest.TestCase):
+
+    SLOW = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) "\
+           "SELECT count(*) FROM n"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+                'statement_timeout': '0.2',
+                'connect_timeout': '5'
+            },
+            'db.red': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'red.sqlite'),
+                'statement_timeout': 'soon'
+            },
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_interrupts(self):
+        engine = self.get_database('db.blue').engine
+        with engine.connect() as connection:
+            started = time.monotonic()
+            with self.assertRaises(OperationalError):
+                connection.execute(text(self.SLOW))
+            self.assertLess(time.monotonic() - started, 5)
+            # The next statement gets its own time
+            time.sleep(0.3)
+            self.assertEqual(1, connection.execute(text("SELECT 1")).scalar())
+
+    def test_interrupts_fetching(self):
+        engine = self.get_database('db.blue').engine
+        with engine.connect() as connection:
+            result = connection.execute(text(
+                    "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL "
+                    "SELECT x + 1 FROM n) SELECT x FROM n LIMIT 20000000"))
+            started = time.monotonic()
+            with self.assertRaises(OperationalError):
+                result.fetchall()
+            self.assertLess(time.monotonic() - started, 5)
+
+    def test_commit_after_deadline(self):
+        engine = self.get_database('db.blue').engine
+        with engine.connect() as connection:
+            connection.execute(text("CREATE TABLE foo (id INTEGER)"))
+            connection.execute(text("INSERT INTO foo VALUES (1)"))
+            time.sleep(0.3)
+            connection.commit()
+            self.assertEqual(1, connection.execute(
+                    text("SELECT count(*) FROM foo")).scalar())
+
+    def test_spec(self):
+        spec = self.get_database.spec('db.blue')
+        self.assertEqual(0.2, spec.statement_timeout)
+        self.assertEqual(5.0, spec.connect_timeout)
+
+    def test_bad_option(self):
+        self.assertRaises(ValueError, self.get_database, 'db.red')
+
+
+if __name__ == '__main__':
+    unittest.main()
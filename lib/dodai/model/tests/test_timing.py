@@ -0,0 +1,165 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from dodai.model.database import DodaiDatabaseObject
+from dodai.model.database import GetDatabase
+from dodai.model.timing import LatencyHistogram
+from dodai.model.timing import QueryTimings
+from dodai.model.timing import normalize_sql
+
+
+class MockLogger(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def warning(self, msg):
+        self.messages.append(msg)
+
+
+class TestNormalizeSql(unittest.TestCase):
+
+    def test_literals(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM t1 WHERE a = 'it''s' AND b = 1.5"),
+            "SELECT * FROM t1 WHERE a = ? AND b = ?")
+
+    def test_parameters_and_lists(self):
+        self.assertEqual(
+            normalize_sql("SELECT a\n  FROM t WHERE b IN (?, ?, ?) "
+                          "AND c = :c AND d = %(d)s AND e = $1"),
+            "SELECT a FROM t WHERE b IN (?) AND c = ? AND d = ? AND e = ?")
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_empty(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertIsNone(histogram.mean)
+
+    def test_precision(self):
+        histogram = LatencyHistogram()
+        for x in range(1, 10001):
+            histogram.record(x / 1000000.0)
+        for percent in (10, 50, 90, 99):
+            expected = percent * 100 / 1000000.0
+            self.assertAlmostEqual(histogram.percentile(percent), expected,
+                                   delta=expected * 0.07)
+        self.assertEqual(histogram.percentile(100), 0.01)
+        self.assertEqual(sum(x[2] for x in histogram.buckets()), 10000)
+
+    def test_buckets_are_contiguous(self):
+        histogram = LatencyHistogram()
+        previous = -1
+        for index in range(200):
+            lower, upper = histogram._bounds(index)
+            self.assertEqual(lower, previous + 1)
+            self.assertEqual(histogram._index(lower), index)
+            self.assertEqual(histogram._index(upper), index)
+            previous = upper
+
+
+class TestQueryTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sections = {
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+                'slow_query_threshold': '0'
+            },
+            'db.green': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'green.sqlite'),
+            }
+        }
+        self.log = MockLogger()
+        self.timings = QueryTimings.load(self.sections, log=self.log)
+        self.get_database = GetDatabase.load(self.sections,
+                                             listeners=[self.timings])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _run(self, name):
+        connection = self.get_database(name).connection
+        connection.execute(text("CREATE TABLE foo (id INT)"))
+        connection.execute(text("INSERT INTO foo VALUES (1), (2), (3)"))
+        connection.execute(text("SELECT * FROM foo WHERE id = 2")).all()
+        connection.commit()
+
+    def test_counts(self):
+        self._run('db.green')
+        stats = self.timings.stats('db.green')
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(stats['rows'], 3)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['slow'], 0)
+        self.assertIsNotNone(stats['percentiles'][99])
+        self.assertEqual(self.timings.histogram('db.green').count, 3)
+
+    def test_sections_are_separate(self):
+        self._run('db.green')
+        self.get_database('db.blue').engine
+        self.assertEqual(sorted(self.timings.sections()),
+                         ['db.blue', 'db.green'])
+        self.assertEqual(self.timings.stats('db.blue')['queries'], 0)
+        with self.assertRaises(KeyError):
+            self.timings.stats('db.red')
+
+    def test_errors(self):
+        connection = self.get_database('db.green').connection
+        with self.assertRaises(OperationalError):
+            connection.execute(text("SELECT * FROM missing"))
+        self.assertEqual(self.timings.stats('db.green')['errors'], 1)
+
+    def test_slow_queries(self):
+        self._run('db.blue')
+        self._run('db.green')
+        slow = self.timings.slow_queries()
+        self.assertEqual(len(slow), 3)
+        self.assertEqual(set(x['name'] for x in slow), set(['db.blue']))
+        self.assertEqual(slow[-1]['statement'],
+                         "SELECT * FROM foo WHERE id = ?")
+        self.assertEqual(len(self.log.messages), 3)
+        self.assertEqual(self.timings.stats('db.blue')['slow'], 3)
+
+    def test_reset(self):
+        self._run('db.blue')
+        self.timings.reset()
+        self.assertEqual(self.timings.stats('db.blue')['queries'], 0)
+        self.assertEqual(self.timings.slow_queries(), [])
+
+    def test_database_object(self):
+        url = "sqlite:///{0}".format(self.sections['db.blue']['filename'])
+        database = DodaiDatabaseObject(url, name='blue',
+                                       listeners=[self.timings])
+        database.session.execute(text("SELECT 1"))
+        self.assertEqual(self.timings.stats('blue')['queries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
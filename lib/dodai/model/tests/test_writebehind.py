@@ -0,0 +1,177 @@
+#
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import text
+from dodai.model.database import GetDatabase
+from dodai.model.writebehind import BufferClosed
+from dodai.model.writebehind import BufferFull
+
+
+class TestWriteBehindBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.get_database = GetDatabase.load({
+            'db.blue': {
+                'dialect': 'sqlite',
+                'filename': os.path.join(self.directory, 'blue.sqlite'),
+            },
+        })
+        self.database = self.get_database('db.blue')
+        self.metadata = MetaData()
+        self.table = Table('foo', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('name', String(20)))
+        self.metadata.create_all(self.database.engine)
+        self.delivered = []
+        self.errors = []
+
+    def tearDown(self):
+        self.database.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def _buffer(self, **kwargs):
+        kwargs.setdefault('on_delivery', self.delivered.append)
+        kwargs.setdefault('on_error',
+                          lambda e, rows: self.errors.append((e, rows)))
+        return self.database.write_behind(self.table, **kwargs)
+
+    def _count(self):
+        with self.database.engine.connect() as connection:
+            return connection.execute(text(
+                    "SELECT COUNT(*) FROM foo")).scalar()
+
+    def test_flush_on_size(self):
+        with self._buffer(max_rows=10, max_age=60) as buffer:
+            for x in range(10):
+                buffer.put((x, 'a'))
+            deadline = time.monotonic() + 5
+            while not self.delivered and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual([10], [len(x) for x in self.delivered])
+            self.assertEqual(10, self._count())
+
+    def test_flush_on_age(self):
+        with self._buffer(max_rows=1000, max_age=0.05) as buffer:
+            buffer.put((1, 'a'))
+            deadline = time.monotonic() + 5
+            while not self.delivered and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual([[(1, 'a')]], self.delivered)
+
+    def test_flush(self):
+        with self._buffer(max_rows=1000, max_age=60) as buffer:
+            buffer.put({'id': 1, 'name': 'a'})
+            self.assertEqual(1, len(buffer))
+            self.assertTrue(buffer.flush(timeout=5))
+            self.assertEqual(0, len(buffer))
+            self.assertEqual(1, self._count())
+
+    def test_close_writes_remaining(self):
+        buffer = self._buffer(max_rows=1000, max_age=60)
+        for x in range(25):
+            buffer.put((x, 'a'))
+        buffer.close()
+        self.assertEqual(25, self._count())
+        self.assertEqual(25, buffer.delivered)
+        self.assertRaises(BufferClosed, buffer.put, (99, 'a'))
+
+    def test_many_threads(self):
+        buffer = self._buffer(max_rows=50, max_age=0.01, capacity=100)
+
+        def produce(start):
+            for x in range(start, start + 500):
+                buffer.put((x, 'a'))
+        threads = [threading.Thread(target=produce, args=(x * 1000,))
+                   for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        buffer.close()
+        self.assertEqual(4000, self._count())
+        self.assertTrue(all(len(x) <= 50 for x in self.delivered))
+
+    def test_callback_error(self):
+        def on_delivery(rows):
+            self.delivered.append(rows)
+            raise RuntimeError("callback failed")
+        log = logging.getLogger('dodai.test.writebehind')
+        with self.assertLogs(log) as logged:
+            buffer = self._buffer(max_rows=2, max_age=60,
+                                  on_delivery=on_delivery, log=log)
+            for x in range(6):
+                buffer.put((x, 'a'))
+            self.assertTrue(buffer.flush(timeout=5))
+            buffer.put((6, 'a'))
+            buffer.close()
+        self.assertEqual(7, self._count())
+        self.assertEqual(7, buffer.delivered)
+        self.assertEqual(4, len(logged.records))
+
+    def test_backpressure(self):
+        gate = threading.Event()
+
+        def on_delivery(rows):
+            gate.wait(5)
+        buffer = self._buffer(max_rows=5, max_age=60, capacity=5,
+                              on_delivery=on_delivery)
+        for x in range(5):
+            buffer.put((x, 'a'))
+        deadline = time.monotonic() + 5
+        while len(buffer) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for x in range(5, 10):
+            buffer.put((x, 'a'))
+        self.assertRaises(BufferFull, buffer.put, (10, 'a'), block=False)
+        started = time.monotonic()
+        self.assertRaises(BufferFull, buffer.put, (10, 'a'), timeout=0.05)
+        self.assertTrue(time.monotonic() - started >= 0.05)
+        gate.set()
+        buffer.put((10, 'a'), timeout=5)
+        buffer.close()
+        self.assertEqual(11, self._count())
+
+    def test_error_callback(self):
+        with self._buffer(max_rows=1000, max_age=60) as buffer:
+            buffer.put((1, 'a'))
+            buffer.put((1, 'b'))
+            buffer.flush(timeout=5)
+            self.assertEqual(1, len(self.errors))
+            self.assertEqual([(1, 'a'), (1, 'b')], self.errors[0][1])
+            self.assertEqual(2, buffer.failed)
+            buffer.put((2, 'c'))
+        self.assertEqual([[(2, 'c')]], self.delivered)
+        self.assertEqual(1, self._count())
+
+
+if __name__ == '__main__':
+    unittest.main()
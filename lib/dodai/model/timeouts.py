@@ -0,0 +1,179 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import time
+from sqlalchemy import event
+
+
+def _whole_seconds(seconds):
+    return max(int(math.ceil(seconds)), 1)
+
+
+def _milliseconds(seconds):
+    return max(int(round(seconds * 1000)), 1)
+
+
+class ConnectTimeout(object):
+    """Callable object for the engine's do_connect event that passes the
+    connect timeout to the DBAPI driver under the name, and in the unit,
+    that the driver understands.  Drivers that are not listed, and sqlite
+    which has nothing to connect to, are left alone.
+    """
+
+    # driver: (connect() keyword, conversion from seconds)
+    PARAMS = {
+        'psycopg2': ('connect_timeout', _whole_seconds),
+        'psycopg': ('connect_timeout', _whole_seconds),
+        'pg8000': ('timeout', float),
+        'asyncpg': ('timeout', float),
+        'pymysql': ('connect_timeout', float),
+        'mysqldb': ('connect_timeout', _whole_seconds),
+        'mysqlconnector': ('connection_timeout', _whole_seconds),
+        'mariadbconnector': ('connect_timeout', _whole_seconds),
+        'pyodbc': ('timeout', _whole_seconds),
+        'pymssql': ('login_timeout', _whole_seconds),
+        'oracledb': ('tcp_connect_timeout', float),
+    }
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def params(self, driver):
+        """Returns the connect() keyword arguments for the driver
+        """
+        if driver not in self.PARAMS:
+            return {}
+        key, convert = self.PARAMS[driver]
+        return {key: convert(self.seconds)}
+
+    def __call__(self, dialect, connection_record, cargs, cparams):
+        for key, val in self.params(dialect.driver).items():
+            cparams.setdefault(key, val)
+
+
+class StatementTimeout(object):
+    """Callable object for the pool's connect event that limits how long a
+    statement may run on each new DBAPI connection.
+
+    Postgres gets its statement_timeout and mysql its max_execution_time
+    (max_statement_time on mariadb) set for the session, oracle a
+    call_timeout and pyodbc a query timeout on the connection.  Sqlite has
+    no such setting, so a progress handler interrupts a statement that is
+    still running once the time is up.  install() arms it before each
+    statement.  Sqlite makes the rows of a query as they are fetched, so
+    the time counts until the rows are fetched, and the deadline is only
+    cleared by a commit, a rollback, an error or the connection going back
+    to the pool; a statement that is done no longer runs and can not be
+    interrupted.
+    """
+
+    STATEMENTS = {
+        'postgresql': "SET statement_timeout = {milliseconds}",
+        'mysql': "SET SESSION max_execution_time = {milliseconds}",
+        'mariadb': "SET SESSION max_statement_time = {seconds}",
+    }
+    INFO_KEY = 'dodai_statement_deadline'
+    PROGRESS_STEPS = 1000
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def statement(self, dialect):
+        """Returns the SQL that sets the timeout for a session of the
+        dialect, or None when it is not set with SQL
+        """
+        name = dialect.name
+        if name == 'mysql' and getattr(dialect, 'is_mariadb', False):
+            name = 'mariadb'
+        if name not in self.STATEMENTS:
+            return None
+        return self.STATEMENTS[name].format(
+                milliseconds=_milliseconds(self.seconds),
+                seconds=self.seconds)
+
+    def install(self, engine):
+        event.listen(engine, 'connect', self._connect(engine.dialect))
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'before_cursor_execute', self._arm)
+            # A deadline left armed would interrupt the commit or rollback
+            event.listen(engine, 'commit', self._end)
+            event.listen(engine, 'rollback', self._end)
+            event.listen(engine, 'handle_error', self._error)
+            event.listen(engine, 'reset', self._reset)
+
+    def _connect(self, dialect):
+        def connect(dbapi_connection, connection_record):
+            sql = self.statement(dialect)
+            if sql:
+                cursor = dbapi_connection.cursor()
+                try:
+                    cursor.execute(sql)
+                finally:
+                    cursor.close()
+                # A rollback when the connection goes back to the pool would
+                # undo the SET
+                dbapi_connection.commit()
+            elif dialect.name == 'sqlite':
+                deadline = [None]
+                connection_record.info[self.INFO_KEY] = deadline
+                dbapi_connection.set_progress_handler(
+                        self._progress(deadline), self.PROGRESS_STEPS)
+            elif dialect.name == 'oracle':
+                dbapi_connection.call_timeout = _milliseconds(self.seconds)
+            elif dialect.driver == 'pyodbc':
+                dbapi_connection.timeout = _whole_seconds(self.seconds)
+        return connect
+
+    @staticmethod
+    def _progress(deadline):
+        def progress():
+            return deadline[0] is not None and \
+                   time.monotonic() > deadline[0]
+        return progress
+
+    def _arm(self, conn, cursor, statement, parameters, context,
+             executemany):
+        deadline = conn.info.get(self.INFO_KEY)
+        if deadline is not None:
+            deadline[0] = time.monotonic() + self.seconds
+
+    def _disarm(self, info):
+        deadline = info.get(self.INFO_KEY)
+        if deadline is not None:
+            deadline[0] = None
+
+    def _end(self, conn):
+        self._disarm(conn.info)
+
+    def _error(self, context):
+        if context.connection is not None:
+            self._disarm(context.connection.info)
+
+    def _reset(self, dbapi_connection, connection_record, reset_state):
+        self._disarm(connection_record.info)
+
+
+def install_timeouts(engine, connect_timeout=None, statement_timeout=None):
+    """Applies a connect timeout and a statement timeout, both in seconds,
+    to every new DBAPI connection of the engine in the way its dialect
+    supports.  A timeout of None is left at the driver's default.
+    """
+    if connect_timeout:
+        event.listen(engine, 'do_connect', ConnectTimeout(connect_timeout))
+    if statement_timeout:
+        StatementTimeout(statement_timeout).install(engine)
@@ -0,0 +1,369 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import threading
+import time
+from collections import deque
+from sqlalchemy import event
+from dodai.model import fork
+from dodai.model.metrics import MetricFamily
+from dodai.model.metrics import quantile
+
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_PARAMETERS = re.compile(r"%\(\w+\)s|%s|(?<!:):\w+|\$\d+|\?")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """Returns the statement with literals and bound parameters replaced
+    with '?', lists of them collapsed to '(?)' and whitespace collapsed so
+    that statements that only differ by their values look the same.
+    """
+    out = _STRINGS.sub('?', statement)
+    out = _PARAMETERS.sub('?', out)
+    out = _NUMBERS.sub('?', out)
+    out = _LISTS.sub('(?)', out)
+    return _SPACES.sub(' ', out).strip()
+
+
+class LatencyHistogram(object):
+    """A histogram of durations with HDR style buckets.
+
+    Durations are kept in microseconds.  Values below 32 get a bucket each
+    and every power of two above that is split into 16 buckets, so a
+    reported value is never more than about 6% away from the real one while
+    recording is a couple of integer operations.
+    """
+
+    SUB_BUCKET_BITS = 5
+    MAX_BITS = 40
+
+    def __init__(self):
+        self._half = 1 << (self.SUB_BUCKET_BITS - 1)
+        self._max_value = (1 << self.MAX_BITS) - 1
+        self._counts = [0] * (self._index(self._max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.SUB_BUCKET_BITS
+        if shift < 1:
+            return value
+        return shift * self._half + (value >> shift)
+
+    def _bounds(self, index):
+        if index < 2 * self._half:
+            return index, index
+        shift = index // self._half - 1
+        sub_bucket = index - shift * self._half
+        return sub_bucket << shift, ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Adds a duration given in seconds
+        """
+        value = min(max(int(seconds * 1000000), 0), self._max_value)
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns the duration in seconds that 'percent' of the recorded
+        durations are at or below
+        """
+        if not self.count:
+            return None
+        target = max(int(round(self.count * percent / 100.0)), 1)
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                return min(self._bounds(index)[1], self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    @property
+    def mean(self):
+        """The mean duration in seconds
+        """
+        if not self.count:
+            return None
+        return self.total / self.count / 1000000.0
+
+    def buckets(self):
+        """Returns a list of (lower, upper, count) for the buckets that have
+        values, with the bounds in seconds
+        """
+        out = []
+        for index, count in enumerate(self._counts):
+            if count:
+                lower, upper = self._bounds(index)
+                out.append((lower / 1000000.0, upper / 1000000.0, count))
+        return out
+
+
+class SectionTimings(object):
+    """The query timings of one database section
+    """
+
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self, name, threshold=None):
+        self.name = name
+        self.threshold = threshold
+        self.histogram = LatencyHistogram()
+        self.queries = 0
+        self.rows = 0
+        self.errors = 0
+        self.slow = 0
+
+    def as_dict(self):
+        """Returns a snapshot of the timings as a dictionary
+        """
+        out = {
+            'name': self.name,
+            'queries': self.queries,
+            'rows': self.rows,
+            'errors': self.errors,
+            'slow': self.slow,
+            'slow_query_threshold': self.threshold,
+            'mean': self.histogram.mean,
+            'min': None,
+            'max': None,
+            'percentiles': {},
+        }
+        if self.histogram.count:
+            out['min'] = self.histogram.min / 1000000.0
+            out['max'] = self.histogram.max / 1000000.0
+        for percent in self.PERCENTILES:
+            out['percentiles'][percent] = self.histogram.percentile(percent)
+        return out
+
+
+class QueryTimings(object):
+    """Engine listener that keeps query timings, row counts, error counts and
+    a log of slow queries for each database section.
+
+    Pass an instance in the listeners of GetDatabase.load,
+    DodaiSqlalchemyConnection or DodaiDatabaseObject.  A section's slow query
+    threshold in seconds comes from its 'slow_query_threshold' key, falling
+    back to the threshold given here.  Slow queries are kept in a bounded
+    log, and written to 'log' when one is given.
+
+    Row counts come from the DBAPI cursor's rowcount, so they are the rows
+    changed by inserts, updates and deletes, and for selects only when the
+    driver reports them.
+
+    To use this class::
+
+        from dodai.model.database import GetDatabase
+        from dodai.model.timing import QueryTimings
+
+        timings = QueryTimings.load(sections)
+        get_database = GetDatabase.load(sections, listeners=[timings])
+
+        # Later on
+        timings.stats('db.blue')['percentiles'][99]
+        timings.slow_queries('db.blue')
+    """
+
+    THRESHOLD_KEY = 'slow_query_threshold'
+    SLOW_LOG_SIZE = 1000
+    LOG_TYPE = 'warning'
+    SLOW_MESSAGE = "Slow query on '{name}' took {duration:.6f}s: {statement}"
+    INFO_KEY = 'dodai_query_start'
+
+    def __init__(self, thresholds=None, threshold=None, log=None,
+                 log_type=None, slow_log_size=None):
+        """
+        :param thresholds: A dictionary of section name to slow query
+            threshold in seconds
+        :param threshold: The slow query threshold for sections that are not
+            in thresholds.  None turns the slow query log off for them.
+        :param log: An instance of 'logger'
+        :param log_type: The name of the log method used for slow queries
+        :param slow_log_size: The number of slow queries that are kept
+        """
+        self._thresholds = thresholds or {}
+        self._threshold = threshold
+        self._log = log
+        self._log_type = log_type or self.LOG_TYPE
+        self._lock = threading.Lock()
+        self._sections = {}
+        self._slow_log = deque(maxlen=slow_log_size or self.SLOW_LOG_SIZE)
+        fork.register(self)
+
+    @classmethod
+    def load(cls, sections, threshold=None, log=None, log_type=None,
+             slow_log_size=None):
+        """Builds the thresholds from the 'slow_query_threshold' key of the
+        given config sections
+        """
+        thresholds = {}
+        for section_name in sections:
+            value = sections[section_name].get(cls.THRESHOLD_KEY)
+            if value:
+                thresholds[section_name] = float(value)
+        return cls(thresholds, threshold, log, log_type, slow_log_size)
+
+    def __call__(self, name, engine):
+        self._section(name)
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after(name))
+        event.listen(engine, 'handle_error', self._error(name))
+
+    def _section(self, name):
+        if name not in self._sections:
+            with self._lock:
+                if name not in self._sections:
+                    threshold = self._thresholds.get(name, self._threshold)
+                    self._sections[name] = SectionTimings(name, threshold)
+        return self._sections[name]
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault(self.INFO_KEY, []).append(time.perf_counter())
+
+    def _after(self, name):
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            duration = time.perf_counter() - conn.info[self.INFO_KEY].pop()
+            rows = cursor.rowcount
+            section = self._section(name)
+            slow = section.threshold is not None and \
+                   duration >= section.threshold
+            with self._lock:
+                section.histogram.record(duration)
+                section.queries += 1
+                if rows > 0:
+                    section.rows += rows
+                if slow:
+                    section.slow += 1
+            if slow:
+                self._slow_query(name, duration, statement, rows)
+        return after_cursor_execute
+
+    def _error(self, name):
+        def handle_error(context):
+            starts = context.connection.info.get(self.INFO_KEY) \
+                     if context.connection is not None else None
+            if starts:
+                starts.pop()
+            section = self._section(name)
+            with self._lock:
+                section.errors += 1
+        return handle_error
+
+    def _slow_query(self, name, duration, statement, rows):
+        statement = normalize_sql(statement)
+        self._slow_log.append({
+            'name': name,
+            'timestamp': time.time(),
+            'duration': duration,
+            'statement': statement,
+            'rows': rows,
+        })
+        if self._log:
+            msg = self.SLOW_MESSAGE.format(name=name, duration=duration,
+                                           statement=statement)
+            getattr(self._log, self._log_type)(msg)
+
+    def sections(self):
+        """Returns the names of the sections that have timings
+        """
+        return list(self._sections)
+
+    def stats(self, name=None):
+        """Returns a snapshot dictionary of the timings of the given section
+        or, without a name, a dictionary of every section's snapshot
+        """
+        with self._lock:
+            if name is not None:
+                return self._section_snapshot(name)
+            return dict((key, section.as_dict())
+                        for key, section in self._sections.items())
+
+    def _section_snapshot(self, name):
+        if name not in self._sections:
+            raise KeyError("No query timings for '{0}'".format(name))
+        return self._sections[name].as_dict()
+
+    def collect(self):
+        """Returns the timings as a list of MetricFamily for
+        dodai.model.metrics.render_prometheus()
+        """
+        stats = self.stats()
+        duration = MetricFamily('dodai_query_duration_seconds', 'summary',
+                                "Time spent running queries")
+        counters = (
+            ('queries', "Queries run"),
+            ('rows', "Rows reported by the DBAPI cursor"),
+            ('errors', "Queries that raised an error"),
+            ('slow', "Queries over the slow query threshold"),
+        )
+        families = [MetricFamily('dodai_query_{0}_total'.format(key),
+                                 'counter', help_)
+                    for key, help_ in counters]
+        for name in sorted(stats):
+            labels = {'section': name}
+            for percent, value in sorted(stats[name]['percentiles'].items()):
+                duration.add(dict(labels, quantile=quantile(percent)), value)
+            histogram = self._sections[name].histogram
+            duration.add(labels, histogram.total / 1000000.0, '_sum')
+            duration.add(labels, histogram.count, '_count')
+            for family, (key, help_) in zip(families, counters):
+                family.add(labels, stats[name][key])
+        return [duration] + families
+
+    def histogram(self, name):
+        """Returns the LatencyHistogram of the given section
+        """
+        return self._sections[name].histogram
+
+    def slow_queries(self, name=None):
+        """Returns the logged slow queries, oldest first, optionally only
+        those of the given section
+        """
+        out = list(self._slow_log)
+        if name is not None:
+            out = [x for x in out if x['name'] == name]
+        return out
+
+    def reset(self):
+        """Forgets all of the timings and slow queries.  The thresholds and
+        engine listeners are kept.
+        """
+        with self._lock:
+            for name, section in self._sections.items():
+                self._sections[name] = SectionTimings(name, section.threshold)
+            self._slow_log.clear()
+
+    def after_fork(self):
+        """Makes a new lock and starts the timings over in the child process
+        so that queries the parent ran are not counted again.  Called
+        automatically after os.fork().
+        """
+        self._lock = threading.Lock()
+        self.reset()
@@ -0,0 +1,250 @@
+# Copyright (C) 2012 Leonard Thomas
+#
+# This file is part of Dodai.
+#
+# Dodai is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Dodai is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Dodai.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import threading
+import time
+from collections import deque
+from dodai.model import fork
+from dodai.model.bulk import BulkLoad
+
+
+class BufferFull(Exception):
+    """Raised when a row can not be added to a WriteBehindBuffer because it
+    is full and stayed full for the whole timeout
+    """
+
+
+class BufferClosed(Exception):
+    """Raised when a row is added to a WriteBehindBuffer that was closed
+    """
+
+
+class WriteBehindBuffer(object):
+    """Collects rows from any number of threads and inserts them in batches
+    from a background thread.
+
+    A batch is written once 'max_rows' rows are waiting or the oldest
+    waiting row is 'max_age' seconds old.  Each batch is written with
+    dodai.model.bulk.BulkLoad in its own transaction.  The buffer holds at
+    most 'capacity' rows; put() waits for room when it is full, so slow
+    writes push back on the threads producing rows instead of growing
+    memory.  close() writes whatever is left and is also run at exit.
+
+    After each batch, on_delivery is called with the list of rows written,
+    or on_error is called with the exception and the list of rows that
+    were not written.  Both are called from the background thread, and
+    an error raised by either is logged and otherwise ignored.
+
+    To use this class::
+
+        database = get_database('db.events')
+        buffer = database.write_behind('events',
+                                       columns=('kind', 'payload'),
+                                       max_rows=500, max_age=0.5)
+        buffer.put(('click', '...'))
+    """
+
+    MAX_ROWS = 1000
+    MAX_AGE = 1.0
+    CAPACITY = 100000
+
+    def __init__(self, engine, table, columns=None, max_rows=None,
+                 max_age=None, capacity=None, on_delivery=None,
+                 on_error=None, log=None):
+        """
+        :param engine: The sqlalchemy engine the rows are written to
+        :param table: A sqlalchemy Table or a table name
+        :param columns: The column names, see BulkLoad
+        :param max_rows: Rows that trigger a write
+        :param max_age: Seconds the oldest row waits at most
+        :param capacity: Rows the buffer holds before put() waits
+        :param on_delivery: Callable called with each list of rows written
+        :param on_error: Callable called with the exception and each list
+            of rows that could not be written
+        :param log: An instance of 'logger' that failed writes are logged
+            to when there is no on_error, and errors of the callbacks.
+            Nothing is logged without one.
+        """
+        self._load = BulkLoad(engine)
+        self.table = table
+        self.columns = columns
+        self.max_rows = max_rows or self.MAX_ROWS
+        self.max_age = max_age or self.MAX_AGE
+        self.capacity = max(capacity or self.CAPACITY, self.max_rows)
+        self._on_delivery = on_delivery
+        self._on_error = on_error
+        self._log = log
+        self.delivered = 0
+        self.failed = 0
+        self.batches = 0
+        self._setup()
+        self._start()
+        atexit.register(self.close)
+        fork.register(self)
+
+    def _setup(self):
+        self._rows = deque()
+        self._times = deque()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="dodai-write-behind")
+        self._thread.start()
+
+    def __len__(self):
+        """The number of rows waiting to be written
+        """
+        with self._condition:
+            return len(self._rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def put(self, row, block=True, timeout=None):
+        """Adds a row to the buffer.  When the buffer is full this waits up
+        to timeout seconds (forever when None) for room, or raises BufferFull
+        right away when block is False.
+        """
+        with self._condition:
+            if self._closed:
+                raise BufferClosed("The write behind buffer is closed")
+            if len(self._rows) >= self.capacity:
+                if not block:
+                    raise BufferFull("The write behind buffer is full")
+                deadline = None if timeout is None else \
+                           time.monotonic() + timeout
+                while len(self._rows) >= self.capacity and not self._closed:
+                    remaining = None if deadline is None else \
+                                deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise BufferFull("The write behind buffer is full")
+                    self._condition.wait(remaining)
+                if self._closed:
+                    raise BufferClosed("The write behind buffer is closed")
+            self._rows.append(row)
+            self._times.append(time.monotonic())
+            # The first row starts the age clock, so the background thread
+            # has to wake up and pick a timeout as well
+            if len(self._rows) == 1 or len(self._rows) >= self.max_rows:
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Writes everything that is waiting now and waits for it to be
+        written.  Returns False if that took longer than timeout.
+        """
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(
+                    lambda: not self._rows and not self._in_flight,
+                    timeout)
+
+    def close(self, timeout=None):
+        """Stops taking rows, writes everything that is waiting and stops
+        the background thread
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def _ready(self):
+        if self._closed or self._flush_requested:
+            return True
+        if len(self._rows) >= self.max_rows:
+            return True
+        return bool(self._times) and \
+            time.monotonic() - self._times[0] >= self.max_age
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._ready():
+                    timeout = None
+                    if self._times:
+                        timeout = self.max_age - (time.monotonic() -
+                                                  self._times[0])
+                    self._condition.wait(timeout)
+                count = min(len(self._rows), self.max_rows)
+                batch = [self._rows.popleft() for x in range(count)]
+                for x in range(count):
+                    self._times.popleft()
+                if not self._rows:
+                    self._flush_requested = False
+                closing = self._closed and not self._rows
+                self._in_flight = count
+                self._condition.notify_all()
+            try:
+                if batch:
+                    self._write(batch)
+            finally:
+                with self._condition:
+                    self._in_flight = 0
+                    self._condition.notify_all()
+            if closing:
+                return
+
+    def _write(self, batch):
+        try:
+            self._load(self.table, batch, columns=self.columns)
+        except Exception as e:
+            self.failed += len(batch)
+            if self._on_error:
+                self._callback(self._on_error, e, batch)
+            elif self._log:
+                self._log.error("Unable to write {0} rows to '{1}': "
+                                "{2}".format(len(batch), self.table, e))
+            return
+        self.delivered += len(batch)
+        self.batches += 1
+        if self._on_delivery:
+            self._callback(self._on_delivery, batch)
+
+    def _callback(self, callback, *args):
+        """Calls on_delivery or on_error.  An error of the callback is
+        logged, since raising it would stop the background thread.
+        """
+        try:
+            callback(*args)
+        except Exception:
+            if self._log:
+                self._log.error(
+                        "The write behind callback {0!r} for '{1}' "
+                        "failed".format(callback, self.table),
+                        exc_info=True)
+
+    def after_fork(self):
+        """Drops the waiting rows in the child process, since the parent
+        writes them, and starts a new background thread.  Called
+        automatically after os.fork().
+        """
+        closed = self._closed
+        self._setup()
+        self._closed = closed
+        if not closed:
+            self._start()